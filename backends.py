@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# Use Python 3
+
+import os
+import glob
+from collections import namedtuple
+
+from level_sensor import MockLevelReader
+import telemetry_store
+
+"""Sensor and actuator backends for pumpcontrol.
+
+A backend is a Devices tuple, which unpacks like the tuple create_devices() has always returned:
+    pump          pump sink: on(), off()
+    status_led    status indicator: on(), off(), blink()
+    seed_voltage  on() and off() around every level probe
+    level_reader  level source: pin_count, read_mask(), read_pin(i), close() (see level_sensor)
+
+Implementations:
+    real GPIO     pumpcontrol.create_devices() with DEVICE_BACKEND = 'gpio' (gpiozero, Raspberry Pi only)
+    mock          create_mock_devices(): in-memory outputs and a MockLevelReader, set by the caller
+    replay        create_replay_devices(): in-memory outputs and a ReplayLevelReader that plays back recorded
+                  levels from CSV files or the telemetry store; the caller steps through the samples as fast as
+                  it likes (see pumpcontrol_replay.py)
+"""
+
+
+Devices = namedtuple("Devices", ["pump", "status_led", "seed_voltage", "level_reader"])
+
+
+class MockOutputDevice:
+    """In-memory stand-in for a gpiozero LED (pump, status LED, seed voltage)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.is_active = False
+        self.blinking = False
+        self.switch_count = 0  # number of off -> on transitions
+
+    def on(self):
+        if not self.is_active:
+            self.switch_count += 1
+        self.is_active = True
+        self.blinking = False
+
+    def off(self):
+        self.is_active = False
+        self.blinking = False
+
+    def blink(self, *args, **kwargs):
+        self.blinking = True
+
+    def close(self):
+        self.off()
+
+
+class ReplayLevelReader:
+    """Level source that returns the recorded level of the current sample as a consistent pin pattern"""
+
+    def __init__(self, samples, pin_count):
+        self.samples = samples  # list of (time, level, pump) as returned by load_replay_samples()
+        self.pin_count = pin_count
+        self.index = 0
+
+    def seek(self, index):
+        self.index = index
+
+    def current_time(self):
+        return self.samples[self.index][0]
+
+    def read_mask(self):
+        level = self.samples[self.index][1]
+        if level is None:
+            return 0
+        return (1 << int(round(level * self.pin_count))) - 1
+
+    def read_pin(self, pin_i):
+        return bool(self.read_mask() >> pin_i & 1)
+
+    def close(self):
+        pass
+
+
+def create_mock_devices(pin_count):
+    return Devices(MockOutputDevice("pump"), MockOutputDevice("status_led"), MockOutputDevice("seed_voltage"),
+                   MockLevelReader(pin_count))
+
+
+def create_replay_devices(samples, pin_count):
+    return Devices(MockOutputDevice("pump"), MockOutputDevice("status_led"), MockOutputDevice("seed_voltage"),
+                   ReplayLevelReader(samples, pin_count))
+
+
+def load_replay_samples(paths, start=None, end=None):
+    """Samples (time, level, pump) sorted by time, from CSV files (.csv, .csv.gz), directories of them, or
+    telemetry store directories (with YYYY-MM-DD.bin files). start and end (unix timestamps) limit the range."""
+    samples = []
+    for path in paths:
+        if os.path.isdir(path) and glob.glob(os.path.join(path, "*.bin")):
+            reader = telemetry_store.TelemetryReader(path)
+            days = reader.days()
+            if not days:
+                continue
+            first = start if start is not None else 0
+            last = end if end is not None else 2 ** 32 - 1
+            for timestamp, level_code, pump_state, flags in telemetry_store.iter_records(
+                    reader.read_range(first, last)):
+                level = None if level_code == telemetry_store.LEVEL_UNKNOWN else level_code / 100.0
+                samples.append((timestamp, level, pump_state))
+            continue
+        if os.path.isdir(path):
+            csv_filepaths = sorted(glob.glob(os.path.join(path, "*.csv")) + glob.glob(os.path.join(path, "*.csv.gz")))
+        else:
+            csv_filepaths = [path]
+        for csv_filepath in csv_filepaths:
+            for timestamp, level, pump_state in telemetry_store.read_csv_records(csv_filepath):
+                if (start is None or timestamp >= start) and (end is None or timestamp < end):
+                    samples.append((timestamp, level, pump_state))
+    samples.sort(key=lambda sample: sample[0])
+    return samples
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# Use Python 3
+
+# Pumpcontrol - parameter sweep backtester
+# Runs the control decision for every combination of threshold_default, threshold_delta and sleep_time against a
+# tank whose inflow is taken from the recorded telemetry (CSV logs or the telemetry store), or against a simulated
+# tank with a constant inflow, and reports pump starts per day, dry-run minutes, water delivered and the minimum
+# level per combination. The combinations are spread over a process pool.
+#
+# Recorded levels cannot be replayed as they are, since other parameters would have switched the pump at other
+# times. Instead, the inflow is estimated per bucket (Default = 1 hour) from the level changes while the pump was
+# off, the pump outflow from the level changes while it was on, and each combination runs the tank simulator with
+# that inflow. tank_simulator.run_event_simulation skips the cycles in which nothing changes, so a year of data
+# costs about as much as its number of inflow buckets and pump cycles, not its number of 30 s cycles.
+#
+# Example: python3 backtester.py logs/ --thresholds 10:40:5 --deltas 5:40:5 --sleep-times 10,30,60 -o sweep.csv
+
+import os
+import sys
+import csv
+import time
+import argparse
+import itertools
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import pumpcontrol
+import pump_scheduler
+from pumpcontrol import ControlMode
+from backends import load_replay_samples
+from tank_simulator import TankModel, InflowProfile, StaticConfig, run_event_simulation
+from virtual_clock import VirtualClock
+
+
+RESULT_FIELDS = ["threshold", "threshold_delta", "sleep_time", "starts_per_day", "dry_run_minutes", "delivered",
+                 "min_level", "pump_on_minutes", "overflowed"]
+
+
+def parse_grid(text):
+    """Parameter values from "start:stop:step" (stop included) or "a,b,c" """
+    if ":" in text:
+        start, stop, step = (float(value) for value in text.split(":"))
+        values = []
+        value = start
+        while value <= stop + 1e-9:
+            values.append(value)
+            value += step
+    else:
+        values = [float(value) for value in text.split(",")]
+    return [int(value) if value == int(value) else value for value in values]
+
+
+def estimate_inflow_profile(samples, capacity, bucket_seconds=3600, max_gap=600, pin_count=None):
+    """Estimate the inflow per bucket and the pump outflow, in litres per hour, from samples (time, level, pump).
+    Returns (InflowProfile, pump_outflow).
+
+    A reading only tells in which pin step the level is, but when it changes, the level is exactly at a pin: the
+    new level when it rises, one step above it when it falls. The rates are taken between these crossings, over
+    stretches in which the pump state did not change and no samples are missing (more than max_gap seconds apart);
+    taking them over whole pump cycles instead would overestimate both flows by one pin step per cycle."""
+    if pin_count is None:
+        pin_count = len(pumpcontrol.LVL_PIN_NO_ARRAY)
+    start_time = samples[0][0]
+    bucket_count = int((samples[-1][0] - start_time) // bucket_seconds) + 1
+    change = {False: [0.0] * bucket_count, True: [0.0] * bucket_count}  # level change per pump state and bucket
+    duration = {False: [0.0] * bucket_count, True: [0.0] * bucket_count}
+
+    crossing = None      # (time, level) of the latest pin crossing
+    stretch_pump = None  # pump state since then, or None if it changed or samples are missing
+    for (timestamp, level, pump_state), (next_timestamp, next_level, next_pump_state) in zip(samples, samples[1:]):
+        interval = next_timestamp - timestamp
+        if level is None or next_level is None or interval <= 0 or interval > max_gap:
+            crossing = None
+            continue
+        if crossing is not None and bool(pump_state) != stretch_pump:
+            stretch_pump = None
+        if next_level == level:
+            continue
+
+        crossing_time = timestamp + interval / 2.0
+        crossing_level = next_level if next_level > level else next_level + 1.0 / pin_count
+        if crossing is not None and stretch_pump is not None:
+            _add_stretch(change[stretch_pump], duration[stretch_pump], crossing, (crossing_time, crossing_level),
+                         start_time, bucket_seconds)
+        crossing = (crossing_time, crossing_level)
+        stretch_pump = bool(next_pump_state)
+
+    # Level units per second -> litres per hour
+    scale = capacity * 3600.0
+    rates = {}
+    for pump_state in (False, True):
+        total_duration = sum(duration[pump_state])
+        rates[pump_state] = sum(change[pump_state]) / total_duration * scale if total_duration else 0.0
+    mean_inflow = max(0.0, rates[False])
+    pump_outflow = max(0.0, mean_inflow - rates[True])
+
+    bucket_rates = []
+    for bucket in range(bucket_count):
+        if duration[False][bucket] > 0:
+            rate = change[False][bucket] / duration[False][bucket] * scale
+        elif duration[True][bucket] > 0:
+            rate = change[True][bucket] / duration[True][bucket] * scale + pump_outflow
+        else:
+            rate = mean_inflow  # no data
+        bucket_rates.append(max(0.0, rate))
+    return InflowProfile(start_time, bucket_seconds, bucket_rates), pump_outflow
+
+
+# Spread the level change between two crossings (time, level) over the buckets it overlaps
+def _add_stretch(change, duration, first, second, start_time, bucket_seconds):
+    (first_time, first_level), (second_time, second_level) = first, second
+    rate = (second_level - first_level) / (second_time - first_time)
+    segment_start = first_time
+    while segment_start < second_time:
+        bucket = int((segment_start - start_time) // bucket_seconds)
+        segment_end = min(second_time, start_time + (bucket + 1) * bucket_seconds)
+        change[bucket] += rate * (segment_end - segment_start)
+        duration[bucket] += segment_end - segment_start
+        segment_start = segment_end
+
+
+class Sweep:
+    """Everything but the swept parameters, sent once to every worker process"""
+
+    def __init__(self, inflow, capacity, pump_outflow, initial_level, start_time, duration, mode=ControlMode.MANUAL,
+                 schedule=None, timer_end_time=0, pin_count=None):
+        self.inflow = inflow  # litres per hour, number or InflowProfile
+        self.capacity = capacity
+        self.pump_outflow = pump_outflow
+        self.initial_level = initial_level
+        self.start_time = start_time
+        self.duration = duration
+        self.mode = mode
+        self.schedule = schedule
+        self.timer_end_time = timer_end_time
+        self.pin_count = pin_count if pin_count is not None else len(pumpcontrol.LVL_PIN_NO_ARRAY)
+
+
+_sweep = None  # the Sweep of this worker process
+
+
+def _init_worker(sweep):
+    global _sweep
+    _sweep = sweep
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def run_combination(combination, sweep=None):
+    """Results (dict with RESULT_FIELDS) for one (threshold, threshold_delta, sleep_time)"""
+    if sweep is None:
+        sweep = _sweep
+    threshold, threshold_delta, sleep_time = combination
+    tank = TankModel(sweep.capacity, sweep.inflow, sweep.pump_outflow, sweep.initial_level)
+    config = StaticConfig(threshold, sweep.mode, True, sweep.schedule, sweep.timer_end_time)
+    previous_threshold_delta = pumpcontrol.threshold_delta
+    pumpcontrol.threshold_delta = threshold_delta  # read by pumpcontrol.is_pump_allowed
+    try:
+        results = run_event_simulation(tank, config, VirtualClock(sweep.start_time), sweep.duration, sleep_time,
+                                       sweep.pin_count)
+    finally:
+        pumpcontrol.threshold_delta = previous_threshold_delta
+    return {
+        "threshold": threshold,
+        "threshold_delta": threshold_delta,
+        "sleep_time": sleep_time,
+        "starts_per_day": results["starts_per_day"],
+        "dry_run_minutes": results["dry_run_seconds"] / 60,
+        "delivered": results["delivered"],
+        "min_level": results["min_level"],
+        "pump_on_minutes": results["pump_on_seconds"] / 60,
+        "overflowed": results["overflowed"],
+    }
+
+
+def run_sweep(sweep, combinations, workers=None):
+    """Results for all combinations, in order, computed by a pool of workers processes (Default = one per CPU)"""
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        return [run_combination(combination, sweep) for combination in combinations]
+    chunksize = max(1, len(combinations) // (workers * 8))
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(sweep,)) as executor:
+        return list(executor.map(run_combination, combinations, chunksize=chunksize))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep pumpcontrol parameters over recorded or simulated inflow")
+    parser.add_argument("paths", nargs="*", help="CSV files (.csv, .csv.gz), log directories, or telemetry "
+                                                 "directories; without paths, a constant --inflow is simulated")
+    parser.add_argument("--thresholds", default=str(pumpcontrol.threshold_default),
+                        help="threshold_default values, start:stop:step or a,b,c (Default = {})"
+                        .format(pumpcontrol.threshold_default))
+    parser.add_argument("--deltas", default=str(pumpcontrol.threshold_delta),
+                        help="threshold_delta values (Default = {})".format(pumpcontrol.threshold_delta))
+    parser.add_argument("--sleep-times", default=str(pumpcontrol.sleep_time),
+                        help="sleep_time values, in seconds (Default = {})".format(pumpcontrol.sleep_time))
+    parser.add_argument("--capacity", type=float, default=1000, help="tank capacity, in litres (Default = 1000)")
+    parser.add_argument("--pump-outflow", type=float,
+                        help="pump outflow, in litres per hour (Default = estimated from the data, or 300)")
+    parser.add_argument("--inflow", type=float, default=100,
+                        help="constant inflow without paths, in litres per hour (Default = 100)")
+    parser.add_argument("--days", type=float, default=365, help="simulated time without paths (Default = 365)")
+    parser.add_argument("--bucket", type=float, default=3600,
+                        help="time over which the inflow is averaged, in seconds (Default = 3600)")
+    parser.add_argument("--mode", choices=[mode.value for mode in ControlMode], default=ControlMode.MANUAL.value,
+                        help="control mode (Default = MANUAL, with the pump switched on)")
+    parser.add_argument("--schedule", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           pumpcontrol.cfg_path, "schedule.csv"),
+                        help="schedule CSV for SCHEDULED mode (Default = cfg/schedule.csv)")
+    parser.add_argument("--workers", type=int, help="number of worker processes (Default = one per CPU)")
+    parser.add_argument("-o", "--output", help="write the results to this CSV file (Default = standard output)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="[%(levelname)s] %(message)s")
+
+    if args.paths:
+        samples = load_replay_samples(args.paths)
+        if len(samples) < 2:
+            print("Not enough samples found in {}".format(", ".join(args.paths)))
+            return 1
+        inflow, pump_outflow = estimate_inflow_profile(samples, args.capacity, args.bucket)
+        if args.pump_outflow is not None:
+            pump_outflow = args.pump_outflow
+        initial_level = next((level for timestamp, level, pump_state in samples if level is not None), 0.5)
+        start_time = samples[0][0]
+        duration = samples[-1][0] - start_time
+        print("Estimated from {} samples: mean inflow {:.1f} l/h, pump outflow {:.1f} l/h".format(
+            len(samples), sum(inflow.rates) / len(inflow.rates), pump_outflow), file=sys.stderr)
+    else:
+        inflow = args.inflow
+        pump_outflow = args.pump_outflow if args.pump_outflow is not None else 300
+        initial_level = 0.5
+        start_time = time.time()
+        duration = args.days * 86400
+
+    schedule = pump_scheduler.read_schedule(args.schedule) if args.mode == ControlMode.SCHEDULED.value else None
+    sweep = Sweep(inflow, args.capacity, pump_outflow, initial_level, start_time, duration, ControlMode(args.mode),
+                  schedule)
+    combinations = list(itertools.product(parse_grid(args.thresholds), parse_grid(args.deltas),
+                                          parse_grid(args.sleep_times)))
+
+    start = time.monotonic()
+    results = run_sweep(sweep, combinations, args.workers)
+    print("Ran {} combinations over {:.1f} days in {:.1f} s".format(len(combinations), duration / 86400.0,
+                                                                     time.monotonic() - start), file=sys.stderr)
+
+    output_file = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.DictWriter(output_file, RESULT_FIELDS)
+        writer.writeheader()
+        for result in results:
+            writer.writerow({name: round(value, 3) if isinstance(value, float) else value
+                             for name, value in result.items()})
+    finally:
+        if args.output:
+            output_file.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
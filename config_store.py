@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# Use Python 3
+
+import os
+import struct
+import logging
+import threading
+import ctypes
+import ctypes.util
+
+logger = logging.getLogger(__name__)
+
+"""Cached configuration store for the files in the CFG directory.
+
+Each registered file is parsed once and only reloaded when its inode, size or modification time changes.
+On Linux, an inotify watch on the containing directories is used so that unchanged files are not even stat'ed;
+without inotify, the store falls back to one stat() per file and refresh.
+
+Attributes:
+    version: Counter that is incremented every time any registered value is reloaded.
+"""
+
+
+# inotify constants, see <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+# IN_MODIFY is left out on purpose: reacting to it would wake the control loop in the middle of a write,
+# IN_CLOSE_WRITE arrives once the writer is done
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class DirectoryWatcher:
+    """Thin ctypes wrapper around Linux inotify, reporting which files in the watched directories changed"""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._libc = libc
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_init1 failed: {}".format(os.strerror(errno)))
+        self._directories = {}  # watch descriptor -> directory path
+
+    def add_directory(self, directory):
+        """Watch a directory for files being written, created, moved or deleted"""
+        directory = os.path.abspath(directory)
+        if directory in self._directories.values():
+            return
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_add_watch failed for {}: {}".format(directory, os.strerror(errno)))
+        self._directories[wd] = directory
+
+    def read_changes(self):
+        """Drain pending events without blocking.
+
+        Returns the set of absolute paths that changed, or None if the kernel queue overflowed and
+        any watched file may have changed.
+        """
+        changed = set()
+        while True:
+            try:
+                buffer = os.read(self._fd, 4096)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                directory = self._directories.get(wd)
+                if directory is not None and name:
+                    changed.add(os.path.join(directory, os.fsdecode(name)))
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class _Entry:
+    def __init__(self, filepath, loader):
+        self.filepath = os.path.abspath(filepath)
+        self.loader = loader
+        self.signature = None
+        self.value = None
+        self.version = 0
+        self.loaded = False
+
+
+# Identify a file version by inode, size and modification time; None if the file does not exist
+def _file_signature(filepath):
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class ConfigStore:
+    """Loads each registered file once and serves the parsed value until the file changes on disk"""
+
+    def __init__(self, use_inotify=True):
+        self.version = 0
+        self._entries = {}
+        self._watcher = None
+        self._changes_lock = threading.Lock()
+        self._changed_paths = set()  # collected by collect_changes(), not refreshed yet; None = all may have changed
+        if use_inotify:
+            try:
+                self._watcher = DirectoryWatcher()
+            except (OSError, AttributeError) as e:
+                # No inotify available (e.g. not on Linux), fall back to stat() polling
+                logger.warning("inotify not available, polling config files instead. Reason: %s", e)
+                self._watcher = None
+
+    def register(self, name, filepath, loader):
+        """Register a file under a name. loader(filepath) returns the parsed value and handles its own defaults."""
+        entry = _Entry(filepath, loader)
+        self._entries[name] = entry
+        if self._watcher is not None:
+            self._watcher.add_directory(os.path.dirname(entry.filepath))
+
+    def get(self, name):
+        """Return the cached value, loading the file on first access"""
+        entry = self._entries[name]
+        if not entry.loaded:
+            self._reload(entry, _file_signature(entry.filepath))
+        return entry.value
+
+    def version_of(self, name):
+        """Version of the store at which the named value was last reloaded"""
+        return self._entries[name].version
+
+    def filepath_of(self, name):
+        return self._entries[name].filepath
+
+    def collect_changes(self):
+        """Drain the inotify events without reloading anything (never blocks), so that an event loop can stop the
+        watch descriptor from being readable and leave the reloading to refresh() in a worker thread.
+        Returns True if any file in a watched directory changed."""
+        if self._watcher is None:
+            return False
+        changed_paths = self._watcher.read_changes()
+        with self._changes_lock:
+            if changed_paths is None or self._changed_paths is None:
+                self._changed_paths = None
+            else:
+                self._changed_paths |= changed_paths
+        return changed_paths is None or bool(changed_paths)
+
+    def refresh(self):
+        """Reload every file that changed since the last refresh. Returns True if any value was reloaded."""
+        if self._watcher is not None:
+            self.collect_changes()
+            with self._changes_lock:
+                changed_paths = self._changed_paths
+                self._changed_paths = set()
+        else:
+            changed_paths = None  # check everything
+
+        reloaded = False
+        for entry in self._entries.values():
+            if entry.loaded and changed_paths is not None and entry.filepath not in changed_paths:
+                continue
+            signature = _file_signature(entry.filepath)
+            if entry.loaded and signature == entry.signature:
+                continue
+            self._reload(entry, signature)
+            reloaded = True
+        return reloaded
+
+    def invalidate(self):
+        """Force all files to be reloaded on the next access or refresh"""
+        for entry in self._entries.values():
+            entry.loaded = False
+
+    def fileno(self):
+        """File descriptor that becomes readable when a watched directory changes, or None without inotify"""
+        return self._watcher.fileno() if self._watcher is not None else None
+
+    def close(self):
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+    def _reload(self, entry, signature):
+        entry.value = entry.loader(entry.filepath)
+        entry.signature = signature
+        entry.loaded = True
+        self.version += 1
+        entry.version = self.version
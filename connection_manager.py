@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# Use Python 3
+
+import ssl
+import json
+import time
+import socket
+import http.client
+from urllib.parse import urlsplit
+
+"""Persistent HTTP(S) connections for cloud uploads.
+
+Keeps one keep-alive connection per endpoint (scheme, host, port) instead of a new TCP and TLS handshake per
+request. When a connection has to be re-established, the previous TLS session is offered to the server so that
+the handshake can be resumed instead of done in full. Failed connection attempts are retried with exponential
+backoff; while backing off, requests fail immediately with ConnectionBackoff instead of blocking on the network.
+
+Counters (see stats()): connects, full and resumed TLS handshakes, requests, requests on a reused connection,
+and round-trip time of the requests.
+"""
+
+
+class ConnectionBackoff(ConnectionError):
+    """Raised instead of connecting while a previous connection attempt failed recently"""
+
+
+class _ResumingHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPSConnection that offers a previous TLS session for resumption"""
+
+    def __init__(self, host, port, timeout, context, session):
+        super().__init__(host, port, timeout=timeout, context=context)
+        self._tls_session = session
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout, self.source_address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host, session=self._tls_session)
+
+
+class PersistentConnection:
+    """One keep-alive connection to one endpoint, reconnecting with exponential backoff"""
+
+    def __init__(self, scheme, host, port, timeout=10.0, ssl_context=None, initial_backoff=1.0, max_backoff=300.0,
+                 max_idle_time=55.0):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.ssl_context = ssl_context if ssl_context is not None else ssl.create_default_context()
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.max_idle_time = max_idle_time  # most servers drop idle keep-alive connections after about a minute
+
+        # Counters
+        self.connects = 0
+        self.full_handshakes = 0
+        self.resumed_handshakes = 0
+        self.requests = 0
+        self.reused_requests = 0
+        self.failures = 0
+        self.rtt_total = 0.0
+        self.rtt_max = 0.0
+
+        self._conn = None
+        self._tls_session = None
+        self._last_used = 0.0
+        self._backoff = 0.0
+        self._next_attempt = 0.0
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        """Send a request and return (status, response body). Raises ConnectionError if the server is unreachable.
+        timeout (seconds) applies to this request only (Default = the connection's timeout)."""
+        if headers is None:
+            headers = {}
+        if timeout is None:
+            timeout = self.timeout
+        if self._conn is not None and time.monotonic() - self._last_used > self.max_idle_time:
+            self.close()
+
+        for attempt in range(2):
+            fresh = self._conn is None
+            if fresh:
+                self._connect(timeout)
+            # The socket timeout is set at connect time, apply this request's one to a reused connection as well
+            self._conn.timeout = timeout
+            if self._conn.sock is not None:
+                self._conn.sock.settimeout(timeout)
+            try:
+                start = time.monotonic()
+                self._conn.request(method, path, body, headers)
+                response = self._conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                self.close()
+                # A reused connection may have been closed by the server in the meantime, try once more on a new one
+                if fresh or attempt > 0:
+                    self._schedule_retry()
+                    raise ConnectionError("Request to {}://{}:{} failed: {}".format(self.scheme, self.host, self.port,
+                                                                                   e))
+                continue
+
+            rtt = time.monotonic() - start
+            self.requests += 1
+            self.rtt_total += rtt
+            self.rtt_max = max(self.rtt_max, rtt)
+            if not fresh:
+                self.reused_requests += 1
+            self._last_used = time.monotonic()
+            self._remember_tls_session()
+            if response.will_close:
+                self.close()
+            return response.status, data
+
+    def close(self):
+        if self._conn is not None:
+            self._remember_tls_session()
+            self._conn.close()
+            self._conn = None
+
+    def stats(self):
+        return {
+            "connects": self.connects,
+            "full_handshakes": self.full_handshakes,
+            "resumed_handshakes": self.resumed_handshakes,
+            "requests": self.requests,
+            "reused_requests": self.reused_requests,
+            "reuse_rate": float(self.reused_requests) / self.requests if self.requests else 0.0,
+            "failures": self.failures,
+            "rtt_mean": self.rtt_total / self.requests if self.requests else 0.0,
+            "rtt_max": self.rtt_max,
+        }
+
+    def _connect(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        now = time.monotonic()
+        if now < self._next_attempt:
+            raise ConnectionBackoff("Not reconnecting to {} for another {:.0f} s"
+                                    .format(self.host, self._next_attempt - now))
+
+        if self.scheme == "https":
+            conn = _ResumingHTTPSConnection(self.host, self.port, timeout, self.ssl_context, self._tls_session)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        try:
+            conn.connect()
+        except OSError as e:
+            conn.close()
+            self._schedule_retry()
+            raise ConnectionError("Could not connect to {}://{}:{}: {}".format(self.scheme, self.host, self.port, e))
+
+        self.connects += 1
+        if self.scheme == "https":
+            if conn.sock.session_reused:
+                self.resumed_handshakes += 1
+            else:
+                self.full_handshakes += 1
+        self._conn = conn
+        self._backoff = 0.0
+        self._next_attempt = 0.0
+
+    def _schedule_retry(self):
+        self.failures += 1
+        if self._backoff == 0.0:
+            self._backoff = self.initial_backoff
+        else:
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+        self._next_attempt = time.monotonic() + self._backoff
+
+    def _remember_tls_session(self):
+        # With TLS 1.3 the session ticket only arrives after the handshake, so pick it up after every response
+        if self._conn is not None and isinstance(self._conn.sock, ssl.SSLSocket):
+            session = self._conn.sock.session
+            if session is not None:
+                self._tls_session = session
+
+
+class ConnectionManager:
+    """Hands out one PersistentConnection per endpoint"""
+
+    def __init__(self, timeout=10.0, ssl_context=None, **connection_options):
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.connection_options = connection_options
+        self._connections = {}
+
+    def connection_for(self, url):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        connection = self._connections.get(key)
+        if connection is None:
+            connection = PersistentConnection(parts.scheme, parts.hostname, port, self.timeout, self.ssl_context,
+                                              **self.connection_options)
+            self._connections[key] = connection
+        return connection
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """Send a request and return (status, response body). Raises ConnectionError if the server is unreachable.
+        timeout (seconds) applies to this request only (Default = the manager's timeout)."""
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        return self.connection_for(url).request(method, path, body, headers, timeout)
+
+    def post_json(self, url, body, timeout=None):
+        """POST a JSON body and return the HTTP status code; usable as transport for ThingspeakUploader, whose
+        timeout is then applied to each request"""
+        status, data = self.request("POST", url, json.dumps(body).encode("utf-8"),
+                                    {"Content-Type": "application/json"}, timeout)
+        return status
+
+    def stats(self):
+        """Counters per endpoint, keyed by "scheme://host:port\""""
+        return {"{}://{}:{}".format(*key): connection.stats() for key, connection in self._connections.items()}
+
+    def close(self):
+        for connection in self._connections.values():
+            connection.close()
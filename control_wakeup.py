@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# Use Python 3
+
+import os
+import time
+import select
+
+"""Wake-up source for the control loop.
+
+Instead of sleeping for a fixed interval, the control loop waits until one of the following happens:
+    - a watched file descriptor becomes readable (e.g. the inotify descriptor of the config store),
+    - notify() is called (e.g. from a gpiozero when_pressed / when_released callback on a level pin),
+    - a deadline passes (e.g. the timer expires or the next schedule window starts or ends),
+    - the maximum idle time elapsed, as a safety net.
+"""
+
+
+WAKEUP_EVENT = "event"
+WAKEUP_DEADLINE = "deadline"
+WAKEUP_IDLE = "idle"
+
+
+class ControlWakeup:
+    """Blocks the control loop until something happened that may change the pump state"""
+
+    def __init__(self, max_idle_time, min_cycle_time=0.0):
+        self.max_idle_time = max_idle_time
+        self.min_cycle_time = min_cycle_time  # rate limit for bouncing inputs
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+        self._fds = [self._read_fd]
+        self._last_wakeup = time.monotonic()
+
+    def watch_fd(self, fd):
+        """Wake up when fd becomes readable. The owner of fd is responsible for draining it."""
+        if fd is not None and fd not in self._fds:
+            self._fds.append(fd)
+
+    def notify(self):
+        """Wake up the waiting loop. Safe to call from any thread, e.g. gpiozero callbacks."""
+        try:
+            os.write(self._write_fd, b"\0")
+        except BlockingIOError:
+            pass  # pipe full, a wake-up is pending anyway
+
+    def wait(self, deadline=None):
+        """Wait until an event, the deadline (unix timestamp) or the maximum idle time. Returns the reason."""
+        timeout = self.max_idle_time
+        reason = WAKEUP_IDLE
+        if deadline is not None:
+            time_to_deadline = max(0.0, deadline - time.time())
+            if time_to_deadline <= timeout:
+                timeout = time_to_deadline
+                reason = WAKEUP_DEADLINE
+
+        readable, _, _ = select.select(self._fds, [], [], timeout)
+        if readable:
+            reason = WAKEUP_EVENT
+            if self._read_fd in readable:
+                self._drain()
+            # Let bursts of events (bouncing pins, multi-step file writes) settle
+            remaining = self.min_cycle_time - (time.monotonic() - self._last_wakeup)
+            if remaining > 0:
+                time.sleep(remaining)
+                self._drain()
+
+        self._last_wakeup = time.monotonic()
+        return reason
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    def _drain(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
@@ -19,6 +19,11 @@ spec.loader.exec_module(pump_scheduler)
 spec = importlib.util.spec_from_file_location("module.name", "/home/pi/pumpcontrol/pump_timer.py")
 pump_timer = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(pump_timer)
+
+# Level Trend Module
+spec = importlib.util.spec_from_file_location("module.name", "/home/pi/pumpcontrol/level_trend.py")
+level_trend = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(level_trend)
 ######################################################
 
 cfg_directory = os.path.join("/home/pi/pumpcontrol", "cfg")
@@ -26,6 +31,8 @@ mode_file_path = os.path.join(cfg_directory, "mode_selection.cfg")
 manual_state_file_path = os.path.join(cfg_directory, "manual_pump_control.cfg")
 schedule_file_path = os.path.join(cfg_directory, "schedule.csv")
 timer_file_path = os.path.join(cfg_directory, "timer.cfg")
+trend_file_path = os.path.join("/home/pi/pumpcontrol", "telemetry", "trend.json")
+schedule_check_interval = 10  # seconds in which schedule.csv is not checked for changes again
 
 # def check_pumpcontrol_running():
 #     #subprocess.check_output(['ls', '-l'])
@@ -173,13 +180,18 @@ def index(request):
         elif manual_state == "0":
             manual_state = "OFF"
 
-        schedule_simple = pump_scheduler.get_schedule_textual_vertically(schedule_file_path)
-        schedule_today = pump_scheduler.get_todays_schedule_textual_vertically(schedule_file_path)
-        schedule_tomorrow = pump_scheduler.get_tomorrows_schedule_textual_vertically(schedule_file_path)
+        # All schedule texts from the cached compiled schedule, rendered once per schedule version and day
+        schedule_texts = pump_scheduler.schedule_texts(
+            pump_scheduler.read_valid_schedule(schedule_file_path, max_age=schedule_check_interval))
+        schedule_simple = schedule_texts.week
+        schedule_today = schedule_texts.today
+        schedule_tomorrow = schedule_texts.tomorrow
 
         timer_expiration_textual = pump_timer.get_end_time_textual_simplified(timer_file_path, 0)
         time_left_textual = pump_timer.get_time_left_textual(timer_file_path, 0)
 
+        trend_textual = level_trend.get_trend_textual(trend_file_path)
+
         # Export the variables to be used in HTML
         context = {
             'today_textual': today_textual,
@@ -190,7 +202,8 @@ def index(request):
             'schedule_today': schedule_today,
             'schedule_tomorrow': schedule_tomorrow,
             'timer_expiration_textual': timer_expiration_textual,
-            'time_left_textual': time_left_textual
+            'time_left_textual': time_left_textual,
+            'trend_textual': trend_textual
             }
 
         return render(request, 'frontend/index.html', context)
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# Use Python 3
+
+import time
+from array import array
+
+from level_sensor import decode_table, LevelDecoding, FAULT_NONE
+
+"""Oversampled level acquisition with robust estimates.
+
+LevelRingBuffer keeps the latest level pin masks and their (monotonic) sample times in two preallocated arrays
+of fixed capacity, so it runs indefinitely in constant memory and adding a sample allocates nothing. Estimates
+over a time window are computed from a preallocated histogram of the decoded level codes (0 to pin_count):
+    median_level(window)   lower median, robust against sloshing (the lower one of two middle values)
+    mode_level(window)     most frequent level, ties resolved towards the lower level
+    debounced_level()      level that was seen debounce_count times in a row (updated on every sample)
+Levels are decoded through level_sensor.decode_table, so inconsistent patterns contribute their conservative level.
+"""
+
+
+ESTIMATES = ("median", "mode", "debounced")
+
+
+class LevelRingBuffer:
+    """Fixed-size ring buffer of level pin masks with median, mode and debounced level estimates"""
+
+    def __init__(self, pin_count, capacity=600, debounce_count=10):
+        self.pin_count = pin_count
+        self.capacity = capacity
+        self.debounce_count = debounce_count
+
+        table = decode_table(pin_count)
+        self._level_codes = array("B", [int(round(decoding.level * pin_count)) for decoding in table])
+        self._faults = array("B", [decoding.fault for decoding in table])
+
+        self._masks = array("H", bytes(2 * capacity))
+        self._times = array("d", bytes(8 * capacity))
+        self._histogram = [0] * (pin_count + 1)
+        self._next = 0     # index the next sample is written to
+        self.count = 0     # number of valid samples (at most capacity)
+        self.total = 0     # number of samples ever added
+
+        self._debounced_code = None
+        self._candidate_code = None
+        self._candidate_count = 0
+
+    def add(self, mask, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        index = self._next
+        self._masks[index] = mask
+        self._times[index] = timestamp
+        self._next = index + 1 if index + 1 < self.capacity else 0
+        if self.count < self.capacity:
+            self.count += 1
+        self.total += 1
+
+        code = self._level_codes[mask]
+        if code == self._candidate_code:
+            self._candidate_count += 1
+        else:
+            self._candidate_code = code
+            self._candidate_count = 1
+        if self._candidate_count >= self.debounce_count or self._debounced_code is None:
+            self._debounced_code = code
+
+    def sample_burst(self, read_mask, burst_size, rate):
+        """Add burst_size samples from read_mask(), rate samples per second"""
+        interval = 1.0 / rate
+        next_sample = time.monotonic()
+        for sample_i in range(burst_size):
+            if sample_i:
+                delay = next_sample - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.add(read_mask())
+            next_sample += interval
+
+    def latest_mask(self):
+        if self.count == 0:
+            return None
+        return self._masks[self._next - 1]
+
+    def _fill_histogram(self, window, now):
+        """Histogram of the level codes of the samples of the last window seconds; returns the number of samples
+        and the fault class of the newest inconsistent sample among them"""
+        histogram = self._histogram
+        for code in range(len(histogram)):
+            histogram[code] = 0
+        oldest = now - window
+        index = self._next
+        samples = 0
+        fault = FAULT_NONE
+        while samples < self.count:
+            index = index - 1 if index > 0 else self.capacity - 1
+            if self._times[index] < oldest:
+                break
+            mask = self._masks[index]
+            histogram[self._level_codes[mask]] += 1
+            if fault == FAULT_NONE:
+                fault = self._faults[mask]
+            samples += 1
+        return samples, fault
+
+    def median_level(self, window, now=None):
+        """Lower median of the levels of the last window seconds as LevelDecoding, or None without samples"""
+        samples, fault = self._fill_histogram(window, time.monotonic() if now is None else now)
+        if samples == 0:
+            return None
+        cumulative = 0
+        for code, code_count in enumerate(self._histogram):
+            cumulative += code_count
+            if 2 * cumulative >= samples:
+                return LevelDecoding(float(code) / self.pin_count, fault == FAULT_NONE, fault)
+
+    def mode_level(self, window, now=None):
+        """Most frequent level of the last window seconds as LevelDecoding, or None without samples"""
+        samples, fault = self._fill_histogram(window, time.monotonic() if now is None else now)
+        if samples == 0:
+            return None
+        histogram = self._histogram
+        mode_code = 0
+        for code in range(1, len(histogram)):
+            if histogram[code] > histogram[mode_code]:
+                mode_code = code
+        return LevelDecoding(float(mode_code) / self.pin_count, fault == FAULT_NONE, fault)
+
+    def debounced_level(self):
+        """Latest level that was read debounce_count times in a row as LevelDecoding, or None without samples"""
+        if self._debounced_code is None:
+            return None
+        fault = self._faults[self.latest_mask()]
+        return LevelDecoding(float(self._debounced_code) / self.pin_count, fault == FAULT_NONE, fault)
+
+    def estimate(self, name, window, now=None):
+        """One of the ESTIMATES by name"""
+        if name == "median":
+            return self.median_level(window, now)
+        elif name == "mode":
+            return self.mode_level(window, now)
+        elif name == "debounced":
+            return self.debounced_level()
+        raise ValueError("Unknown level estimate: {}".format(name))
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# Use Python 3
+
+import mmap
+import struct
+from collections import namedtuple
+
+"""Level pin readers that return the state of all level pins as one bitmask.
+
+Bit i of the mask is the state of pin i of LVL_PIN_NO_ARRAY (ordered from the lowest to the highest probe),
+set if the probe is wet (HIGH while the seed voltage is on). All readers share the same interface:
+    reader.pin_count     number of level pins
+    reader.read_mask()   read all pins, return the bitmask
+    reader.read_pin(i)   read pin i only, return True if it is wet
+    reader.close()       release the pins
+
+Backends:
+    GpiozeroLevelReader  one gpiozero Button per pin, read one after another (the original way)
+    GpiomemLevelReader   snapshot of the BCM283x GPIO level register through /dev/gpiomem, a single memory read
+                         for all pins; the pins are configured (input, pull-down) by gpiozero Buttons as before
+    GpiodLevelReader     all pins requested as one group through libgpiod, read with a single ioctl
+    MockLevelReader      no hardware, the mask is set by the caller (for tests and trials)
+
+AdaptiveLevelReader wraps any of them and reads only the pins around the previous level (see its docstring).
+
+decode_table(pin_count)[mask] decodes a mask in O(1) into a LevelDecoding: the level, whether the pattern is
+physically possible, and the likely sensor fault if it is not.
+"""
+
+
+# Offset of the GPLEV0 register (level of GPIO 0-31) in the BCM283x GPIO register block
+GPLEV0_OFFSET = 0x34
+
+
+# Unpack a bitmask into a list of booleans, pin 0 first
+def mask_to_pin_values(mask, pin_count):
+    return [bool(mask >> pin_i & 1) for pin_i in range(pin_count)]
+
+
+# Pack a list of pin states (pin 0 first) into a bitmask
+def pin_values_to_mask(pin_values):
+    mask = 0
+    for pin_i, pin_value in enumerate(pin_values):
+        if pin_value:
+            mask |= 1 << pin_i
+    return mask
+
+
+class GpiozeroLevelReader:
+    """Reads gpiozero Buttons one at a time"""
+
+    def __init__(self, lvl_pin_array):
+        self.lvl_pin_array = lvl_pin_array
+        self.pin_count = len(lvl_pin_array)
+
+    def read_mask(self):
+        mask = 0
+        for pin_i in range(self.pin_count):
+            if self.lvl_pin_array[pin_i].is_pressed:
+                mask |= 1 << pin_i
+        return mask
+
+    def read_pin(self, pin_i):
+        return bool(self.lvl_pin_array[pin_i].is_pressed)
+
+    def close(self):
+        for lvl_pin in self.lvl_pin_array:
+            lvl_pin.close()
+
+
+class GpiomemLevelReader:
+    """Reads all level pins at once from the GPIO level register (Raspberry Pi only, GPIO 0-31)"""
+
+    def __init__(self, pin_numbers, lvl_pin_array=(), device="/dev/gpiomem"):
+        if max(pin_numbers) > 31:
+            raise ValueError("GPIO level register snapshots only cover GPIO 0-31")
+        self.pin_count = len(pin_numbers)
+        self.lvl_pin_array = lvl_pin_array  # gpiozero Buttons that keep the pins configured as inputs
+
+        # One table per register byte: byte value -> the level pin bits it contains
+        self._byte_tables = [[0] * 256 for byte_i in range(4)]
+        for pin_i, pin_no in enumerate(pin_numbers):
+            table = self._byte_tables[pin_no // 8]
+            for byte_value in range(256):
+                if byte_value >> (pin_no % 8) & 1:
+                    table[byte_value] |= 1 << pin_i
+
+        with open(device, "r+b") as gpiomem_file:
+            self._registers = mmap.mmap(gpiomem_file.fileno(), 4096)
+
+    def read_mask(self):
+        register = struct.unpack_from("<I", self._registers, GPLEV0_OFFSET)[0]
+        tables = self._byte_tables
+        return tables[0][register & 0xFF] | tables[1][register >> 8 & 0xFF] | tables[2][register >> 16 & 0xFF] | \
+            tables[3][register >> 24]
+
+    def read_pin(self, pin_i):
+        return bool(self.read_mask() >> pin_i & 1)
+
+    def close(self):
+        self._registers.close()
+        for lvl_pin in self.lvl_pin_array:
+            lvl_pin.close()
+
+
+class GpiodLevelReader:
+    """Requests all level pins as one group through libgpiod (python3-libgpiod, API v1 or v2)"""
+
+    def __init__(self, pin_numbers, chip="gpiochip0", consumer="pumpcontrol"):
+        import gpiod  # only needed for this backend
+
+        self.pin_count = len(pin_numbers)
+        self._offsets = list(pin_numbers)
+        if hasattr(gpiod, "request_lines"):
+            # libgpiod v2
+            from gpiod.line import Direction, Bias
+            settings = gpiod.LineSettings(direction=Direction.INPUT, bias=Bias.PULL_DOWN)
+            self._request = gpiod.request_lines("/dev/" + chip, consumer=consumer,
+                                                config={tuple(self._offsets): settings})
+            self._active = gpiod.line.Value.ACTIVE
+            self._get_values = lambda: self._request.get_values(self._offsets)
+        else:
+            # libgpiod v1
+            self._request = gpiod.Chip(chip).get_lines(self._offsets)
+            self._request.request(consumer=consumer, type=gpiod.LINE_REQ_DIR_IN,
+                                  flags=getattr(gpiod, "LINE_REQ_FLAG_BIAS_PULL_DOWN", 0))
+            self._active = 1
+            self._get_values = self._request.get_values
+
+    def read_mask(self):
+        mask = 0
+        for pin_i, value in enumerate(self._get_values()):
+            if value == self._active:
+                mask |= 1 << pin_i
+        return mask
+
+    def read_pin(self, pin_i):
+        return bool(self.read_mask() >> pin_i & 1)  # a bulk read costs the same single ioctl
+
+    def close(self):
+        self._request.release()
+
+
+class MockLevelReader:
+    """Pure software reader; set the wet pins with set_level() or set_mask()"""
+
+    def __init__(self, pin_count, mask=0):
+        self.pin_count = pin_count
+        self.mask = mask
+        self.reads = 0
+
+    def set_mask(self, mask):
+        self.mask = mask & ((1 << self.pin_count) - 1)
+
+    def set_level(self, level):
+        """Wet all pins up to a level [0.0-1.0], like a real tank"""
+        self.mask = (1 << int(round(level * self.pin_count))) - 1
+
+    def read_mask(self):
+        self.reads += 1
+        return self.mask
+
+    def read_pin(self, pin_i):
+        self.reads += 1
+        return bool(self.mask >> pin_i & 1)
+
+    def close(self):
+        pass
+
+
+class AdaptiveLevelReader:
+    """Reads only the pins next to the previous level, like a bracketed binary search.
+
+    With the previous level at k wet pins, pins k-1 (expected wet) and k (expected dry) are read. If the level
+    has moved, the search gallops away from the previous level (1, 2, 4, ... pins) and then bisects the bracket,
+    so a change of d pins costs about 2 + 2*log2(d) pin reads instead of pin_count. The result is reported as the
+    consistent mask of the level found. A full scan is done every full_scan_interval samples, when the two pins
+    around the previous level contradict each other, and after any inconsistent full scan, so that sensor faults
+    are still seen by the decoding table.
+    With per-pin backends (gpiozero) this cuts pin reads and the seed voltage on-time per sample; bulk backends
+    read all pins in one call anyway."""
+
+    def __init__(self, level_reader, full_scan_interval=60):
+        self.level_reader = level_reader
+        self.pin_count = level_reader.pin_count
+        self.full_scan_interval = full_scan_interval
+        self._level = None  # number of wet pins found by the previous sample
+        self._samples_since_full_scan = 0
+
+        self.samples = 0
+        self.pins_read = 0
+        self.full_scans = 0
+        self.last_pins_read = 0
+
+    def read_mask(self):
+        self.samples += 1
+        pins_read_before = self.pins_read
+        if self._level is None or self._samples_since_full_scan >= self.full_scan_interval:
+            mask = self._full_scan()
+        else:
+            level = self._search()
+            mask = self._full_scan() if level is None else (1 << level) - 1
+            self._samples_since_full_scan += 1
+        self.last_pins_read = self.pins_read - pins_read_before
+        return mask
+
+    def read_pin(self, pin_i):
+        self.pins_read += 1
+        return self.level_reader.read_pin(pin_i)
+
+    def pins_read_per_sample(self):
+        return float(self.pins_read) / self.samples if self.samples else 0.0
+
+    def stats(self):
+        return {"samples": self.samples, "pins_read": self.pins_read, "full_scans": self.full_scans,
+                "pins_read_per_sample": self.pins_read_per_sample(), "last_pins_read": self.last_pins_read}
+
+    def close(self):
+        self.level_reader.close()
+
+    def _full_scan(self):
+        mask = self.level_reader.read_mask()
+        self.pins_read += self.pin_count
+        self.full_scans += 1
+        self._samples_since_full_scan = 0
+        decoding = decode_table(self.pin_count)[mask]
+        # Only trust the previous level as a prior if the pattern made sense
+        self._level = int(round(decoding.level * self.pin_count)) if decoding.consistent else None
+        return mask
+
+    # Find the new level (the first dry pin) starting from the previous one, or None on a contradiction
+    def _search(self):
+        level = self._level
+        below_wet = level == 0 or self.read_pin(level - 1)
+        at_dry = level == self.pin_count or not self.read_pin(level)
+        if below_wet and at_dry:
+            return level
+        if not below_wet and not at_dry:
+            return None  # pin above wet while pin below is dry: inconsistent
+
+        if not at_dry:
+            # Level rose: first dry pin lies in (level, pin_count]
+            low, step = level + 1, 1
+            high = self.pin_count
+            while low + step - 1 < self.pin_count:
+                if not self.read_pin(low + step - 1):
+                    high = low + step - 1
+                    break
+                low, step = low + step, step * 2
+        else:
+            # Level fell: first dry pin lies in [0, level - 1]
+            high, step = level - 1, 1
+            low = 0
+            while high - step >= 0:
+                if self.read_pin(high - step):
+                    low = high - step + 1
+                    break
+                high, step = high - step, step * 2
+        # Bisect: pins below low are wet, pin high is dry (or high == pin_count)
+        while low < high:
+            middle = (low + high) // 2
+            if self.read_pin(middle):
+                low = middle + 1
+            else:
+                high = middle
+        self._level = low
+        return low
+
+
+# Decoding ############################################################################################################
+
+# Fault classes of a pin pattern
+FAULT_NONE = 0
+FAULT_STUCK_PIN = 1      # a single wet pin above dry ones: stuck HIGH or shorted
+FAULT_BROKEN_WIRE = 2    # a single dry pin below wet ones: the pin's wire is broken
+FAULT_FOULED_PROBE = 3   # several wet islands or gaps: residue bridging probes
+FAULT_NAMES = {
+    FAULT_NONE: "none",
+    FAULT_STUCK_PIN: "stuck pin",
+    FAULT_BROKEN_WIRE: "broken wire",
+    FAULT_FOULED_PROBE: "fouled probe",
+}
+
+# Level [0.0-1.0], whether the pattern is physically possible (wet pins contiguous from the bottom), fault class
+LevelDecoding = namedtuple("LevelDecoding", ["level", "consistent", "fault"])
+
+
+def classify_mask(mask, pin_count):
+    """Decode one pin pattern. For inconsistent patterns, the level is the most plausible one: the top of the
+    wet pins for a broken wire, otherwise the top of the contiguous wet pins from the bottom (the lower, safe
+    choice for the pump)."""
+    top = mask.bit_length()        # number of pins up to and including the highest wet pin
+    bottom_run = (~mask & (mask + 1)).bit_length() - 1  # number of contiguous wet pins from the bottom
+    if bottom_run == top:
+        return LevelDecoding(float(top) / pin_count, True, FAULT_NONE)
+
+    dry_below_top = top - bin(mask).count("1")
+    wet_above_gap = bin(mask >> bottom_run).count("1")
+    if wet_above_gap == 1:
+        return LevelDecoding(float(bottom_run) / pin_count, False, FAULT_STUCK_PIN)
+    if dry_below_top == 1:
+        return LevelDecoding(float(top) / pin_count, False, FAULT_BROKEN_WIRE)
+    return LevelDecoding(float(bottom_run) / pin_count, False, FAULT_FOULED_PROBE)
+
+
+def build_decode_table(pin_count):
+    """Decodings for all 2**pin_count pin patterns, indexed by mask (1024 entries for 10 pins)"""
+    return [classify_mask(mask, pin_count) for mask in range(1 << pin_count)]
+
+
+_decode_tables = {}
+
+
+def decode_table(pin_count):
+    """Shared, lazily built decode table for a pin count"""
+    table = _decode_tables.get(pin_count)
+    if table is None:
+        table = _decode_tables[pin_count] = build_decode_table(pin_count)
+    return table
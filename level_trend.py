@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# Use Python 3
+
+import os
+import json
+import time
+import logging
+from collections import deque, namedtuple
+
+logger = logging.getLogger(__name__)
+
+"""Level trend: fill/drain rate and predicted threshold crossings from the recent level history.
+
+LevelTrendEstimator fits a straight line (least squares) through the level readings of the last window seconds.
+The sums of the fit are updated as samples come in and drop out of the window, so adding a sample and asking
+for the trend is O(1) no matter how long the daemon runs. The level only changes in steps of one level pin
+(10% with 10 pins), so the fit needs some history before it means anything: the rate is reported only once
+the window holds min_span seconds of readings.
+
+Pumping drains the tank, standing still lets it fill up, so the history is restarted whenever the pump state
+changes; the trend then always describes the current regime.
+
+The daemon writes the latest trend to a small JSON file (write_trend_file), which the web UI reads with
+get_trend_textual() to show e.g. "Tank empty in ~2h10m" without scanning the logs.
+"""
+
+
+# Rate in percent per hour (None if unknown), and the predicted unix time at which the level crosses the threshold
+# and threshold + threshold_delta (None if the level is not moving towards it)
+LevelTrend = namedtuple("LevelTrend", ["rate_per_hour", "threshold_time", "upper_threshold_time"])
+
+
+class LevelTrendEstimator:
+    """Sliding-window least-squares fit of the level (in percent) over time"""
+
+    def __init__(self, window=3600.0, min_span=300.0, capacity=1024):
+        self.window = window
+        self.min_span = min_span
+        self._samples = deque(maxlen=capacity)
+        self._pump_running = None
+        self.reset()
+
+    def reset(self):
+        self._samples.clear()
+        self._origin = None  # times are taken relative to the first sample, for numerical stability
+        self._sum_t = self._sum_y = self._sum_tt = self._sum_ty = 0.0
+
+    def add(self, timestamp, level, pump_running=None):
+        """Add a level reading [0.0-1.0] taken at timestamp (unix time). Unknown levels (None) are skipped."""
+        if level is None:
+            return
+        if pump_running is not None and pump_running != self._pump_running:
+            self._pump_running = pump_running
+            self.reset()
+        if self._origin is None:
+            self._origin = timestamp
+        if len(self._samples) == self._samples.maxlen:
+            self._remove(*self._samples[0])
+        t = timestamp - self._origin
+        y = level * 100
+        self._samples.append((t, y))
+        self._sum_t += t
+        self._sum_y += y
+        self._sum_tt += t * t
+        self._sum_ty += t * y
+        while self._samples and self._samples[0][0] < t - self.window:
+            self._remove(*self._samples.popleft())
+
+    def _remove(self, t, y):
+        self._sum_t -= t
+        self._sum_y -= y
+        self._sum_tt -= t * t
+        self._sum_ty -= t * y
+
+    def _fit(self):
+        """Slope (percent per second) and intercept of the line, or None while the history is too short"""
+        count = len(self._samples)
+        if count < 2 or self._samples[-1][0] - self._samples[0][0] < self.min_span:
+            return None
+        denominator = count * self._sum_tt - self._sum_t * self._sum_t
+        if denominator <= 0:
+            return None
+        slope = (count * self._sum_ty - self._sum_t * self._sum_y) / denominator
+        intercept = (self._sum_y - slope * self._sum_t) / count
+        return slope, intercept
+
+    def rate_per_hour(self):
+        """Fill (positive) or drain (negative) rate in percent per hour, or None if unknown"""
+        fit = self._fit()
+        return fit[0] * 3600 if fit is not None else None
+
+    def time_until(self, level_percent, now=None):
+        """Seconds from now until the fitted level reaches level_percent, or None if it is not moving towards it
+        (steady, moving away, or already past it)"""
+        fit = self._fit()
+        if fit is None or fit[0] == 0:
+            return None
+        if now is None:
+            now = time.time()
+        slope, intercept = fit
+        current = intercept + slope * (now - self._origin)
+        seconds = (level_percent - current) / slope
+        return seconds if seconds >= 0 else None
+
+    def predict(self, threshold, threshold_delta, now=None):
+        """LevelTrend for the pump thresholds (in percent)"""
+        if now is None:
+            now = time.time()
+        to_threshold = self.time_until(threshold, now)
+        to_upper_threshold = self.time_until(threshold + threshold_delta, now)
+        return LevelTrend(self.rate_per_hour(),
+                          now + to_threshold if to_threshold is not None else None,
+                          now + to_upper_threshold if to_upper_threshold is not None else None)
+
+
+# Short duration text, e.g. "2h10m" or "45m"
+def format_duration(seconds):
+    minutes = int(round(seconds / 60.0))
+    if minutes < 60:
+        return "{}m".format(minutes)
+    return "{}h{:02d}m".format(minutes // 60, minutes % 60)
+
+
+def trend_textual(trend, now=None):
+    """Human readable trend, e.g. "Tank empty in ~2h10m (-8.5%/h)" """
+    if trend is None or trend.rate_per_hour is None:
+        return "Level trend unknown"
+    if now is None:
+        now = time.time()
+    rate_textual = "{:+.1f}%/h".format(trend.rate_per_hour)
+    if trend.rate_per_hour < 0 and trend.threshold_time is not None:
+        return "Tank empty in ~{} ({})".format(format_duration(max(trend.threshold_time - now, 0)), rate_textual)
+    if trend.rate_per_hour > 0 and trend.upper_threshold_time is not None:
+        return "Tank refilled in ~{} ({})".format(format_duration(max(trend.upper_threshold_time - now, 0)),
+                                                  rate_textual)
+    return "Level steady ({})".format(rate_textual)
+
+
+def write_trend_file(filepath, trend, level, threshold, threshold_delta):
+    """Atomically replace the trend file with the latest trend"""
+    state = {"time": time.time(), "level": level, "threshold": threshold, "threshold_delta": threshold_delta}
+    state.update(trend._asdict())
+    temp_filepath = filepath + ".tmp"
+    with open(temp_filepath, "w") as trend_file:
+        json.dump(state, trend_file)
+    os.replace(temp_filepath, filepath)
+
+
+def read_trend_file(filepath, max_age=None):
+    """LevelTrend from the trend file, or None if there is none or it is older than max_age seconds"""
+    try:
+        with open(filepath) as trend_file:
+            state = json.load(trend_file)
+        if max_age is not None and time.time() - state["time"] > max_age:
+            return None  # pumpcontrol is not running
+        return LevelTrend(state["rate_per_hour"], state["threshold_time"], state["upper_threshold_time"])
+    except (IOError, ValueError, KeyError) as err:
+        # A missing or half-written file is expected while pumpcontrol is not running or starting up
+        logger.debug("Could not read level trend from %s. %s", filepath, err)
+        return None
+
+
+def get_trend_textual(filepath, max_age=600):
+    """Textual trend from the trend file, for the web UI"""
+    return trend_textual(read_trend_file(filepath, max_age))
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# Use Python 3
+
+import os
+import json
+import gzip
+import time
+import queue
+import shutil
+import logging
+import threading
+from datetime import datetime
+
+"""Size- and day-based rotation of the log and CSV files, with background compression and a manifest.
+
+Each kind of file (e.g. "log" and "csv") is written as a sequence of segments. A segment is closed when it
+exceeds max_bytes or when the calendar day changes, then compressed with gzip in a background thread.
+Only the newest retention_count segments per kind are kept.
+
+The manifest (a JSON file next to the segments) lists every segment with its kind, file name, and the unix
+timestamps of its first and last record, so tools can pick the files for a time range without opening them:
+    {"segments": [{"kind": "csv", "file": "2020-05-23_10-00-00.csv.gz", "start": 1590220800, "end": 1590307199,
+                   "compressed": true, "bytes": 81234}, ...]}
+"end" is null for segments that are still being written.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentManifest:
+    """JSON index of all segments and their time ranges, safe to use from several threads"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._segments = []
+        try:
+            with open(filepath) as manifest_file:
+                self._segments = json.load(manifest_file)["segments"]
+        except (IOError, ValueError, KeyError):
+            self._segments = []
+
+    def add(self, kind, filename, start):
+        with self._lock:
+            self._segments.append({"kind": kind, "file": filename, "start": int(start), "end": None,
+                                   "compressed": False, "bytes": 0})
+            self._save()
+
+    def update(self, filename, **fields):
+        with self._lock:
+            for segment in self._segments:
+                if segment["file"] == filename:
+                    segment.update(fields)
+            self._save()
+
+    def remove(self, filename):
+        with self._lock:
+            self._segments = [segment for segment in self._segments if segment["file"] != filename]
+            self._save()
+
+    def segments(self, kind=None):
+        """Segments (oldest first), optionally only those of one kind"""
+        with self._lock:
+            return [dict(segment) for segment in self._segments if kind is None or segment["kind"] == kind]
+
+    def find(self, kind, start, end):
+        """Segments of a kind that may contain records between the unix timestamps start and end"""
+        now = time.time()
+        return [segment for segment in self.segments(kind)
+                if segment["start"] <= end and (segment["end"] if segment["end"] is not None else now) >= start]
+
+    def _save(self):
+        tmp_filepath = self.filepath + ".tmp"
+        with open(tmp_filepath, "w") as manifest_file:
+            json.dump({"segments": self._segments}, manifest_file, indent=1)
+        os.replace(tmp_filepath, self.filepath)
+
+
+class SegmentCompressor:
+    """Background thread that gzips closed segments and updates the manifest"""
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="segment-compressor", daemon=True)
+        self._thread.start()
+
+    def submit(self, filename):
+        self._queue.put(filename)
+
+    def stop(self, timeout=None):
+        """Finish the pending compressions and stop"""
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            filename = self._queue.get()
+            if filename is None:
+                return
+            try:
+                self._compress(filename)
+            except (IOError, OSError) as e:
+                logger.error("Could not compress %s. Error: %s", filename, e)
+
+    def _compress(self, filename):
+        filepath = os.path.join(self.directory, filename)
+        if not os.path.exists(filepath):
+            return
+        with open(filepath, "rb") as segment_file, gzip.open(filepath + ".gz", "wb") as compressed_file:
+            shutil.copyfileobj(segment_file, compressed_file)
+        os.remove(filepath)
+        self.manifest.update(filename, file=filename + ".gz", compressed=True,
+                             bytes=os.path.getsize(filepath + ".gz"))
+        logger.debug("Compressed %s", filename)
+
+
+class SegmentRotator:
+    """Decides when to start a new segment of one kind, and takes care of closed segments"""
+
+    def __init__(self, directory, prefix, extension, kind, manifest, compressor=None, max_bytes=4 * 1024 * 1024,
+                 rotate_daily=True, retention_count=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.extension = extension
+        self.kind = kind
+        self.manifest = manifest
+        self.compressor = compressor
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.retention_count = retention_count
+
+        self.current_filename = None
+        self.current_filepath = None
+        self._start = None
+        self._last_write = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open_segment(self, now=None):
+        """Register a new segment and return its path"""
+        if now is None:
+            now = time.time()
+        filename = "{}{}.{}".format(self.prefix, datetime.fromtimestamp(now).strftime("%Y-%m-%d_%H-%M-%S"),
+                                    self.extension)
+        suffix = 1
+        while os.path.exists(os.path.join(self.directory, filename)) or \
+                os.path.exists(os.path.join(self.directory, filename + ".gz")):
+            suffix += 1
+            filename = "{}{}_{}.{}".format(self.prefix, datetime.fromtimestamp(now).strftime("%Y-%m-%d_%H-%M-%S"),
+                                           suffix, self.extension)
+        self.current_filename = filename
+        self.current_filepath = os.path.join(self.directory, filename)
+        self._start = now
+        self._last_write = now
+        self.manifest.add(self.kind, filename, now)
+        return self.current_filepath
+
+    def should_rotate(self, size, now=None):
+        """True if the current segment is full or belongs to a previous day"""
+        if now is None:
+            now = time.time()
+        if self.max_bytes is not None and size >= self.max_bytes:
+            return True
+        if self.rotate_daily and datetime.fromtimestamp(now).date() != datetime.fromtimestamp(self._start).date():
+            return True
+        return False
+
+    def record_written(self, now=None):
+        self._last_write = now if now is not None else time.time()
+
+    def close_segment(self, compress=True):
+        """Mark the current segment as complete, hand it to the compressor and apply the retention limit"""
+        if self.current_filename is None:
+            return
+        filename = self.current_filename
+        self.manifest.update(filename, end=int(self._last_write), bytes=_file_size(self.current_filepath))
+        self.current_filename = None
+        self.current_filepath = None
+        if compress and self.compressor is not None:
+            self.compressor.submit(filename)
+        self._apply_retention()
+
+    def _apply_retention(self):
+        if self.retention_count is None:
+            return
+        closed_segments = [segment for segment in self.manifest.segments(self.kind) if segment["end"] is not None]
+        for segment in closed_segments[:max(0, len(closed_segments) - self.retention_count)]:
+            for filename in (segment["file"], segment["file"] + ".gz"):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+            self.manifest.remove(segment["file"])
+            logger.info("Deleted old %s segment %s", self.kind, segment["file"])
+
+
+def _file_size(filepath):
+    try:
+        return os.path.getsize(filepath)
+    except OSError:
+        return 0
+
+
+# Close segments left open by a previous run (e.g. after a crash or power cut) and compress them
+def recover_segments(directory, manifest, compressor):
+    for segment in manifest.segments():
+        if segment["end"] is None:
+            filepath = os.path.join(directory, segment["file"])
+            if not os.path.exists(filepath):
+                manifest.remove(segment["file"])
+                continue
+            manifest.update(segment["file"], end=int(os.path.getmtime(filepath)), bytes=_file_size(filepath))
+            compressor.submit(segment["file"])
+        elif not segment["compressed"]:
+            compressor.submit(segment["file"])
+
+
+class RotatingCsvWriter:
+    """Keeps the CSV file open and writes one line per record, starting new segments as needed"""
+
+    def __init__(self, rotator, header=None, flush_count=1):
+        self.rotator = rotator
+        self.header = header
+        self.flush_count = flush_count
+        self._file = None
+        self._pending = 0
+
+    def write_line(self, line, now=None):
+        if now is None:
+            now = time.time()
+        try:
+            if self._file is not None and self.rotator.should_rotate(self._file.tell(), now):
+                self._close_segment()
+            if self._file is None:
+                self._file = open(self.rotator.open_segment(now), "a")
+                if self.header is not None:
+                    self._file.write("{}\n".format(self.header))
+            self._file.write("{}\n".format(line))
+            self.rotator.record_written(now)
+            self._pending += 1
+            if self._pending >= self.flush_count:
+                self._file.flush()
+                self._pending = 0
+        except IOError as e:
+            logger.error("Could not write to CSV file. IOError occurred: %s", e)
+
+    def close(self):
+        if self._file is not None:
+            self._close_segment()
+
+    def _close_segment(self):
+        self._file.close()
+        self._file = None
+        self._pending = 0
+        self.rotator.close_segment()
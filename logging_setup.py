@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# Use Python 3
+
+import sys
+import time
+import atexit
+import queue
+import logging
+import logging.handlers
+
+"""Asynchronous, buffered logging for pumpcontrol.
+
+Log records are put on an in-memory queue by a QueueHandler on the root logger and written by a single
+QueueListener thread. The log file stays open and is flushed in batches (every flush_count records,
+every flush_interval seconds, or right away for warnings and errors) instead of being opened, appended to
+and closed for every message. Use %-style arguments (logger.debug("Level Pin status: %s", values)), so that
+messages below the active level are never formatted.
+"""
+
+
+LOG_FORMAT = "%(asctime)s.%(msecs)03d: [%(levelname)s] %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+CONSOLE_FORMAT = "[%(levelname)s] %(message)s"
+
+_listener = None
+_queue_handler = None
+
+
+class BatchingFileHandler(logging.FileHandler):
+    """FileHandler that keeps the file open and only flushes every few records, seconds, or on warnings"""
+
+    def __init__(self, filename, flush_count=50, flush_interval=5.0, flush_level=logging.WARNING):
+        super().__init__(filename, mode="a", encoding="utf-8")
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            self._pending += 1
+            if self._pending >= self.flush_count or record.levelno >= self.flush_level \
+                    or time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        super().flush()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+
+class SegmentedFileHandler(BatchingFileHandler):
+    """BatchingFileHandler that starts a new file whenever its log_rotation.SegmentRotator asks for it"""
+
+    def __init__(self, rotator, flush_count=50, flush_interval=5.0, flush_level=logging.WARNING):
+        self.rotator = rotator
+        super().__init__(rotator.open_segment(), flush_count, flush_interval, flush_level)
+
+    def emit(self, record):
+        if self.stream is not None and self.rotator.should_rotate(self.stream.tell(), record.created):
+            self.flush()
+            self.stream.close()
+            self.stream = None
+            self.rotator.close_segment()
+            self.baseFilename = self.rotator.open_segment(record.created)
+        super().emit(record)
+        self.rotator.record_written(record.created)
+
+    def close(self):
+        super().close()
+        self.rotator.close_segment()
+
+
+def setup_logging(log_file_path_abs, level=logging.DEBUG, console=True, flush_count=50, flush_interval=5.0,
+                  rotator=None):
+    """Route all loggers through a queue to a single writer thread for the log file (and stdout).
+    If a log_rotation.SegmentRotator is given, the log is written to its segments instead of log_file_path_abs."""
+    global _listener, _queue_handler
+    if _listener is not None:
+        shutdown_logging()
+
+    handlers = []
+    if rotator is not None:
+        file_handler = SegmentedFileHandler(rotator, flush_count, flush_interval)
+    else:
+        file_handler = BatchingFileHandler(log_file_path_abs, flush_count, flush_interval)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+    handlers.append(file_handler)
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers.append(console_handler)
+
+    log_queue = queue.SimpleQueue()
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    _listener = logging.handlers.QueueListener(log_queue, *handlers)
+
+    # Replace handlers installed by logging.basicConfig(), everything goes through the queue now
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    set_log_level(level)
+
+    _listener.start()
+    atexit.register(shutdown_logging)  # also write out queued records on Ctrl+C
+    return _listener
+
+
+def set_log_level(level):
+    """Change the log level at runtime; accepts logging constants or names like "DEBUG" """
+    if isinstance(level, str):
+        level = logging.getLevelName(level.strip().upper())
+        if not isinstance(level, int):
+            logging.getLogger(__name__).warning("Unknown log level, keeping %s",
+                                                logging.getLevelName(logging.getLogger().level))
+            return False
+    logging.getLogger().setLevel(level)
+    return True
+
+
+def shutdown_logging():
+    """Write out all queued records, close the log file and fall back to logging to stderr"""
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    root = logging.getLogger()
+    root.removeHandler(_queue_handler)
+    root.addHandler(logging.StreamHandler())
+    _listener = None
+    _queue_handler = None
@@ -1,133 +1,543 @@
 #!/usr/bin/python
 # Use Python 3
 
+import os
+import sys
 import csv
-from datetime import datetime, timedelta
+import json
+import argparse
+import logging
+import operator
+from bisect import bisect_left, bisect_right
+from functools import partial
+from itertools import islice, count
+from collections import namedtuple
+from datetime import datetime, timedelta, time
 
+from virtual_clock import system_clock
 
-def extract_time_windows_for_day(schedule_row):
-    window_cnt = int((len(schedule_row) - 1) / 2)
-    print("Found {} time windows for {}".format(window_cnt, schedule_row[0]))
-    result = []
-    for window_i in range(1, window_cnt + 1):
-        window = [schedule_row[2 * (window_i - 1) + 1], schedule_row[2 * (window_i - 1) + 2]]
-        result.append(window)
+logger = logging.getLogger(__name__)
 
-    return result
+# Source of the current time; the simulator replaces it with a virtual_clock.VirtualClock
+clock = system_clock
 
+"""A weekly schedule of time windows in which the pump is desired.
 
-def read_schedule(schedule_filepath):
-    """Read schedule from CSV file without (!) a header"""
-    try:
-        schedule_arr = []
-        with open(schedule_filepath) as schedule_file:
-            schedreader = csv.reader(schedule_file, delimiter=',')
-            # next(schedreader)  # Skip header
-            # print("Rows read:")
-            for row in schedreader:
-                # print(row)
-                schedule_arr.append(row)
-            print("Successfully read schedule from CSV.")
-    except IOError as err:
-        print("IOError: could not read schedule.csv. {}".format(err))
-
-    # Check schedule for integrity
-    for row in schedule_arr:
+schedule.csv has one row per weekday, Monday first: the day's name followed by start and end times (HH:MM) of
+its windows, e.g. "Mon,08:00,12:00,16:00,18:00". A day's last window may end after midnight ("Fri,22:00,02:00"
+runs into Saturday, Sunday's into Monday). read_schedule() compiles the file into a CompiledSchedule:
+the windows as sorted minute-of-week intervals, validated once, so that lookups are a binary search without any
+string parsing. Compiled schedules are cached per file and only recompiled when its mtime or size changes; the
+daemon and the web views both go through read_schedule() and so share this cache. The text renderings for the web
+views are made once per compiled schedule and date by schedule_texts().
 
-        # Check incomplete windows (odd number of times)
-        if len(row) % 2 == 0:
-            raise Exception("Inconsistent schedule: A time window must have both start and end time. "
-                            "One is missing in {}'s schedule.".format(row[0]))
+"python3 pump_scheduler.py compile [cfg/schedule.csv]" validates the file, lists every error with its row and
+column, and only if there are none writes the compiled intervals to cfg/schedule.compiled.json. read_schedule()
+loads that artifact instead of parsing the CSV as long as it was compiled from the file as it is now. The daemon
+and the web views read through read_valid_schedule(), which keeps the last valid schedule when the file is
+invalid, so a bad upload is logged instead of stopping the control loop.
+"""
 
-        time_windows = extract_time_windows_for_day(row)
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+DAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]  # first column of schedule.csv
 
-        # More detailed checks
-        for window_i in range(0, len(time_windows)):
-            window_start_time = datetime.strptime(time_windows[window_i][0], "%H:%M").time()
-            window_end_time = datetime.strptime(time_windows[window_i][1], "%H:%M").time()
+# A switching point of the schedule: when (datetime), and whether the pump is desired from then on
+Transition = namedtuple("Transition", ["time", "pump_desired"])
 
-            print("Time window ({}/{}) for today, {}: {} until {}"
-                  .format(window_i+1, len(time_windows), row[0],
-                          time_windows[window_i][0], time_windows[window_i][1]))
+# Text renderings of a schedule: the whole week (text and HTML), the windows per weekday (Monday first), and those
+# of today and tomorrow
+ScheduleTexts = namedtuple("ScheduleTexts", ["week", "week_html", "days", "today", "tomorrow"])
 
-            # Check for reversed window boundaries
-            if window_start_time > window_end_time:
-                raise Exception("Inconsistent schedule: End time of a window cannot be before its start time. "
-                                "Found in window number {} for {}'s schedule.".format(window_i+1, row[0]))
+# A problem in schedule.csv, at a row and column (both starting at 1)
+ScheduleDiagnostic = namedtuple("ScheduleDiagnostic", ["row", "column", "message"])
 
-            # Check for overlapping time windows
-            if window_i > 0:
-                prev_window_end_time = datetime.strptime(time_windows[window_i-1][1], "%H:%M").time()
-                if prev_window_end_time > window_start_time:
-                    raise Exception("Inconsistent schedule: Consecutive windows cannot overlap. "
-                                    "Found in window number {} for {}'s schedule.".format(window_i + 1, row[0]))
+COMPILED_FORMAT = 1  # version of the compiled artifact's layout
 
-    return schedule_arr
+_schedule_versions = count(1)
 
 
-def get_schedule_textual_vertically(schedule_filepath):
-    schedule_arr = read_schedule(schedule_filepath)
+class ScheduleError(Exception):
+    """Invalid schedule; errors holds a ScheduleDiagnostic for every problem found"""
 
-    result = ""
+    def __init__(self, errors, filepath=None):
+        self.errors = errors
+        self.filepath = filepath
+        super().__init__("\n".join(format_diagnostic(error, filepath) for error in errors))
 
-    for row in schedule_arr:
-        time_windows = extract_time_windows_for_day(row)
 
-        result += row[0] + "\n"
+# "file:row:column: message"
+def format_diagnostic(diagnostic, filepath=None):
+    return "{}:{}:{}: {}".format(filepath or "schedule", diagnostic.row, diagnostic.column, diagnostic.message)
 
-        # More detailed checks
-        for window_i in range(0, len(time_windows)):
-            window_start_time = datetime.strptime(time_windows[window_i][0], "%H:%M").time()
-            window_end_time = datetime.strptime(time_windows[window_i][1], "%H:%M").time()
 
-            result += time_windows[window_i][0] + " until " + time_windows[window_i][1] + "\n"
+def extract_time_windows_for_day(schedule_row):
+    if not schedule_row:
+        return []
+    window_cnt = int((len(schedule_row) - 1) / 2)
+    logger.debug("Found %s time windows for %s", window_cnt, schedule_row[0])
+    result = []
+    for window_i in range(1, window_cnt + 1):
+        window = [schedule_row[2 * (window_i - 1) + 1], schedule_row[2 * (window_i - 1) + 2]]
+        result.append(window)
 
     return result
 
 
-def get_schedule_textual_vertically_html(schedule_filepath):
-    result = get_schedule_textual_vertically(schedule_filepath)
-    result = result.replace("\n", "<br />")
-    return result
+# Minutes since midnight from "HH:MM" (same format as datetime.strptime(text, "%H:%M")), or ValueError.
+# "24:00" is accepted as well, for windows that last until midnight.
+def parse_time_of_day(text):
+    hours, separator, minutes = text.strip().partition(":")
+    if not separator or not hours.isdigit() or not minutes.isdigit() or len(hours) > 2 or len(minutes) > 2:
+        raise ValueError("time data {!r} does not match format '%H:%M'".format(text))
+    hours, minutes = int(hours), int(minutes)
+    if minutes > 59 or hours > 24 or (hours == 24 and minutes > 0):
+        raise ValueError("time data {!r} does not match format '%H:%M'".format(text))
+    return hours * 60 + minutes
+
+
+# "HH:MM" from minutes since midnight
+def format_time_of_day(minutes):
+    return "{:02d}:{:02d}".format(minutes // 60, minutes % 60)
+
+
+# Minute of the week of a datetime, Monday 00:00 = 0
+def minute_of_week(now):
+    return now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+
+
+# Monday 00:00 of the week of a datetime
+def start_of_week(now):
+    return datetime.combine(now.date() - timedelta(days=now.weekday()), time())
+
+
+class CompiledSchedule:
+    """Weekly schedule as sorted, non-overlapping minute-of-week intervals [start, end).
+
+    Behaves like the list of CSV rows it was compiled from (len, indexing, iteration), so code that works on
+    the rows keeps working."""
+
+    def __init__(self, rows, starts, ends):
+        self.version = next(_schedule_versions)  # unique per compilation, keys the text renderings
+        self.rows = rows
+        self.starts = starts  # interval starts, ascending; touching windows are merged
+        self.ends = ends
+
+        # Minutes of the week at which the desired state changes, ascending. A window ending at the end of the
+        # week and one starting on Monday 00:00 are one window across the wrap-around.
+        self.edges = []
+        for minute in sorted(set(starts + ends)):
+            minute %= MINUTES_PER_WEEK
+            if self.is_desired_at_minute(minute) != self.is_desired_at_minute((minute - 1) % MINUTES_PER_WEEK):
+                self.edges.append(minute)
+        self.edges.sort()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def is_desired_at_minute(self, minute):
+        interval_i = bisect_right(self.starts, minute) - 1
+        return interval_i >= 0 and minute < self.ends[interval_i]
+
+    def is_desired(self, now=None):
+        """True if now (datetime, Default = the current time) lies within a time window"""
+        if now is None:
+            now = clock.now()
+        return self.is_desired_at_minute(minute_of_week(now))
+
+    def next_transition(self, now=None):
+        """The first Transition after now (datetime, Default = the current time), or None if the pump is desired
+        always or never"""
+        if not self.edges:
+            return None
+        if now is None:
+            now = clock.now()
+        edge_i = bisect_right(self.edges, minute_of_week(now))
+        week_start = start_of_week(now)
+        if edge_i == len(self.edges):
+            edge_i = 0
+            week_start += timedelta(days=7)
+        edge = self.edges[edge_i]
+        return Transition(week_start + timedelta(minutes=edge), self.is_desired_at_minute(edge))
+
+    def transitions_between(self, start, end):
+        """All Transitions with start <= time < end (datetimes), in order"""
+        transitions = []
+        if not self.edges:
+            return transitions
+        week_start = start_of_week(start)
+        edge_i = bisect_left(self.edges, minute_of_week(start))
+        while True:
+            if edge_i == len(self.edges):
+                edge_i = 0
+                week_start += timedelta(days=7)
+            edge = self.edges[edge_i]
+            transition_time = week_start + timedelta(minutes=edge)
+            if transition_time >= end:
+                return transitions
+            if transition_time >= start:
+                transitions.append(Transition(transition_time, self.is_desired_at_minute(edge)))
+            edge_i += 1
+
+    def desired_mask(self, timestamps):
+        """is_desired() for each of a sequence of unix timestamps, see desired_mask()"""
+        return desired_mask(self, timestamps)
+
+
+def desired_mask(schedule, timestamps):
+    """For each unix timestamp in a sequence (list, array.array, numpy array, ...), 1 if the pump is desired at that
+    time by the schedule (CompiledSchedule or schedule_calendar.CalendarSchedule) and 0 if not, as a bytearray.
+
+    The desired state only changes at the schedule's transitions, so instead of a lookup per timestamp, the
+    transitions between the first and last timestamp are computed once, and the timestamps between two of them
+    are found by binary search and filled as one slice: a year of 30 s ticks takes a few hundred transitions.
+    Timestamps that are not in ascending order fall back to one binary search in the transitions per timestamp."""
+    mask = bytearray(len(timestamps))
+    if len(timestamps) == 0:
+        return mask
+    ascending = all(map(operator.le, timestamps, islice(timestamps, 1, None)))
+    first, last = (timestamps[0], timestamps[-1]) if ascending else (min(timestamps), max(timestamps))
+
+    first_dt = datetime.fromtimestamp(first)
+    desired = schedule.is_desired(first_dt)
+    edges = [transition.time.timestamp() for transition in schedule.transitions_between(
+        first_dt + timedelta(microseconds=1), datetime.fromtimestamp(last) + timedelta(microseconds=1))]
+
+    if not ascending:
+        # The state flips at every transition, so it follows from the number of transitions up to a timestamp
+        state_after = [desired ^ (edge_count & 1) for edge_count in range(len(edges) + 1)]
+        return bytearray(map(state_after.__getitem__, map(partial(bisect_right, edges), timestamps)))
+
+    index = 0
+    for edge in edges + [float("inf")]:
+        edge_index = bisect_left(timestamps, edge, index)
+        if desired:
+            mask[index:edge_index] = b"\x01" * (edge_index - index)
+        index = edge_index
+        desired = not desired
+    return mask
+
+
+def validate_schedule(schedule_arr):
+    """Check the schedule rows for integrity; returns a ScheduleDiagnostic for every problem, none if valid"""
+    return _check_schedule(schedule_arr)[1]
+
+
+# Windows of each row as (start, end) minutes of the day, and the ScheduleDiagnostics of all problems found
+def _check_schedule(schedule_arr):
+    day_windows = []
+    errors = []
+    for day_i, row in enumerate(schedule_arr):
+        windows = []
+        day_windows.append(windows)
+        day_name = row[0] if row else ""
+
+        if day_i >= 7:
+            errors.append(ScheduleDiagnostic(day_i + 1, 1, "Inconsistent schedule: Found more than seven days. "
+                                                           "{}'s schedule is one too many.".format(day_name)))
+            continue
+        if not row:
+            errors.append(ScheduleDiagnostic(day_i + 1, 1, "Inconsistent schedule: Empty row, expected the "
+                                                           "schedule of {}.".format(DAY_NAMES[day_i])))
+            continue
+        # Check incomplete windows (odd number of times)
+        if len(row) % 2 == 0:
+            errors.append(ScheduleDiagnostic(day_i + 1, max(len(row), 1),
+                                             "Inconsistent schedule: A time window must have both start and end "
+                                             "time. One is missing in {}'s schedule.".format(day_name)))
+
+        prev_window_end = None
+        for window_i, window in enumerate(extract_time_windows_for_day(row)):
+            start_column = 2 * window_i + 2
+            try:
+                window_start = parse_time_of_day(window[0])
+            except ValueError as err:
+                errors.append(ScheduleDiagnostic(day_i + 1, start_column, "Inconsistent schedule: {}".format(err)))
+                window_start = None
+            try:
+                window_end = parse_time_of_day(window[1])
+            except ValueError as err:
+                errors.append(ScheduleDiagnostic(day_i + 1, start_column + 1, "Inconsistent schedule: {}"
+                                                 .format(err)))
+                window_end = None
+            if window_start is None or window_end is None:
+                prev_window_end = None
+                continue
+
+            # Check for overlapping time windows; a window across midnight must be the day's last one
+            if prev_window_end is not None and prev_window_end > window_start:
+                errors.append(ScheduleDiagnostic(day_i + 1, start_column,
+                                                 "Inconsistent schedule: Consecutive windows cannot overlap. "
+                                                 "Found in window number {} for {}'s schedule."
+                                                 .format(window_i + 1, day_name)))
+            if window_start > window_end:
+                prev_window_end = MINUTES_PER_DAY + 1  # nothing may follow
+            else:
+                prev_window_end = window_end
+            windows.append((window_start, window_end))
+    return day_windows, errors
+
+
+def compile_schedule(schedule_arr, filepath=None):
+    """Check the schedule rows for integrity and compile them into a CompiledSchedule; raises a ScheduleError
+    listing every problem (with filepath, if given, in the messages) if there are any"""
+    day_windows, errors = _check_schedule(schedule_arr)
+    if errors:
+        raise ScheduleError(errors, filepath)
+
+    intervals = []
+    for day_i, windows in enumerate(day_windows):
+        day_start = day_i * MINUTES_PER_DAY
+        for window_start, window_end in windows:
+            if window_start > window_end:
+                # Overnight window, e.g. 22:00 until 02:00: ends on the next day, Sunday's on Monday
+                end = day_start + MINUTES_PER_DAY + window_end
+                if end > MINUTES_PER_WEEK:
+                    intervals.append((0, end - MINUTES_PER_WEEK))
+                    end = MINUTES_PER_WEEK
+                intervals.append((day_start + window_start, end))
+            elif window_start < window_end:
+                intervals.append((day_start + window_start, day_start + window_end))
+
+    starts = []
+    ends = []
+    for start, end in sorted(intervals):
+        if ends and ends[-1] >= start:
+            ends[-1] = max(ends[-1], end)  # touching windows, e.g. until 12:00 and from 12:00, or overnight ones
+        else:
+            starts.append(start)
+            ends.append(end)
+    return CompiledSchedule(schedule_arr, starts, ends)
+
+
+# Precompiled artifact ###############################################################################################
+
+def compiled_filepath(schedule_filepath):
+    """Path of the compiled artifact of a schedule file: cfg/schedule.csv -> cfg/schedule.compiled.json"""
+    return os.path.splitext(schedule_filepath)[0] + ".compiled.json"
+
+
+def read_schedule_rows(schedule_filepath):
+    """Rows of a schedule CSV file without (!) a header, unchecked"""
+    with open(schedule_filepath) as schedule_file:
+        schedreader = csv.reader(schedule_file, delimiter=',')
+        # next(schedreader)  # Skip header
+        return [row for row in schedreader]
+
+
+def compile_schedule_file(schedule_filepath, artifact_filepath=None):
+    """Validate a schedule CSV file once and write its compiled artifact (Default = compiled_filepath()).
+    Returns the CompiledSchedule. If the file is invalid, raises a ScheduleError listing every problem and
+    leaves an existing artifact untouched; IOError/OSError if the files cannot be read or written."""
+    if artifact_filepath is None:
+        artifact_filepath = compiled_filepath(schedule_filepath)
+    stat = os.stat(schedule_filepath)
+    schedule = compile_schedule(read_schedule_rows(schedule_filepath), schedule_filepath)
+    artifact = {
+        "format": COMPILED_FORMAT,
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "rows": schedule.rows,
+        "starts": schedule.starts,
+        "ends": schedule.ends,
+    }
+    temp_filepath = artifact_filepath + ".tmp"
+    with open(temp_filepath, "w") as artifact_file:
+        json.dump(artifact, artifact_file)
+    os.replace(temp_filepath, artifact_filepath)
+    logger.info("Compiled %s windows from %s into %s", len(schedule.starts), schedule_filepath, artifact_filepath)
+    return schedule
+
+
+def load_compiled_schedule(artifact_filepath, source_stat=None):
+    """CompiledSchedule from an artifact written by compile_schedule_file, without any parsing or checking of
+    times. With source_stat (os.stat of the schedule CSV), None if the artifact was compiled from another
+    version of the file. Raises ValueError if the artifact is malformed, IOError/OSError if it cannot be read."""
+    with open(artifact_filepath) as artifact_file:
+        artifact = json.load(artifact_file)
+    try:
+        if artifact["format"] != COMPILED_FORMAT:
+            raise ValueError("unknown format {}".format(artifact["format"]))
+        if source_stat is not None and (artifact["source_size"] != source_stat.st_size or
+                                        artifact["source_mtime_ns"] != source_stat.st_mtime_ns):
+            return None
+        starts = [int(start) for start in artifact["starts"]]
+        ends = [int(end) for end in artifact["ends"]]
+        rows = [[str(cell) for cell in row] for row in artifact["rows"]]
+    except (KeyError, TypeError) as err:
+        raise ValueError("malformed artifact: {!r}".format(err))
+    if len(starts) != len(ends) or any(not 0 <= start < end <= MINUTES_PER_WEEK for start, end in zip(starts, ends)) \
+            or starts != sorted(starts):
+        raise ValueError("malformed artifact: invalid intervals")
+    return CompiledSchedule(rows, starts, ends)
+
+
+# Compiled schedules by file path: (mtime in ns, size, CompiledSchedule, clock.monotonic() of the last check)
+_schedule_cache = {}
+
+
+def read_schedule(schedule_filepath, max_age=0):
+    """Read schedule from CSV file without (!) a header and compile it; returns a CompiledSchedule, recompiled
+    only when the file changed since the last call. With max_age (seconds), a schedule checked less than max_age
+    ago is returned without even a stat() of the file. An empty schedule if the file cannot be read."""
+    try:
+        return _read_schedule(schedule_filepath, max_age)
+    except (IOError, OSError) as err:
+        logger.error("IOError: could not read schedule.csv. %s", err)
+        return compile_schedule([])
+
+
+# Same as read_schedule, but raises IOError/OSError if the file cannot be read
+def _read_schedule(schedule_filepath, max_age=0):
+    cached = _schedule_cache.get(schedule_filepath)
+    if cached is not None and max_age and clock.monotonic() - cached[3] < max_age:
+        return cached[2]
+    stat = os.stat(schedule_filepath)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        _schedule_cache[schedule_filepath] = cached[:3] + (clock.monotonic(),)
+        return cached[2]
+
+    schedule = _load_current_artifact(schedule_filepath, stat)
+    if schedule is None:
+        schedule_arr = read_schedule_rows(schedule_filepath)
+        logger.debug("Successfully read schedule from CSV.")
+        schedule = compile_schedule(schedule_arr, schedule_filepath)
+    _schedule_cache[schedule_filepath] = (stat.st_mtime_ns, stat.st_size, schedule, clock.monotonic())
+    return schedule
+
+
+# The schedule from the compiled artifact, or None if there is none or it is outdated or unreadable
+def _load_current_artifact(schedule_filepath, stat):
+    artifact_filepath = compiled_filepath(schedule_filepath)
+    try:
+        schedule = load_compiled_schedule(artifact_filepath, stat)
+    except FileNotFoundError:
+        return None
+    except (IOError, OSError, ValueError) as err:
+        logger.warning("Ignoring compiled schedule %s, compiling the CSV instead. %s", artifact_filepath, err)
+        return None
+    if schedule is None:
+        logger.debug("Compiled schedule %s is outdated, compiling the CSV instead.", artifact_filepath)
+    else:
+        logger.debug("Loaded compiled schedule from %s.", artifact_filepath)
+    return schedule
+
+
+# Last valid schedule by file path, for read_valid_schedule
+_last_valid_schedules = {}
+
+
+def read_valid_schedule(schedule_filepath, max_age=0):
+    """Same as read_schedule, but an invalid or unreadable file never replaces a valid schedule: the problem is
+    logged and the last valid schedule is returned until the file is fixed. After a restart, that is the last
+    compiled artifact (only ever written from a valid file), whichever CSV it was compiled from; without one, an
+    empty schedule."""
+    try:
+        schedule = _read_schedule(schedule_filepath, max_age)
+    except (ScheduleError, IOError, OSError) as err:
+        schedule = _last_valid_schedules.get(schedule_filepath)
+        if schedule is not None:
+            fallback = "keeping the previous one"
+        else:
+            schedule = _load_any_artifact(schedule_filepath)
+            fallback = "using the last compiled one" if schedule is not None else "using an empty one"
+        if isinstance(err, ScheduleError):
+            logger.error("Invalid schedule, %s:\n%s", fallback, err)
+        else:
+            logger.error("IOError: could not read schedule.csv, %s. %s", fallback, err)
+        if schedule is None:
+            return compile_schedule([])
+        _last_valid_schedules[schedule_filepath] = schedule
+        return schedule
+    _last_valid_schedules[schedule_filepath] = schedule
+    return schedule
+
+
+# The schedule from the compiled artifact whatever CSV it was compiled from, or None if there is none or it is
+# unreadable
+def _load_any_artifact(schedule_filepath):
+    artifact_filepath = compiled_filepath(schedule_filepath)
+    try:
+        return load_compiled_schedule(artifact_filepath)
+    except FileNotFoundError:
+        return None
+    except (IOError, OSError, ValueError) as err:
+        logger.warning("Ignoring compiled schedule %s. %s", artifact_filepath, err)
+        return None
+
+
+# Renderings by (schedule version, date), only for the latest dates (a page shows today's and tomorrow's windows)
+_texts_cache = {}
+
+
+def schedule_texts(schedule, day=None):
+    """All text renderings (ScheduleTexts) of a CompiledSchedule for day (date, Default = today). Made once per
+    schedule version and date, so page views after the first one do no formatting at all."""
+    if day is None:
+        day = clock.now().date()
+    key = (schedule.version, day)
+    texts = _texts_cache.get(key)
+    if texts is None:
+        week = schedule_textual_vertically(schedule)
+        days = [windows_textual_vertically(row) for row in schedule]
+        today, tomorrow = day.weekday(), (day.weekday() + 1) % 7
+        texts = ScheduleTexts(week, week.replace("\n", "<br />"), days,
+                              days[today] if today < len(days) else "",
+                              days[tomorrow] if tomorrow < len(days) else "")
+        if len(_texts_cache) >= 8:
+            _texts_cache.clear()
+        _texts_cache[key] = texts
+    return texts
 
 
-def get_schedule_textual_vertically_for_dayofweek(schedule_filepath, dayofweek):
+def get_schedule_textual_vertically(schedule_filepath):
+    return schedule_texts(read_schedule(schedule_filepath)).week
 
-    # Read the schedule
-    schedule_arr = read_schedule(schedule_filepath)
 
-    # Determine schedule row from day of week
-    row = dayofweek - 1
+def schedule_textual_vertically(schedule_arr):
+    """Same as get_schedule_textual_vertically, for schedule rows that have already been read (or were made by
+    schedule_bitmap.ScheduleBitmap.to_rows())"""
+    result = ""
 
-    # Extract the corresponding schedule for this day
-    schedule_for_day = schedule_arr[row]
+    for row in schedule_arr:
+        result += row[0] + "\n"
+        result += windows_textual_vertically(row)
 
-    # Extract the defined time windows for the day
-    time_windows = extract_time_windows_for_day(schedule_for_day)
+    return result
 
+
+# The time windows of a schedule row, one "HH:MM until HH:MM" per line
+def windows_textual_vertically(schedule_row):
     result = ""
 
     # Assemble string for time windows
-    for window_i in range(0, len(time_windows)):
-        window_start_time = datetime.strptime(time_windows[window_i][0], "%H:%M").time()
-        window_end_time = datetime.strptime(time_windows[window_i][1], "%H:%M").time()
-
-        result += time_windows[window_i][0] + " until " + time_windows[window_i][1] + "\n"
+    for window in extract_time_windows_for_day(schedule_row):
+        result += window[0] + " until " + window[1] + "\n"
 
     return result
 
 
+def get_schedule_textual_vertically_html(schedule_filepath):
+    return schedule_texts(read_schedule(schedule_filepath)).week_html
+
+
+def get_schedule_textual_vertically_for_dayofweek(schedule_filepath, dayofweek):
+    # Windows of the day of week (1 = Monday)
+    return schedule_texts(read_schedule(schedule_filepath)).days[dayofweek - 1]
+
+
 def get_todays_schedule_textual_vertically(schedule_filepath):
-    today = datetime.today()
-    weekday = today.isoweekday()
-    return get_schedule_textual_vertically_for_dayofweek(schedule_filepath, weekday)
+    return schedule_texts(read_schedule(schedule_filepath)).today
 
 
 def get_tomorrows_schedule_textual_vertically(schedule_filepath):
-    today = datetime.today()
-    tomorrow = today + timedelta(days = 1)
-    weekday = tomorrow.isoweekday()
-    return get_schedule_textual_vertically_for_dayofweek(schedule_filepath, weekday)
+    return schedule_texts(read_schedule(schedule_filepath)).tomorrow
 
 
 def is_pump_desired(schedule_filepath):
@@ -136,44 +546,30 @@ def is_pump_desired(schedule_filepath):
     # Read the schedule
     schedule_arr = read_schedule(schedule_filepath)
 
-    # Determine what day of the week it is today
-    now = datetime.now()
-    weekday = now.isoweekday()-1
-    print("Today is {}".format(now.strftime("%A")))
-
-    # Extract the corresponding schedule for this day
-    schedule_today = schedule_arr[weekday]
-
-    # Extract the defined time windows for the day
-    time_windows_today = extract_time_windows_for_day(schedule_today)
+    return is_pump_desired_from_schedule(schedule_arr)
 
-    # Check if we are within one of the time windows
-    for window in time_windows_today:
 
-        # Extract start and end time for current window
-        window_start_time = datetime.strptime(window[0], "%H:%M").time()
-        window_end_time = datetime.strptime(window[1], "%H:%M").time()
-
-        window_start_datetime = datetime.combine(now.date(), window_start_time)
-        window_end_datetime = datetime.combine(now.date(), window_end_time)
-
-        print("Today's hours of operation: "
-              "{} until {}".format(window_start_time.strftime("%H:%M"), window_end_time.strftime("%H:%M")))
-        # print("window_start_datetime, window_end_datetime: ", window_start_datetime, window_end_datetime)
+def is_pump_desired_from_schedule(schedule_arr, now=None):
+    """Same as is_pump_desired, but for a schedule that has already been read and checked (a CompiledSchedule or
+    schedule_calendar.CalendarSchedule, or rows, which are compiled first). now (datetime) defaults to the current
+    time"""
+    if isinstance(schedule_arr, list):
+        schedule_arr = compile_schedule(schedule_arr)
+    pump_desired = schedule_arr.is_desired(now)
+    logger.debug("We %s within a time window right now.", "ARE" if pump_desired else "are NOT")
+    return pump_desired
 
-        # Check if we are within the current time window
-        if (now >= window_start_datetime) & (now < window_end_datetime):
-            # We are within the current time window, return True
-            print("We ARE within a time window right now.")
-            return True
 
-    # We are not within one of the time windows for today, return False
-    print("We are NOT within a time window right now.")
-    return False
+def get_next_switching_time(schedule_arr, now=None):
+    """Get the next point in time at which a time window starts or ends, or None if the schedule is empty"""
+    if isinstance(schedule_arr, list):
+        schedule_arr = compile_schedule(schedule_arr)
+    transition = schedule_arr.next_transition(now)
+    return transition.time if transition is not None else None
 
 
 def get_today_textual():
-    result = "{}".format(datetime.now().strftime("%A, %d %B %Y"))
+    result = "{}".format(clock.now().strftime("%A, %d %B %Y"))
     return result
 
 
@@ -184,5 +580,32 @@ def main():
     return pump_desired
 
 
+def compile_main(argv=None):
+    """pump_scheduler.py compile: validate a schedule and write its compiled artifact; exit code 1 on errors"""
+    parser = argparse.ArgumentParser(prog="pump_scheduler.py compile",
+                                     description="Validate a schedule CSV and write its compiled artifact")
+    parser.add_argument("schedule", nargs="?", default="cfg/schedule.csv",
+                        help="schedule CSV file (Default = cfg/schedule.csv)")
+    parser.add_argument("-o", "--output", help="artifact to write (Default = <schedule>.compiled.json)")
+    args = parser.parse_args(argv)
+
+    try:
+        schedule = compile_schedule_file(args.schedule, args.output)
+    except ScheduleError as err:
+        print(err, file=sys.stderr)
+        print("{} error(s) found, nothing written.".format(len(err.errors)), file=sys.stderr)
+        return 1
+    except (IOError, OSError) as err:
+        print("Could not compile {}: {}".format(args.schedule, err), file=sys.stderr)
+        return 1
+    print("Compiled {} windows from {} into {}".format(len(schedule.starts), args.schedule,
+                                                      args.output or compiled_filepath(args.schedule)))
+    return 0
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["compile"]:
+        logging.basicConfig(level=logging.WARNING)
+        sys.exit(compile_main(sys.argv[2:]))
+    logging.basicConfig(level=logging.DEBUG)
     main()
\ No newline at end of file
@@ -2,6 +2,9 @@
 # Use Python 3
 
 import csv
+import operator
+from bisect import bisect_left
+from itertools import islice
 from time import sleep
 from datetime import datetime, date, time, timedelta
 # import pytz
@@ -10,6 +13,13 @@ from datetime import datetime, date, time, timedelta
 import logging
 import traceback
 
+from virtual_clock import system_clock
+
+logger = logging.getLogger(__name__)
+
+# Source of the current time; the simulator replaces it with a virtual_clock.VirtualClock
+clock = system_clock
+
 """A timer to turn on pump operation for a set period of time, and turn it off after that time interval elapsed ("the timer expired").
 
 Attributes:
@@ -25,14 +35,14 @@ def add_time(timer_filepath, log_file_path_abs, days = 0, hours = 0, minutes = 0
     current_end_time_dt = datetime.fromtimestamp(current_end_time_unix)
 
     # If timer is currently expired, reset the timer to now and add the time
-    if current_end_time_dt < datetime.now():
-        current_end_time_dt = datetime.now()
+    if current_end_time_dt < clock.now():
+        current_end_time_dt = clock.now()
         # otherwise, just add the time
 
     time_to_add_dt = timedelta(days = days, hours = hours, minutes = minutes, seconds = seconds)
     new_end_time = current_end_time_dt + time_to_add_dt
     new_end_time_unix = int(new_end_time.timestamp())
-    print("Added time ({}). New end time is now: {} / unix: {}".format(time_to_add_dt, new_end_time, new_end_time_unix))
+    logger.info("Added time (%s). New end time is now: %s / unix: %s", time_to_add_dt, new_end_time, new_end_time_unix)
     write_end_time(timer_filepath, new_end_time_unix, log_file_path_abs)
 
 # TODO: Finish and test - needs to be logical, should it be possible to go negative?
@@ -47,11 +57,11 @@ def add_time(timer_filepath, log_file_path_abs, days = 0, hours = 0, minutes = 0
 
 def set_timer_time_left(timer_filepath, log_file_path_abs, days = 0, hours = 0, minutes = 0, seconds = 0):
     """Reset the timer to a specified time interval"""
-    current_end_time_dt = datetime.now()
+    current_end_time_dt = clock.now()
     time_to_add_dt = timedelta(days = days, hours = hours, minutes = minutes, seconds = seconds)
     new_end_time = current_end_time_dt + time_to_add_dt
     new_end_time_unix = int(new_end_time.timestamp())
-    print("Reset timer to ({}). New end time is now: {} / unix: {}".format(time_to_add_dt, new_end_time, new_end_time_unix))
+    logger.info("Reset timer to (%s). New end time is now: %s / unix: %s", time_to_add_dt, new_end_time, new_end_time_unix)
     write_end_time(timer_filepath, new_end_time_unix, log_file_path_abs)
 
 
@@ -108,7 +118,7 @@ def get_time_left(timer_filepath, log_file_path_abs):
     end_time_dt = datetime.fromtimestamp(end_time_unix)
     # print("End Time datetime object: {}".format(end_time_dt))
     # print("Now datetime object: {}".format(datetime.now()))
-    time_left = end_time_dt - datetime.now()
+    time_left = end_time_dt - clock.now()
     # print("Time left: {} seconds".format(time_left))
     return time_left
 
@@ -140,6 +150,24 @@ def is_pump_desired(timer_filepath, log_file_path_abs):
     return time_left_seconds > 0
 
 
+def is_pump_desired_from_end_time(end_time_unix, now=None):
+    """Same as is_pump_desired, but for an end time that has already been read from file.
+    now (datetime) defaults to the current time"""
+    if now is None:
+        now = clock.now()
+    return datetime.fromtimestamp(end_time_unix) > now
+
+
+def desired_mask(end_time_unix, timestamps):
+    """is_pump_desired_from_end_time for each of a sequence of unix timestamps (list, array.array, numpy array,
+    ...), as a bytearray of 1 (timer running) and 0 (expired). For ascending timestamps, the expiry is found by binary
+    search and everything before it filled at once."""
+    if all(map(operator.le, timestamps, islice(timestamps, 1, None))):
+        running_count = bisect_left(timestamps, end_time_unix)
+        return bytearray(b"\x01" * running_count) + bytearray(len(timestamps) - running_count)
+    return bytearray(timestamp < end_time_unix for timestamp in timestamps)
+
+
 """File I/O Functions"""
 
 def read_end_time(timer_filepath, log_file_path_abs):
@@ -148,16 +176,16 @@ def read_end_time(timer_filepath, log_file_path_abs):
         timer_file = open(timer_filepath, "r")
         timer_endtime = int(timer_file.readline())
         timer_file.close()
-        print("Successfully read timer end time from file. End time: {}, file: {}".format(timer_endtime, timer_filepath), log_file_path_abs)
+        logger.debug("Successfully read timer end time from file. End time: %s, file: %s", timer_endtime, timer_filepath)
     except IOError as timer_err:
-        print("IOError occurred: timer end time file ({}) could not be read. "
-                      "Using default value of {}. Error:\n{}"
-                      .format(timer_filepath, 0, timer_err), log_file_path_abs)
+        logger.error("IOError occurred: timer end time file (%s) could not be read. "
+                     "Using default value of %s. Error:\n%s",
+                     timer_filepath, 0, timer_err)
         return 0
     except ValueError as timer_err:
-        print("Value Error occurred: timer end time could not be recognized as an integer."
-                      "Using default value of {}. Error:\n{}"
-                      .format(0, timer_err), log_file_path_abs)
+        logger.error("Value Error occurred: timer end time could not be recognized as an integer."
+                     "Using default value of %s. Error:\n%s",
+                     0, timer_err)
         return 0
 
     return timer_endtime
@@ -169,14 +197,13 @@ def write_end_time(timer_filepath, end_time_unix, log_file_path_abs):
         timer_file = open(timer_filepath, "w")
         timer_file.write(str(end_time_unix))
         timer_file.close()
-        print("Successfully wrote new timer end time to file: {}".format(timer_filepath), log_file_path_abs)
+        logger.debug("Successfully wrote new timer end time to file: %s", timer_filepath)
     except IOError as timer_err:
-        print("IOError occurred: timer end time file ({}) could not be written. Error:\n{}"
-                      .format(timer_filepath, timer_err), log_file_path_abs)
+        logger.error("IOError occurred: timer end time file (%s) could not be written. Error:\n%s",
+                     timer_filepath, timer_err)
         return 0
     except ValueError as timer_err:
-        print("Value Error occurred: timer end time file could not be written. Error:\n{}"
-                      .format(timer_err), log_file_path_abs)
+        logger.error("Value Error occurred: timer end time file could not be written. Error:\n%s", timer_err)
         return 0
 
 
@@ -12,25 +12,41 @@
 # I reused the send_data() method to send data to Thingspeak
 
 import os
-import sys
 import resource
 import traceback
 import logging
+import sqlite3
+import atexit
 
 from enum import Enum
 
-import urllib  # URL functions
-import urllib2  # URL functions
+from urllib.parse import urlencode
 
-import time
-from time import sleep
-from datetime import datetime
-
-from gpiozero import LED
-from gpiozero import Button
+try:
+    from gpiozero import LED
+    from gpiozero import Button
+except ImportError:
+    LED = Button = None  # only DEVICE_BACKEND = 'mock' works without gpiozero
 
 import pump_scheduler
 import pump_timer
+import schedule_calendar
+from config_store import ConfigStore
+from control_wakeup import ControlWakeup
+from thingspeak_uploader import ThingspeakUploader, THINGSPEAK_BULK_URL
+from connection_manager import ConnectionManager
+import logging_setup
+from log_rotation import SegmentManifest, SegmentCompressor, SegmentRotator, RotatingCsvWriter, recover_segments
+from telemetry_store import TelemetryWriter, FLAG_PUMP_ALLOWED, FLAG_PUMP_DESIRED, FLAG_SENSOR_FAULT, \
+    FLAG_FAULT_SHIFT
+from telemetry_db import TelemetryDatabase
+from safety_watchdog import SafetyWatchdog
+from level_filter import LevelRingBuffer
+from level_trend import LevelTrendEstimator, trend_textual, write_trend_file
+from virtual_clock import system_clock
+from backends import create_mock_devices
+from level_sensor import GpiozeroLevelReader, GpiomemLevelReader, GpiodLevelReader, MockLevelReader, \
+    AdaptiveLevelReader, mask_to_pin_values, decode_table, FAULT_NONE, FAULT_NAMES
 
 
 # Parameters ###########################################################################################################
@@ -40,22 +56,85 @@ import pump_timer
 threshold_default = 20
 # Width of hysteresis in percent (Default = 10)
 threshold_delta = 20
-# Frequency to check level, in seconds (Default = 30)
+# Maximum time between two checks, in seconds (Default = 30);
+# the loop wakes up earlier on config changes, level changes, timer expiry and schedule window boundaries
 sleep_time = 30
+# Minimum time between two checks, in seconds (Default = 1); keeps bouncing level pins from spinning the loop
+min_cycle_time = 1
+# Interval at which the safety watchdog probes the level pins on its own, in seconds (Default = 1)
+watchdog_sample_interval = 1.0
+# The watchdog turns the pump off if the main loop has not checked in for this long, in seconds (Default = 3 cycles)
+watchdog_heartbeat_timeout = 3 * sleep_time
+# Real-time (SCHED_FIFO) priority of the watchdog thread, needs root; None for normal priority (Default = 10)
+watchdog_priority = 10
+# Oversampling: read the level pins in bursts into a ring buffer and use a filtered level (Default = False);
+# keeps sloshing while the pump runs from causing spurious threshold crossings
+oversampling_enabled = False
+# Samples per second within a burst (Default = 20) and samples per burst (Default = 10); one burst per level reading
+oversampling_rate = 20
+oversampling_burst_size = 10
+# Level estimate: 'median' or 'mode' over the last oversampling_window seconds, or 'debounced' (Default = 'median')
+oversampling_estimate = 'median'
+oversampling_window = 10
+# Number of equal samples in a row before the debounced level changes (Default = 10)
+oversampling_debounce_count = 10
+# Level history the fill/drain trend is fitted over, in seconds (Default = 3600)
+trend_window = 3600
+# Minimum history before a trend is reported, in seconds (Default = 600); the level moves in steps of one pin
+trend_min_span = 600
+# File in telemetry_path the latest trend is written to for the web UI (Default = 'trend.json')
+trend_file_name = 'trend.json'
 
 THINGSPEAKKEY = ''
 THINGSPEAKURL = 'https://api.thingspeak.com/update'
+# Channel ID for bulk uploads, read from thingspeak_channel.cfg; if empty, every sample is sent on its own
+THINGSPEAKCHANNEL = ''
+# Number of samples per bulk upload (Default = 30, i.e. one request every 15 minutes)
+thingspeak_batch_size = 30
+# Samples that could not be sent are kept here until the link is back (in log_file_path)
+thingspeak_spool_file_name = 'thingspeak_spool.jsonl'
+# Maximum size of the spool file, in bytes (Default = 8 MiB); the oldest samples are dropped beyond that
+thingspeak_spool_max_bytes = 8 * 1024 * 1024
 
 cfg_path = 'cfg'
 
 log_file_path = 'logs'  # cannot be left empty
 log_file_name = ''   # prefix for log file name
+# Log level (Default = DEBUG); overwritten with the value in log_level.cfg if possible, also while running
+log_level_default = 'DEBUG'
 csv_file_name = ''   # prefix for csv file name
-
+# Start a new log / CSV file once it exceeds this size, in bytes (Default = 4 MiB)
+log_rotate_max_bytes = 4 * 1024 * 1024
+# Start a new log / CSV file every calendar day (Default = True)
+log_rotate_daily = True
+# Number of old (compressed) log and CSV files to keep, each (Default = 90)
+log_retention_count = 90
+# Index of all log and CSV files and their time ranges (in log_file_path)
+log_manifest_file_name = 'manifest.json'
+# Directory of the binary telemetry store (one file per day), relative to program directory (Default = 'telemetry')
+telemetry_path = 'telemetry'
+# Also write the telemetry to an SQLite database with rollup tables in telemetry_path (Default = False)
+telemetry_db_enabled = False
+telemetry_db_file_name = 'telemetry.sqlite3'
+# Commit the database every so many samples or seconds, whichever comes first (Default = 30, 300)
+telemetry_db_commit_count = 30
+telemetry_db_commit_interval = 300
+
+
+# Devices to use (Default = 'gpio'): 'gpio' (gpiozero on a Raspberry Pi) or 'mock' (in-memory, runs anywhere)
+DEVICE_BACKEND = 'gpio'
 
 # GPIO Pin Configuration
 SEED_VOLTAGE_PIN_NO = 26
 LVL_PIN_NO_ARRAY = [4, 17, 27, 22, 23, 24, 25, 5, 6, 13]    # ordered from 0 to 100
+# How to read the level pins (Default = 'gpiozero'): 'gpiozero' (one pin at a time), 'gpiomem' (one snapshot of
+# the GPIO level register), 'gpiod' (one bulk request through libgpiod on GPIO_CHIP) or 'mock' (no hardware)
+LVL_READER_BACKEND = 'gpiozero'
+GPIO_CHIP = 'gpiochip0'
+# Adaptive probing: only read the pins next to the previous level, with a full scan every
+# LVL_FULL_SCAN_INTERVAL readings and on inconsistencies (Default = False, 60)
+LVL_ADAPTIVE_PROBING = False
+LVL_FULL_SCAN_INTERVAL = 60
 PUMP_PIN_NO = 20
 STATUS_LED_PIN_NO = 21
 
@@ -73,83 +152,99 @@ class ControlMode(Enum):
 DEFAULT_MODE = ControlMode.MANUAL
 control_mode = ControlMode.SCHEDULED  # Start in scheduled mode by default
 
+# Keep-alive HTTPS connections to Thingspeak, shared by all uploads
+thingspeak_connections = ConnectionManager(timeout=5)
+
+logger = logging.getLogger("pumpcontrol")
+
+# Source of the current time; the simulator replaces it with a virtual_clock.VirtualClock
+clock = system_clock
+
+LOG_LEVEL_PREFIXES = {
+    "[DEBUG]": logging.DEBUG,
+    "[INFO]": logging.INFO,
+    "[WARNING]": logging.WARNING,
+    "[ERROR]": logging.ERROR,
+    "[CRITICAL]": logging.CRITICAL,
+}
+
 
 # FUNCTION DEFINITIONS #################################################################################################
 
 
 # Get Timestamp up to seconds as string
 def get_timestamp_s():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return clock.now().strftime("%Y-%m-%d %H:%M:%S")
 
 # Get Timestamp up to microseconds as string 
 def get_timestamp_ms():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-
-
-def print_and_log(message, log_file_path_abs):
-    print(message)
-    try:
-        log_file = open(log_file_path_abs, "a+")
-        message_string = "{}: {}\n".format(get_timestamp_ms(), message)
-        log_file.write(message_string)
-        log_file.close()
-    except IOError as e:
-        print("[ERROR] Could not write to log file. IOError occurred: {}".format(e))
-
-
-def write_to_csv(message, csv_file_path_abs, log_file_path_abs):
-    try:
-        csv_file = open(csv_file_path_abs, "a+")
-        csv_file.write("{}\n".format(message))
-        csv_file.close()
-    except IOError as e:
-        print_and_log("[ERROR] Could not write to CSV file. IOError occurred: {}".format(e), log_file_path_abs)
-
+    return clock.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+# Log a message starting with a level prefix like "[INFO]". The log file (log_file_path_abs) is opened once by
+# logging_setup.setup_logging(); the argument is only kept for existing callers.
+# Prefer logger.debug("...%s", value) for messages that are not always needed, so they are not formatted in vain.
+def print_and_log(message, log_file_path_abs=None):
+    level = logging.INFO
+    for prefix, prefix_level in LOG_LEVEL_PREFIXES.items():
+        if message.startswith(prefix):
+            level = prefix_level
+            message = message[len(prefix):].lstrip()
+            break
+    logger.log(level, message)
 
-# Probe the (10) level pins for HIGH or LOW and return boolean array
-def probe_level_pins(lvl_pin_array, seed_voltage, log_file_path_abs):
-    lvl_pin_values = [False] * len(list(lvl_pin_array))
 
+# Probe the (10) level pins for HIGH or LOW and return them as bitmask (bit 0 = lowest pin).
+# All pins are read in one call of the level reader, so the seed voltage is only on for that call
+def probe_level_mask(level_reader, seed_voltage):
     seed_voltage.on()
-
-    for x in range(len(lvl_pin_array)):
-        #print_and_log("[DEBUG] Checking pin no. {}: GPIO {}".format(x, lvlPinNoArray[x]), log_file_path_abs)
-        lvl_pin_values[x] = lvl_pin_array[x].is_pressed
-
+    lvl_pin_mask = level_reader.read_mask()
     seed_voltage.off()
-    print_and_log("[DEBUG] Level Pin status: {}".format(lvl_pin_values), log_file_path_abs)
-
-    return lvl_pin_values
-
+    return lvl_pin_mask
 
-# First probe GPIO pins, then read the returned value array in reversed order (starting with 100%),
-# and break at first HIGH and return its corresponding level [0.0-1.0]
-def read_tank_level(lvl_pin_array, seed_voltage, log_file_path_abs):
-    lvl_pin_values_reversed = list(reversed(list(probe_level_pins(lvl_pin_array, seed_voltage, log_file_path_abs))))
-    lvl_pin_cnt = len(lvl_pin_array)
-
-    for x in range(lvl_pin_cnt + 1):
-        if x == lvl_pin_cnt:
-            break
-        if lvl_pin_values_reversed[x]:
-            break
-    result = (float(lvl_pin_cnt) - x) / float(lvl_pin_cnt)
-    print_and_log("[INFO] Detected tank level is {}%".format(result * 100), log_file_path_abs)
-    return result
 
+# Probe the (10) level pins for HIGH or LOW and return boolean array
+def probe_level_pins(level_reader, seed_voltage, log_file_path_abs, verbose=True):
+    lvl_pin_values = mask_to_pin_values(probe_level_mask(level_reader, seed_voltage), level_reader.pin_count)
+    if verbose:
+        logger.debug("Level Pin status: %s", lvl_pin_values)
+    return lvl_pin_values
 
-# Turn on pump
-def pump_turn_on(pump, log_file_path_abs):
-    pump.on()  # Pump is ON when LOW
-    print_and_log("[INFO] Turning Pump ON", log_file_path_abs)
-    return True
 
-
-# Turn off pump
-def pump_turn_off(pump, log_file_path_abs):
-    pump.off()  # Pump is OFF when HIGH
-    print_and_log("[INFO] Turning Pump OFF", log_file_path_abs)
-    return False
+# Probe the level pins and decode the pattern through the precomputed table into a level_sensor.LevelDecoding:
+# level [0.0-1.0], whether the pattern is consistent (wet pins contiguous from the bottom), and the fault class
+def read_tank_level_decoded(level_reader, seed_voltage, log_file_path_abs, verbose=True):
+    lvl_pin_mask = probe_level_mask(level_reader, seed_voltage)
+    decoding = decode_table(level_reader.pin_count)[lvl_pin_mask]
+    if verbose:
+        logger.debug("Level Pin status: %s", mask_to_pin_values(lvl_pin_mask, level_reader.pin_count))
+        if not decoding.consistent:
+            logger.warning("Inconsistent level pin pattern %s (top pin first), likely cause: %s. Using level %s%%",
+                           "{:0{}b}".format(lvl_pin_mask, level_reader.pin_count), FAULT_NAMES[decoding.fault],
+                           decoding.level * 100)
+        logger.info("Detected tank level is %s%%", decoding.level * 100)
+    return decoding
+
+
+# Probe the level pins in a burst into the ring buffer and return the filtered level as level_sensor.LevelDecoding
+def read_tank_level_oversampled(level_buffer, level_reader, seed_voltage, log_file_path_abs, verbose=True):
+    level_buffer.sample_burst(lambda: probe_level_mask(level_reader, seed_voltage), oversampling_burst_size,
+                              oversampling_rate)
+    decoding = level_buffer.estimate(oversampling_estimate, oversampling_window)
+    if verbose:
+        logger.debug("Level Pin status (latest of %s samples): %s", level_buffer.count,
+                     mask_to_pin_values(level_buffer.latest_mask(), level_reader.pin_count))
+        if not decoding.consistent:
+            logger.warning("Inconsistent level pin pattern within the last %s s, likely cause: %s",
+                           oversampling_window, FAULT_NAMES[decoding.fault])
+        logger.info("Detected tank level is %s%% (%s of the last %s s)", decoding.level * 100,
+                    oversampling_estimate, oversampling_window)
+    return decoding
+
+
+# Probe the level pins and return the level [0.0-1.0]
+def read_tank_level(level_reader, seed_voltage, log_file_path_abs, verbose=True):
+    return read_tank_level_decoded(level_reader, seed_voltage, log_file_path_abs, verbose).level
 
 
 # Get textual representation of pump state
@@ -162,27 +257,26 @@ def send_data_to_thingspeak(url, key, level, pump_state, log_file_path_abs):
   Send event to internet site
   """
 
-    print_and_log("[INFO] Sending data to Thingspeak...", log_file_path_abs)
+    logger.info("Sending data to Thingspeak...")
 
     values = {'api_key': key, 'field1': level, 'field2': pump_state}
 
-    postdata = urllib.urlencode(values)
-    req = urllib2.Request(url, postdata)
+    postdata = urlencode(values).encode("ascii")
 
     try:
         # Send data to Thingspeak
-        response = urllib2.urlopen(req, None, 5)
-        html_string = response.read()
-        response.close()
-
-        log_str = "[INFO] Successfully sent data: {:.1f}, {:.2f}".format(level, pump_state) + ", Update " + html_string
-    except urllib2.HTTPError as e:
-        # Thrown when URL or Key are wrong
-        log_str = '[ERROR] Error sending data to Thingspeak: Server could not fulfill the request. ' \
-                  'Error code: {}'.format(e.code)
-    except urllib2.URLError as e:
+        status, html_bytes = thingspeak_connections.request("POST", url, postdata,
+                                                            {"Content-Type": "application/x-www-form-urlencoded"})
+        if status < 400:
+            log_str = "[INFO] Successfully sent data: {:.1f}, {:.2f}".format(level, pump_state) + ", Update " + \
+                      html_bytes.decode("utf-8", "replace")
+        else:
+            # Returned when URL or Key are wrong
+            log_str = '[ERROR] Error sending data to Thingspeak: Server could not fulfill the request. ' \
+                      'Error code: {}'.format(status)
+    except ConnectionError as e:
         # Thrown when no internet connection
-        log_str = '[ERROR] Error sending data to Thingspeak: Failed to reach server. Reason: {}'.format(e.reason)
+        log_str = '[ERROR] Error sending data to Thingspeak: Failed to reach server. Reason: {}'.format(e)
     except:
         log_str = '[ERROR] Unknown error sending data to Thingspeak'
 
@@ -268,6 +362,20 @@ def read_pump_on_off(filepath, log_file_path_abs):
     return manctl
 
 
+# Read log level name from file, e.g. "INFO"
+def read_log_level_from_file(filepath, log_file_path_abs):
+    try:
+        log_level_file = open(filepath, "r")
+        log_level = log_level_file.readline().strip().upper()
+        log_level_file.close()
+        print_and_log("[DEBUG] Successfully read log level from file: {}".format(log_level), log_file_path_abs)
+    except IOError:
+        print_and_log("[INFO] No log level file found. Using default value of {}.".format(log_level_default),
+                      log_file_path_abs)
+        return log_level_default
+    return log_level
+
+
 # Read timer end time from file
 # TODO: Improve
 def read_timer_end_time_from_file(filepath, log_file_path_abs):
@@ -289,18 +397,88 @@ def read_timer_end_time_from_file(filepath, log_file_path_abs):
     return threshold
 
 
-# MAIN FUNCTION ########################################################################################################
-def main():
-    now = datetime.now()
-    my_path = os.path.abspath(os.path.dirname(__file__))
-    log_file_path_abs = os.path.join(my_path, "{}/{}{}.log".format(log_file_path, log_file_name,
-                                                                    now.strftime("%Y-%m-%d_%H-%M-%S")))
-    csv_file_path_abs = os.path.join(my_path, "{}/{}{}.csv".format(log_file_path, csv_file_name,
-                                                                    now.strftime("%Y-%m-%d_%H-%M-%S")))
-    print_and_log("[INFO] Starting pumpcontrol service", log_file_path_abs);
+# SETUP FUNCTIONS ######################################################################################################
+
+
+# Set up logging and the CSV writer, both rotating their files and sharing one manifest and compression thread.
+# Returns the path of the first log file, the CSV writer and the compressor
+def setup_log_files(my_path):
+    log_directory = os.path.join(my_path, log_file_path)
+    if not os.path.isdir(log_directory):
+        os.makedirs(log_directory)
+
+    manifest = SegmentManifest(os.path.join(log_directory, log_manifest_file_name))
+    compressor = SegmentCompressor(log_directory, manifest)
+    recover_segments(log_directory, manifest, compressor)
+    compressor.start()
+
+    log_rotator = SegmentRotator(log_directory, log_file_name, "log", "log", manifest, compressor,
+                                 log_rotate_max_bytes, log_rotate_daily, log_retention_count)
+    csv_rotator = SegmentRotator(log_directory, csv_file_name, "csv", "csv", manifest, compressor,
+                                 log_rotate_max_bytes, log_rotate_daily, log_retention_count)
 
-    write_to_csv("Time;Level;Pump", csv_file_path_abs, log_file_path_abs)
+    logging_setup.setup_logging(None, log_level_default, rotator=log_rotator)
+    csv_writer = RotatingCsvWriter(csv_rotator, "Time;Level;Pump")
+    return log_rotator.current_filepath, csv_writer, compressor
 
+
+# Close the current log and CSV files and wait for their compression
+def close_log_files(csv_writer, compressor):
+    csv_writer.close()
+    logging_setup.shutdown_logging()
+    compressor.stop(60)
+
+
+# Create the safety watchdog, which owns the pump output from now on. It probes the level pins every
+# watchdog_sample_interval seconds (quietly; the main loop's readings are logged as before).
+# With oversampling, every reading is a burst into a ring buffer shared by the watchdog and the main loop
+def create_safety_watchdog(devices, log_file_path_abs):
+    pump, status_led, seed_voltage, level_reader = devices
+    if oversampling_enabled:
+        capacity = int(oversampling_rate * oversampling_window) + oversampling_burst_size
+        level_buffer = LevelRingBuffer(level_reader.pin_count, capacity, oversampling_debounce_count)
+        read_level = lambda verbose: read_tank_level_oversampled(level_buffer, level_reader, seed_voltage,
+                                                                 log_file_path_abs, verbose)
+    else:
+        read_level = lambda verbose: read_tank_level_decoded(level_reader, seed_voltage, log_file_path_abs,
+                                                             verbose)
+    return SafetyWatchdog(pump, read_level, threshold_default, watchdog_sample_interval, watchdog_heartbeat_timeout,
+                          priority=watchdog_priority)
+
+
+# Open the binary telemetry store and, if enabled, the telemetry database. Returns the list of writers that could
+# be opened; all of them take append(timestamp, level, pump_state, flags) and close()
+def create_telemetry_writers(my_path):
+    writers = []
+    try:
+        writers.append(TelemetryWriter(os.path.join(my_path, telemetry_path)))
+    except OSError as e:
+        logger.error("Could not create telemetry store. Error: %s", e)
+    if telemetry_db_enabled:
+        try:
+            database = TelemetryDatabase(os.path.join(my_path, telemetry_path, telemetry_db_file_name),
+                                         telemetry_db_commit_count, telemetry_db_commit_interval,
+                                         max_sample_gap=3 * sleep_time)
+            atexit.register(database.close)  # also commit the pending samples on Ctrl+C
+            writers.append(database)
+        except (OSError, sqlite3.Error) as e:
+            logger.error("Could not open telemetry database. Error: %s", e)
+    return writers
+
+
+# Flags stored with each telemetry record
+def telemetry_flags(pump_allowed, pump_desired, sensor_fault=FAULT_NONE):
+    flags = 0
+    if sensor_fault != FAULT_NONE:
+        flags |= FLAG_SENSOR_FAULT | sensor_fault << FLAG_FAULT_SHIFT
+    if pump_allowed:
+        flags |= FLAG_PUMP_ALLOWED
+    if pump_desired:
+        flags |= FLAG_PUMP_DESIRED
+    return flags
+
+
+def increase_stack_size(log_file_path_abs):
     try:
         # Set stack size limit to maximum possible
         resource.setrlimit(resource.RLIMIT_STACK, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
@@ -308,86 +486,236 @@ def main():
     except Exception as e:
         print_and_log("[WARNING] Unable to increase stack size. Reason: {}. Continuing...".format(e), log_file_path_abs)
 
-    # Create devices using GPIOZERO library
+
+# Create devices using GPIOZERO library, return None if that is not possible
+def create_devices(log_file_path_abs):
+    if DEVICE_BACKEND == 'mock':
+        print_and_log("[WARNING] Using mock devices, the pump is not connected!", log_file_path_abs)
+        return create_mock_devices(len(LVL_PIN_NO_ARRAY))
+    if LED is None:
+        print_and_log("[CRITICAL] Unable to create devices: gpiozero is not installed. Exiting...", log_file_path_abs)
+        return None
     try:
         pump = LED(PUMP_PIN_NO, active_high=False)
         #pump_off(pump, log_file)
         status_led = LED(STATUS_LED_PIN_NO)
         seed_voltage = LED(SEED_VOLTAGE_PIN_NO)
-        lvl_pin_cnt = len(list(LVL_PIN_NO_ARRAY))
-        lvl_pin_array = [LED] * lvl_pin_cnt
-        for x in range(lvl_pin_cnt):
-            #print_and_log("Checking pin no. {}: GPIO {}".format(x, lvlPinNoArray[x]), log_file_path_abs)
-            lvl_pin_array[x] = Button(LVL_PIN_NO_ARRAY[x], pull_up=False)
-        print_and_log("[INFO] Done initializing GPIO devices. Using {} level pins.".format(lvl_pin_cnt),
-                      log_file_path_abs);
+        level_reader = create_level_reader(log_file_path_abs)
+        print_and_log("[INFO] Done initializing GPIO devices. Using {} level pins ({}).".format(
+                      level_reader.pin_count, type(level_reader).__name__), log_file_path_abs);
     except Exception as e:
         print_and_log("[CRITICAL] Unable to create devices: {}. Exiting...".format(e), log_file_path_abs)
-        return 1
+        return None
+    return pump, status_led, seed_voltage, level_reader
 
-    # CFG stuff - TODO: quick and dirty for testing, needs to be replaced
-    cfg_file_threshold_path_abs = os.path.join(my_path, cfg_path, "threshold.cfg")
-    key_file_path_abs = os.path.join(my_path, cfg_path, "thingspeak_key.cfg")
 
-    # Read key for Thingspeak service
-    # TODO: Read Thingspeak URL and Key from config file
+# Create gpiozero Buttons for the level pins (input, pull-down)
+def create_lvl_pin_array():
+    lvl_pin_cnt = len(list(LVL_PIN_NO_ARRAY))
+    lvl_pin_array = [LED] * lvl_pin_cnt
+    for x in range(lvl_pin_cnt):
+        #print_and_log("Checking pin no. {}: GPIO {}".format(x, lvlPinNoArray[x]), log_file_path_abs)
+        lvl_pin_array[x] = Button(LVL_PIN_NO_ARRAY[x], pull_up=False)
+    return lvl_pin_array
+
+
+# Create the level reader selected by LVL_READER_BACKEND (wrapped for adaptive probing if enabled)
+def create_level_reader(log_file_path_abs):
+    level_reader = create_backend_level_reader(log_file_path_abs)
+    if LVL_ADAPTIVE_PROBING:
+        return AdaptiveLevelReader(level_reader, LVL_FULL_SCAN_INTERVAL)
+    return level_reader
+
+
+# Create the level reader selected by LVL_READER_BACKEND, falling back to gpiozero if the backend is not available
+def create_backend_level_reader(log_file_path_abs):
+    if LVL_READER_BACKEND == 'mock':
+        return MockLevelReader(len(LVL_PIN_NO_ARRAY))
+    lvl_pin_array = None
+    try:
+        if LVL_READER_BACKEND == 'gpiod':
+            return GpiodLevelReader(LVL_PIN_NO_ARRAY, GPIO_CHIP)
+        elif LVL_READER_BACKEND == 'gpiomem':
+            lvl_pin_array = create_lvl_pin_array()
+            return GpiomemLevelReader(LVL_PIN_NO_ARRAY, lvl_pin_array)
+    except (ImportError, OSError, ValueError) as e:
+        print_and_log("[WARNING] Level reader backend '{}' is not available: {}. Using gpiozero instead."
+                      .format(LVL_READER_BACKEND, e), log_file_path_abs)
+    return GpiozeroLevelReader(lvl_pin_array if lvl_pin_array is not None else create_lvl_pin_array())
+
+
+# Read key for Thingspeak service
+# TODO: Read Thingspeak URL and Key from config file
+def load_thingspeak_key(my_path, log_file_path_abs):
     global THINGSPEAKKEY
+    key_file_path_abs = os.path.join(my_path, cfg_path, "thingspeak_key.cfg")
     THINGSPEAKKEY = read_key_from_file(key_file_path_abs, log_file_path_abs)
 
+
+# Create the batching uploader if a channel ID is configured, otherwise return None
+def create_thingspeak_uploader(my_path, log_file_path_abs):
+    global THINGSPEAKCHANNEL
+    channel_file_path_abs = os.path.join(my_path, cfg_path, "thingspeak_channel.cfg")
+    if os.path.exists(channel_file_path_abs):
+        THINGSPEAKCHANNEL = read_key_from_file(channel_file_path_abs, log_file_path_abs)
+    if not THINGSPEAKCHANNEL:
+        print_and_log("[INFO] No Thingspeak channel configured, sending every sample on its own.", log_file_path_abs)
+        return None
+
+    uploader = ThingspeakUploader(THINGSPEAK_BULK_URL.format(THINGSPEAKCHANNEL), THINGSPEAKKEY,
+                                  os.path.join(my_path, log_file_path, thingspeak_spool_file_name),
+                                  log=lambda message: print_and_log(message, log_file_path_abs),
+                                  batch_size=thingspeak_batch_size, batch_interval=thingspeak_batch_size * sleep_time,
+                                  spool_max_bytes=thingspeak_spool_max_bytes,
+                                  transport=thingspeak_connections.post_json)
+    uploader.start()
+    return uploader
+
+
+def create_config_store(my_path, log_file_path_abs):
+    # CFG stuff - TODO: quick and dirty for testing, needs to be replaced
+    cfg_file_threshold_path_abs = os.path.join(my_path, cfg_path, "threshold.cfg")
+
     # Manual pump ctl through file TODO: Replace
     manctl_filepath = os.path.join(my_path, cfg_path, "manual_pump_control.cfg")
     schedule_filepath = os.path.join(my_path, cfg_path, "schedule.csv")
+    calendar_filepath = os.path.join(my_path, cfg_path, "calendar.csv")
     mode_selection_filepath = os.path.join(my_path, cfg_path, "mode_selection.cfg")
     timer_filepath = os.path.join(my_path, cfg_path, "timer.cfg")
 
+    # Config files are parsed once and only reloaded when they change on disk
+    config = ConfigStore()
+    config.register("threshold", cfg_file_threshold_path_abs,
+                    lambda filepath: read_threshold_from_file(filepath, log_file_path_abs))
+    config.register("mode", mode_selection_filepath,
+                    lambda filepath: read_mode_from_file(filepath, log_file_path_abs))
+    config.register("manual_pump_on", manctl_filepath,
+                    lambda filepath: read_pump_on_off(filepath, log_file_path_abs))
+    config.register("timer_end_time", timer_filepath,
+                    lambda filepath: pump_timer.read_end_time(filepath, log_file_path_abs))
+    # An invalid schedule or calendar is logged and the last valid one kept, so a bad upload never stops the loop
+    config.register("schedule", schedule_filepath, pump_scheduler.read_valid_schedule)
+    config.register("calendar", calendar_filepath, schedule_calendar.read_valid_calendar)
+    config.register("log_level", os.path.join(my_path, cfg_path, "log_level.cfg"),
+                    lambda filepath: read_log_level_from_file(filepath, log_file_path_abs))
+    return config
+
+
+# Apply the log level from log_level.cfg if it changed since applied_version; returns the version now applied
+def update_log_level(config, applied_version):
+    log_level = config.get("log_level")
+    if config.version_of("log_level") != applied_version:
+        logging_setup.set_log_level(log_level)
+    return config.version_of("log_level")
+
+
+# MAIN FUNCTION ########################################################################################################
+def main():
+    my_path = os.path.abspath(os.path.dirname(__file__))
+    log_file_path_abs, csv_writer, compressor = setup_log_files(my_path)
+    print_and_log("[INFO] Starting pumpcontrol service", log_file_path_abs);
+    telemetry_writers = create_telemetry_writers(my_path)
+
+    increase_stack_size(log_file_path_abs)
+
+    devices = create_devices(log_file_path_abs)
+    if devices is None:
+        return 1
+    pump, status_led, seed_voltage, level_reader = devices
+
+    load_thingspeak_key(my_path, log_file_path_abs)
+    uploader = create_thingspeak_uploader(my_path, log_file_path_abs)
+
+    config = create_config_store(my_path, log_file_path_abs)
+    log_level_version = update_log_level(config, None)
+
+    # Wake up the main loop on config changes, level changes and deadlines instead of polling
+    wakeup = ControlWakeup(sleep_time, min_cycle_time)
+    wakeup.watch_fd(config.fileno())
+
+    # From here on, only the watchdog switches the pump
+    watchdog = create_safety_watchdog(devices, log_file_path_abs)
+    watchdog.on_level_change = lambda level: wakeup.notify()
+    watchdog.start()
+
     # Initialize pump state variable - pump is always off if not actively pulled LOW by program
     pump_running = False
 
+    level_trend = LevelTrendEstimator(trend_window, trend_min_span)
+    trend_filepath = os.path.join(my_path, telemetry_path, trend_file_name)
+
     # Heartbeat TODO: check if this works as intended (when program crashes...)
     status_led.blink()
 
     # Main Loop
     while True:
         try:
-            # Read Level
-            level = read_tank_level(lvl_pin_array, seed_voltage, log_file_path_abs)
-
-            # Read Threshold from File
-            threshold = read_threshold_from_file(cfg_file_threshold_path_abs, log_file_path_abs)
-            print_and_log("[INFO] Using threshold value of: {}".format(threshold), log_file_path_abs)
+            watchdog.heartbeat()
 
-            # Check selected mode of operation
-            # global control_mode
-            switch_mode(read_mode_from_file(mode_selection_filepath, log_file_path_abs))
+            # Read Level
+            level_decoding = watchdog.read_level()
+            level = level_decoding.level
+            level_trend.add(clock.time(), level, pump_running)
+            if isinstance(level_reader, AdaptiveLevelReader):
+                logger.debug("Adaptive probing: %s pins read for this level, %.2f per level on average "
+                             "(%s full scans)", level_reader.last_pins_read, level_reader.pins_read_per_sample(),
+                             level_reader.full_scans)
+
+            # Reload config files that changed since the last cycle
+            if config.refresh():
+                logger.debug("Config changed, now at version %s", config.version)
+                log_level_version = update_log_level(config, log_level_version)
+
+            # Decide on the pump based on threshold and mode of operation
+            threshold, pump_allowed, pump_desired = decide_pump(level, pump_running, config, log_file_path_abs)
+            logger.info("Using threshold value of: %s", threshold)
 
             # Control pump
-            pump_allowed = is_pump_allowed(level, pump_running, threshold)
-            pump_desired = is_pump_desired(manctl_filepath, schedule_filepath, timer_filepath, log_file_path_abs)
-            if pump_allowed & pump_desired:
-                pump_running = pump_turn_on(pump, log_file_path_abs)
-            else:
-                pump_running = pump_turn_off(pump, log_file_path_abs)
+            watchdog.set_threshold(threshold)
+            pump_running = watchdog.request_pump(pump_allowed & pump_desired)
+
+            # Predict when the level crosses the thresholds
+            trend = level_trend.predict(threshold, threshold_delta, clock.time())
+            logger.info("Level trend: %s", trend_textual(trend))
+            try:
+                write_trend_file(trend_filepath, trend, level, threshold, threshold_delta)
+            except OSError as e:
+                logger.warning("Could not write level trend file. Error: %s", e)
 
             # Log Data
-            print_and_log("[INFO] Current state: Level: {}% | Pump: [ALLOWED: {}, DESIRED: {}, RUNNING: {}]"
-                          .format(level * 100,
-                                  pump_allowed,
-                                  pump_desired,
-                                  pump_state_textual(pump_running)),
-                          log_file_path_abs)
+            logger.info("Current state: Level: %s%% | Pump: [ALLOWED: %s, DESIRED: %s, RUNNING: %s]",
+                        level * 100,
+                        pump_allowed,
+                        pump_desired,
+                        pump_state_textual(pump_running))
 
-            write_to_csv("{};{};{}".format(get_timestamp_s(), level, int(pump_running)), csv_file_path_abs, log_file_path_abs)
+            csv_writer.write_line("{};{};{}".format(get_timestamp_s(), level, int(pump_running)))
+            for telemetry_writer in telemetry_writers:
+                telemetry_writer.append(clock.time(), level, pump_running,
+                                        telemetry_flags(pump_allowed, pump_desired, level_decoding.fault))
 
             # Send Data to Thingspeak
-            send_data_to_thingspeak(THINGSPEAKURL, THINGSPEAKKEY, level * 100, int(pump_running), log_file_path_abs)
-            sys.stdout.flush()
-
-            # Wait until next check is due
-            print_and_log("[DEBUG] Waiting {} seconds until next check...".format(sleep_time), log_file_path_abs)
-            sleep(sleep_time)
+            if uploader is not None:
+                if not uploader.submit(level * 100, int(pump_running)):
+                    logger.warning("Thingspeak upload queue is full, dropping sample")
+            else:
+                send_data_to_thingspeak(THINGSPEAKURL, THINGSPEAKKEY, level * 100, int(pump_running),
+                                        log_file_path_abs)
+
+            # Wait until something happens or the next check is due
+            deadline = earliest_deadline(get_next_deadline(config), get_trend_deadline(trend, pump_running))
+            logger.debug("Waiting at most %s seconds until next check (next deadline: %s)...", sleep_time, deadline)
+            wakeup_reason = wakeup.wait(deadline)
+            logger.debug("Woke up, reason: %s", wakeup_reason)
         except Exception as err:
             print_and_log("[ERROR] An unknown error occurred! Exiting...", log_file_path_abs)
             print_and_log(traceback.format_exc(), log_file_path_abs)
+            watchdog.stop(5)
+            if uploader is not None:
+                uploader.stop(5)  # spool what has not been sent yet
+            for telemetry_writer in telemetry_writers:
+                telemetry_writer.close()
+            close_log_files(csv_writer, compressor)
             raise err
 
     # Terminate Program
@@ -397,6 +725,20 @@ def main():
     return 0
 
 
+def decide_pump(level, pump_running, config, log_file_path_abs, now=None):
+    """One control decision on the (cached) config: returns the threshold and whether the pump is allowed and desired.
+    now (datetime) defaults to the current time"""
+    # Read Threshold from File
+    threshold = config.get("threshold")
+
+    # Check selected mode of operation
+    switch_mode(config.get("mode"))
+
+    pump_allowed = is_pump_allowed(level, pump_running, threshold)
+    pump_desired = is_pump_desired(config, log_file_path_abs, now)
+    return threshold, pump_allowed, pump_desired
+
+
 def is_pump_allowed(level, pump_running, threshold):
     """Determine if pump operation is allowed based on tank level"""
     pump_allowed = pump_running
@@ -412,19 +754,19 @@ def is_pump_allowed(level, pump_running, threshold):
 
 
 # TODO: Write logic here. Ultimately use WSGI / Django???
-def is_pump_desired(manctl_filepath, schedule_filepath, timer_filepath, log_file_path_abs):
+def is_pump_desired(config, log_file_path_abs, now=None):
     """Determine if pump operation is desired based on active control mode"""
     global control_mode
     if control_mode == ControlMode.MANUAL:
-        # read from file
-        pump_desired = read_pump_on_off(manctl_filepath, log_file_path_abs)
+        # read from (cached) file
+        pump_desired = config.get("manual_pump_on")
     elif control_mode == ControlMode.SCHEDULED:
-        # read schedule from file and compare current weekday and time with schedule
+        # compare current weekday and time with the cached schedule and calendar
         # TODO: Add logging path and logging functionality to scheduler
-        pump_desired = pump_scheduler.is_pump_desired(schedule_filepath)
+        pump_desired = pump_scheduler.is_pump_desired_from_schedule(get_schedule(config), now)
     elif control_mode == ControlMode.TIMED:
-        # read timer end time from file and compare current time with end time
-        pump_desired = pump_timer.is_pump_desired(timer_filepath, log_file_path_abs)
+        # compare current time with the cached timer end time
+        pump_desired = pump_timer.is_pump_desired_from_end_time(config.get("timer_end_time"), now)
     else:
         raise Exception("[CRITICAL] Something went terribly wrong. Pump should be turned off now.\n"
                         "Exact Reason: current control mode not recognized.")
@@ -432,6 +774,39 @@ def is_pump_desired(manctl_filepath, schedule_filepath, timer_filepath, log_file
     return pump_desired
 
 
+def get_schedule(config):
+    """The weekly schedule with the calendar exceptions (calendar.csv) on top; only rebuilt when either changed"""
+    return schedule_calendar.layer_calendar(config.get("schedule"), config.get("calendar"))
+
+
+def get_next_deadline(config):
+    """Unix timestamp at which the desired pump state changes on its own in the active control mode, or None"""
+    if control_mode == ControlMode.SCHEDULED:
+        transition = get_schedule(config).next_transition(clock.now())
+        if transition is not None:
+            logger.debug("Next schedule transition: pump %s at %s", "ON" if transition.pump_desired else "OFF",
+                         transition.time)
+            return transition.time.timestamp()
+    elif control_mode == ControlMode.TIMED:
+        timer_end_time = config.get("timer_end_time")
+        if timer_end_time > clock.time():
+            return timer_end_time
+    return None
+
+
+def get_trend_deadline(trend, pump_running):
+    """Unix timestamp at which the level is predicted to cross the threshold that matters next, or None:
+    the lower threshold while pumping, the upper one (pump allowed again) while not"""
+    if pump_running:
+        return trend.threshold_time
+    return trend.upper_threshold_time
+
+
+def earliest_deadline(*deadlines):
+    deadlines = [deadline for deadline in deadlines if deadline is not None]
+    return min(deadlines) if deadlines else None
+
+
 def switch_mode(desired_mode):
     global control_mode
     old_mode = control_mode
@@ -439,10 +814,10 @@ def switch_mode(desired_mode):
     if old_mode != desired_mode:
         if isinstance(desired_mode, ControlMode):
             control_mode = desired_mode
-            print("[INFO] Mode switched from {} to {}".format(old_mode, control_mode))
+            logger.info("Mode switched from %s to %s", old_mode, control_mode)
             return True
         else:
-            print("[WARNING] Desired mode not recognized. Not switching.")
+            logger.warning("Desired mode not recognized. Not switching.")
 
     return False
 
@@ -0,0 +1,367 @@
+#!/usr/bin/python
+# Use Python 3
+
+# Pumpcontrol - asyncio runtime
+# Same control logic as pumpcontrol.main(), but sensing, the control decision, persistence and the upload to
+# Thingspeak run as separate tasks. Blocking work (GPIO probing, disk and network I/O) runs in worker threads,
+# so a slow SD card or a flaky WiFi link can never delay the control decision by more than control_period.
+
+import os
+import sys
+import time
+import argparse
+import asyncio
+import traceback
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pumpcontrol
+from pumpcontrol import print_and_log, get_timestamp_s, pump_state_textual
+from level_sensor import AdaptiveLevelReader
+from level_trend import LevelTrendEstimator, trend_textual, write_trend_file
+
+
+# Parameters ###########################################################################################################
+
+# Maximum time between two control decisions, in seconds (Default = 1); bounds the reaction time of the control task
+control_period = 1.0
+# Turn the pump off if the latest level reading is older than this, in seconds (Default = 3 sleep cycles)
+max_level_age = 3 * pumpcontrol.sleep_time
+# Maximum number of pending CSV records for persistence and upload each; the oldest record is dropped when full
+queue_size = 100
+# Interval at which the config files are checked for changes when inotify is not available, in seconds (Default = 5)
+config_poll_interval = 5
+# Interval for latency reports in latency measuring mode, in seconds (Default = 300)
+latency_report_interval = 300
+# Interval at which the event loop lag is sampled in latency measuring mode, in seconds (Default = 0.1)
+loop_lag_sample_interval = 0.1
+
+########################################################################################################################
+
+
+class LatencyStats:
+    """Running count, mean and maximum of a latency, in seconds"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def textual(self):
+        mean = self.total / self.count if self.count else 0.0
+        return "{}: n={}, mean={:.1f} ms, max={:.1f} ms".format(self.name, self.count, mean * 1000, self.max * 1000)
+
+
+# Put an item into a bounded queue without ever waiting, dropping the oldest item if the queue is full
+def put_dropping_oldest(queue, item):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
+
+
+class ControlDaemon:
+    """Runs the sense, control, persist and upload tasks on one asyncio event loop"""
+
+    def __init__(self, devices, config, log_file_path_abs, csv_writer, measure_latency=False,
+                 uploader=None, telemetry_writers=(), trend_filepath=None):
+        self.pump, self.status_led, self.seed_voltage, self.level_reader = devices
+        # The watchdog owns the pump output, the daemon only asks it to switch
+        self.watchdog = pumpcontrol.create_safety_watchdog(devices, log_file_path_abs)
+        self.config = config
+        self.uploader = uploader
+        self.log_file_path_abs = log_file_path_abs
+        self.csv_writer = csv_writer
+        self.telemetry_writers = telemetry_writers
+        self.trend_filepath = trend_filepath  # level trend file for the web UI (None = do not write it)
+        self.measure_latency = measure_latency
+
+        self.level = None
+        self.level_time = None  # monotonic time of the latest level reading
+        self.level_fault = None  # level_sensor fault class of the latest level reading
+        self.pump_running = False
+        self.level_trend = LevelTrendEstimator(pumpcontrol.trend_window, pumpcontrol.trend_min_span)
+        self._recorded_level_time = None
+        self._log_level_version = None
+
+        self._loop = None
+        self._config_request = None
+        self._control_request = None
+        self._control_request_time = None
+        self._sense_request = None
+        self._persist_queue = None
+        self._upload_queue = None
+
+        # One worker thread each, so that a hanging upload cannot block persistence and vice versa
+        self._config_executor = ThreadPoolExecutor(max_workers=1)
+        self._sense_executor = ThreadPoolExecutor(max_workers=1)
+        self._persist_executor = ThreadPoolExecutor(max_workers=1)
+        self._upload_executor = ThreadPoolExecutor(max_workers=1)
+
+        self.latency = {name: LatencyStats(name)
+                        for name in ("sense", "control", "reaction", "persist", "upload", "loop lag")}
+
+    # Helpers ##########################################################################################################
+
+    def log(self, message):
+        """Log a message; never blocks, the log file is written by the logging_setup writer thread"""
+        print_and_log(message)
+
+    def request_control(self):
+        """Wake up the control task; must be called from the event loop thread"""
+        if not self._control_request.is_set():
+            self._control_request_time = time.monotonic()
+            self._control_request.set()
+
+    def request_sense(self):
+        self._sense_request.set()
+
+    def _record_latency(self, name, seconds):
+        if self.measure_latency:
+            self.latency[name].record(seconds)
+
+    def _on_config_changed(self):
+        # Drain the inotify descriptor right away (a non-blocking read), so that it stops being readable; the files
+        # themselves are reloaded by the config task in a worker thread
+        if self.config.collect_changes():
+            self._config_request.set()
+
+    # Tasks ############################################################################################################
+
+    async def config_task(self):
+        """Reload changed config files in a worker thread, on inotify events or, without inotify, every
+        config_poll_interval seconds, and wake up the control task if anything changed"""
+        poll_interval = config_poll_interval if self.config.fileno() is None else None
+        while True:
+            try:
+                await asyncio.wait_for(self._config_request.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._config_request.clear()
+            if await self._loop.run_in_executor(self._config_executor, self.config.refresh):
+                pumpcontrol.logger.debug("Config changed, now at version %s", self.config.version)
+                self.request_control()
+
+    async def sense_task(self):
+        """Probe the level pins every sleep_time seconds, or earlier when the watchdog sees the level change"""
+        while True:
+            start = time.monotonic()
+            level_decoding = await self._loop.run_in_executor(self._sense_executor, self.watchdog.read_level)
+            self.level = level_decoding.level
+            self.level_fault = level_decoding.fault
+            self.level_time = time.monotonic()
+            self._record_latency("sense", self.level_time - start)
+            self.request_control()
+
+            self._sense_request.clear()
+            try:
+                await asyncio.wait_for(self._sense_request.wait(), pumpcontrol.sleep_time)
+                await asyncio.sleep(pumpcontrol.min_cycle_time)  # let bouncing pins settle
+            except asyncio.TimeoutError:
+                pass
+
+    async def control_task(self):
+        """Decide on the pump state on every request, but at least every control_period seconds"""
+        while True:
+            try:
+                await asyncio.wait_for(self._control_request.wait(), control_period)
+            except asyncio.TimeoutError:
+                pass
+            start = time.monotonic()
+            if self._control_request.is_set():
+                self._record_latency("reaction", start - self._control_request_time)
+                self._control_request.clear()
+
+            self.control_once()
+            self._record_latency("control", time.monotonic() - start)
+
+    def control_once(self):
+        """Make one control decision. Runs on the event loop, so it must not do any blocking I/O."""
+        self.watchdog.heartbeat()
+        self._log_level_version = pumpcontrol.update_log_level(self.config, self._log_level_version)
+
+        threshold = self.config.get("threshold")
+        self.watchdog.set_threshold(threshold)
+        pumpcontrol.switch_mode(self.config.get("mode"))
+
+        level_fresh = self.level is not None and time.monotonic() - self.level_time <= max_level_age
+        if level_fresh:
+            pump_allowed = pumpcontrol.is_pump_allowed(self.level, self.pump_running, threshold)
+        else:
+            pump_allowed = False  # no recent level reading, fail safe
+        pump_desired = pumpcontrol.is_pump_desired(self.config, self.log_file_path_abs)
+
+        pump_running_before = self.pump_running
+        pump_running = self.watchdog.request_pump(pump_allowed and pump_desired)
+        self.pump_running = pump_running
+
+        # Persist and upload every level reading once, together with the resulting pump state
+        if level_fresh and self.level_time != self._recorded_level_time:
+            self._recorded_level_time = self.level_time
+            self.level_trend.add(time.time(), self.level, pump_running_before)
+            trend = self.level_trend.predict(threshold, pumpcontrol.threshold_delta)
+            pumpcontrol.logger.info("Current state: Level: %s%% | Threshold: %s | Pump: [ALLOWED: %s, DESIRED: %s, "
+                                    "RUNNING: %s]", self.level * 100, threshold, pump_allowed, pump_desired,
+                                    pump_state_textual(pump_running))
+            pumpcontrol.logger.info("Level trend: %s", trend_textual(trend))
+            record = (get_timestamp_s(), self.level, int(pump_running), time.time(),
+                      pumpcontrol.telemetry_flags(pump_allowed, pump_desired, self.level_fault), trend, threshold)
+            put_dropping_oldest(self._persist_queue, record)
+            put_dropping_oldest(self._upload_queue, record)
+
+    async def persist_task(self):
+        """Write CSV and telemetry records in a worker thread"""
+        while True:
+            record = await self._persist_queue.get()
+            start = time.monotonic()
+            await self._loop.run_in_executor(self._persist_executor, self.persist, record)
+            self._record_latency("persist", time.monotonic() - start)
+
+    def persist(self, record):
+        timestamp, level, pump_state, timestamp_unix, flags, trend, threshold = record
+        self.csv_writer.write_line("{};{};{}".format(timestamp, level, pump_state))
+        for telemetry_writer in self.telemetry_writers:
+            telemetry_writer.append(timestamp_unix, level, pump_state, flags)
+        if self.trend_filepath is not None:
+            try:
+                write_trend_file(self.trend_filepath, trend, level, threshold, pumpcontrol.threshold_delta)
+            except OSError as e:
+                pumpcontrol.logger.warning("Could not write level trend file. Error: %s", e)
+
+    async def upload_task(self):
+        """Send records to Thingspeak in a worker thread, or hand them to the batching uploader"""
+        while True:
+            timestamp, level, pump_state = (await self._upload_queue.get())[:3]
+            start = time.monotonic()
+            if self.uploader is not None:
+                if not self.uploader.submit(level * 100, pump_state):
+                    self.log("[WARNING] Thingspeak upload queue is full, dropping sample")
+                continue
+            await self._loop.run_in_executor(self._upload_executor, pumpcontrol.send_data_to_thingspeak,
+                                             pumpcontrol.THINGSPEAKURL, pumpcontrol.THINGSPEAKKEY,
+                                             level * 100, pump_state, self.log_file_path_abs)
+            self._record_latency("upload", time.monotonic() - start)
+
+    async def latency_task(self):
+        """Sample the event loop lag and report all latencies periodically"""
+        next_report = time.monotonic() + latency_report_interval
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(loop_lag_sample_interval)
+            now = time.monotonic()
+            self._record_latency("loop lag", now - before - loop_lag_sample_interval)
+            if now >= next_report:
+                self.log_latency_report()
+                next_report = now + latency_report_interval
+
+    def log_latency_report(self):
+        for stats in self.latency.values():
+            self.log("[INFO] Latency {}".format(stats.textual()))
+        for endpoint, stats in pumpcontrol.thingspeak_connections.stats().items():
+            self.log("[INFO] Connection {}: {}".format(endpoint, stats))
+        self.watchdog.log_report()
+        if isinstance(self.level_reader, AdaptiveLevelReader):
+            self.log("[INFO] Adaptive probing: {}".format(self.level_reader.stats()))
+
+    # Runtime ##########################################################################################################
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._config_request = asyncio.Event()
+        self._control_request = asyncio.Event()
+        self._sense_request = asyncio.Event()
+        self._persist_queue = asyncio.Queue(queue_size)
+        self._upload_queue = asyncio.Queue(queue_size)
+
+        # Load all config files before the first decision, so that control_once never reads a file itself
+        await self._loop.run_in_executor(self._config_executor, self.config.refresh)
+        if self.config.fileno() is not None:
+            self._loop.add_reader(self.config.fileno(), self._on_config_changed)
+        self.watchdog.on_level_change = lambda level: self._loop.call_soon_threadsafe(self.request_sense)
+        self.watchdog.start()
+
+        tasks = [self.config_task(), self.sense_task(), self.control_task(), self.persist_task(), self.upload_task()]
+        if self.measure_latency:
+            tasks.append(self.latency_task())
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            if self.config.fileno() is not None:
+                self._loop.remove_reader(self.config.fileno())
+            self.watchdog.stop(5)
+            self.pump_running = False
+            if self.measure_latency:
+                for stats in self.latency.values():
+                    print_and_log("[INFO] Latency {}".format(stats.textual()), self.log_file_path_abs)
+
+    def shutdown(self):
+        for executor in (self._config_executor, self._sense_executor, self._persist_executor, self._upload_executor):
+            executor.shutdown(wait=False)
+
+
+# MAIN FUNCTION ########################################################################################################
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pumpcontrol asyncio daemon")
+    parser.add_argument("--measure-latency", action="store_true",
+                        help="measure per-task latencies and report them every {} seconds and on exit"
+                        .format(latency_report_interval))
+    args = parser.parse_args(argv)
+
+    my_path = os.path.abspath(os.path.dirname(pumpcontrol.__file__))
+    log_file_path_abs, csv_writer, compressor = pumpcontrol.setup_log_files(my_path)
+    print_and_log("[INFO] Starting pumpcontrol service (asyncio)", log_file_path_abs)
+    telemetry_writers = pumpcontrol.create_telemetry_writers(my_path)
+
+    pumpcontrol.increase_stack_size(log_file_path_abs)
+
+    devices = pumpcontrol.create_devices(log_file_path_abs)
+    if devices is None:
+        return 1
+
+    pumpcontrol.load_thingspeak_key(my_path, log_file_path_abs)
+    uploader = pumpcontrol.create_thingspeak_uploader(my_path, log_file_path_abs)
+
+    config = pumpcontrol.create_config_store(my_path, log_file_path_abs)
+
+    daemon = ControlDaemon(devices, config, log_file_path_abs, csv_writer, args.measure_latency, uploader,
+                           telemetry_writers,
+                           os.path.join(my_path, pumpcontrol.telemetry_path, pumpcontrol.trend_file_name))
+
+    # Heartbeat
+    daemon.status_led.blink()
+
+    try:
+        asyncio.run(daemon.run())
+    except KeyboardInterrupt:
+        print_and_log("[INFO] Terminating...", log_file_path_abs)
+    except Exception:
+        print_and_log("[ERROR] An unknown error occurred! Exiting...", log_file_path_abs)
+        print_and_log(traceback.format_exc(), log_file_path_abs)
+        raise
+    finally:
+        daemon.shutdown()
+        config.close()
+        if uploader is not None:
+            uploader.stop(5)  # spool what has not been sent yet
+        for telemetry_writer in telemetry_writers:
+            telemetry_writer.close()
+        pumpcontrol.close_log_files(csv_writer, compressor)
+
+    print("Done.")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logger = logging.getLogger()
+    try:
+        sys.exit(main())
+    except Exception as e:
+        logger.exception("Main crashed: %s\n%s", e, traceback.format_exc())
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# Use Python 3
+
+# Pumpcontrol - replay runtime
+# Runs pumpcontrol's control decision (level decoding, hysteresis, schedule/timer/manual mode) over recorded levels
+# from CSV files or the telemetry store, on mock devices and as fast as possible, so the control logic can be
+# benchmarked and regression-tested on any Linux box. The recorded pump state is compared with the replayed one.
+#
+# Example: python3 pumpcontrol_replay.py logs/ --mode SCHEDULED --threshold 30
+
+import os
+import sys
+import time
+import argparse
+import logging
+from datetime import datetime
+
+import pumpcontrol
+from pumpcontrol import ControlMode
+from backends import create_replay_devices, load_replay_samples
+
+
+class OverriddenConfig:
+    """Config store view that returns fixed values for some names"""
+
+    def __init__(self, config, overrides):
+        self.config = config
+        self.overrides = overrides
+
+    def get(self, name):
+        if name in self.overrides:
+            return self.overrides[name]
+        return self.config.get(name)
+
+
+def run_replay(samples, config, pin_count, speed=None):
+    """Replay samples (time, level, pump) through the control decision; returns a dict of results"""
+    devices = create_replay_devices(samples, pin_count)
+    pump, status_led, seed_voltage, level_reader = devices
+
+    pump_running = False
+    mismatches = 0
+    pump_on_seconds = 0.0
+    start = time.monotonic()
+    for sample_i, (timestamp, recorded_level, recorded_pump) in enumerate(samples):
+        if sample_i:
+            interval = timestamp - samples[sample_i - 1][0]
+            if pump_running:
+                pump_on_seconds += interval
+            if speed:
+                time.sleep(interval / speed)
+
+        level_reader.seek(sample_i)
+        decoding = pumpcontrol.read_tank_level_decoded(level_reader, seed_voltage, None, verbose=False)
+        threshold, pump_allowed, pump_desired = pumpcontrol.decide_pump(decoding.level, pump_running, config, None,
+                                                                        datetime.fromtimestamp(timestamp))
+        if pump_allowed and pump_desired:
+            pump.on()
+        else:
+            pump.off()
+        pump_running = pump.is_active
+        if int(pump_running) != recorded_pump:
+            mismatches += 1
+    duration = time.monotonic() - start
+
+    span = samples[-1][0] - samples[0][0] if samples else 0
+    return {
+        "cycles": len(samples),
+        "duration": duration,
+        "cycles_per_second": len(samples) / duration if duration > 0 else 0.0,
+        "replayed_seconds": span,
+        "speedup": span / duration if duration > 0 else 0.0,
+        "pump_starts": pump.switch_count,
+        "pump_on_seconds": pump_on_seconds,
+        "mismatches": mismatches,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded levels through pumpcontrol's control logic")
+    parser.add_argument("paths", nargs="+", help="CSV files (.csv, .csv.gz), log directories, or telemetry directories")
+    parser.add_argument("--program-dir", default=os.path.abspath(os.path.dirname(pumpcontrol.__file__)),
+                        help="directory containing the cfg directory (Default = pumpcontrol's directory)")
+    parser.add_argument("--mode", choices=[mode.value for mode in ControlMode], help="override the control mode")
+    parser.add_argument("--threshold", type=int, help="override the threshold, in percent")
+    parser.add_argument("--manual-on", type=int, choices=[0, 1], help="override the manual pump state")
+    parser.add_argument("--speed", type=float, help="replay at this multiple of real time (Default = as fast as "
+                                                    "possible)")
+    parser.add_argument("--verbose", action="store_true", help="log every control decision")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format="[%(levelname)s] %(message)s")
+
+    samples = load_replay_samples(args.paths)
+    if not samples:
+        print("No samples found in {}".format(", ".join(args.paths)))
+        return 1
+
+    overrides = {}
+    if args.mode is not None:
+        overrides["mode"] = ControlMode(args.mode)
+    if args.threshold is not None:
+        overrides["threshold"] = args.threshold
+    if args.manual_on is not None:
+        overrides["manual_pump_on"] = bool(args.manual_on)
+    config = OverriddenConfig(pumpcontrol.create_config_store(args.program_dir, None), overrides)
+
+    results = run_replay(samples, config, len(pumpcontrol.LVL_PIN_NO_ARRAY), args.speed)
+    print("Replayed {} cycles ({} to {}) in {:.3f} s: {:.0f} cycles/s, {:.0f}x real time".format(
+        results["cycles"], datetime.fromtimestamp(samples[0][0]), datetime.fromtimestamp(samples[-1][0]),
+        results["duration"], results["cycles_per_second"], results["speedup"]))
+    print("Pump starts: {}, pump on: {:.0f} min, cycles with a different pump state than recorded: {}".format(
+        results["pump_starts"], results["pump_on_seconds"] / 60, results["mismatches"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+# Use Python 3
+
+import os
+import time
+import logging
+import threading
+
+"""Safety supervisor for the pump.
+
+The SafetyWatchdog thread is the only code that switches the pump output. It probes the level pins on its own,
+every sample_interval seconds, and turns the pump off as soon as the level is below the threshold, the level
+cannot be read, or the control loop has not called heartbeat() for heartbeat_timeout seconds - no matter what the
+control loop is busy with (config reads, CSV writes, a hanging Thingspeak request). The control loop asks for
+the pump with request_pump(), which refuses to turn it on while any of these conditions hold.
+
+Reaction time is bounded by the time between two samples plus the time for one probe and decision. Both are
+measured; stats() reports the worst case observed so far as worst_case_reaction_time. Cycles with a failed probe
+are left out of it: they turn the pump off as sensor trips of their own, whose reaction time is measured from the
+moment the last valid reading went stale (max_sensor_trip_reaction_time).
+"""
+
+logger = logging.getLogger(__name__)
+
+# Kinds of trips, see SafetyWatchdog._unsafe_reason
+TRIP_LEVEL = "level"          # level below the threshold
+TRIP_SENSOR = "sensor"        # level unknown or reading too old
+TRIP_HEARTBEAT = "heartbeat"  # no heartbeat from the control loop
+
+
+class SafetyWatchdog:
+    """Thread that owns the pump output and turns it off on low level or a missed heartbeat"""
+
+    def __init__(self, pump, read_level, threshold, sample_interval=1.0, heartbeat_timeout=90.0,
+                 report_interval=3600.0, priority=None, on_level_change=None):
+        self.pump = pump
+        self.sample_interval = sample_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.report_interval = report_interval
+        self.priority = priority  # SCHED_FIFO priority for the thread, needs root (None = normal scheduling)
+        self.on_level_change = on_level_change  # called from the watchdog thread with the new level
+
+        self._read_level = read_level  # read_level(verbose) -> level_sensor.LevelDecoding
+        self._threshold = threshold
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self._pump_on = False
+        self._level = None
+        self._level_time = None  # time of the last reading with a level
+        self._last_heartbeat = time.monotonic()
+
+        self.samples = 0
+        self.level_trips = 0
+        self.sensor_trips = 0
+        self.heartbeat_trips = 0
+        self.probe_errors = 0
+        self.sensor_faults = 0  # inconsistent pin patterns
+        self.max_sample_interval = 0.0
+        self.max_decision_time = 0.0
+        self.max_trip_reaction_time = 0.0
+        self.max_sensor_trip_reaction_time = 0.0
+
+        self.pump.off()
+
+    # Interface for the control loop ###################################################################################
+
+    def start(self):
+        self._last_heartbeat = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="safety-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop supervising and turn the pump off"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            self._switch(False)
+        self.log_report()
+
+    def heartbeat(self):
+        """Tell the watchdog that the control loop is alive; call this on every cycle"""
+        with self._lock:
+            self._last_heartbeat = time.monotonic()
+
+    def set_threshold(self, threshold):
+        """Minimum level in percent below which the pump is forced off"""
+        with self._lock:
+            self._threshold = threshold
+
+    def read_level(self):
+        """Probe the level pins now (in the caller's thread) and return the level_sensor.LevelDecoding"""
+        start = time.monotonic()
+        with self._probe_lock:
+            decoding = self._read_level(True)
+        self._record_level(decoding, start)
+        return decoding
+
+    def request_pump(self, pump_on):
+        """Turn the pump on or off as requested by the control loop, unless that is unsafe.
+        Returns the resulting pump state."""
+        with self._lock:
+            if pump_on:
+                unsafe = self._unsafe_reason(time.monotonic())
+                if unsafe is not None:
+                    if self._pump_on:
+                        self._switch(False)
+                    logger.warning("Safety watchdog refuses to turn the pump on: %s", unsafe[1])
+                    return False
+            self._switch(pump_on)
+            return self._pump_on
+
+    def pump_state(self):
+        with self._lock:
+            return self._pump_on
+
+    def stats(self):
+        with self._lock:
+            return {"samples": self.samples, "level_trips": self.level_trips, "sensor_trips": self.sensor_trips,
+                    "heartbeat_trips": self.heartbeat_trips, "probe_errors": self.probe_errors,
+                    "sensor_faults": self.sensor_faults,
+                    "max_sample_interval": self.max_sample_interval,
+                    "max_decision_time": self.max_decision_time,
+                    "max_trip_reaction_time": self.max_trip_reaction_time,
+                    "max_sensor_trip_reaction_time": self.max_sensor_trip_reaction_time,
+                    "worst_case_reaction_time": self.max_sample_interval + self.max_decision_time}
+
+    def log_report(self):
+        stats = self.stats()
+        logger.info("Safety watchdog: %s samples, worst-case reaction time %.3f s (max. sample interval %.3f s, "
+                    "max. decision time %.3f s), trips: %s level, %s sensor, %s heartbeat, %s probe errors, "
+                    "%s sensor faults, max. trip reaction time %.3f s (sensor trips %.3f s)", stats["samples"],
+                    stats["worst_case_reaction_time"], stats["max_sample_interval"], stats["max_decision_time"],
+                    stats["level_trips"], stats["sensor_trips"], stats["heartbeat_trips"], stats["probe_errors"],
+                    stats["sensor_faults"], stats["max_trip_reaction_time"], stats["max_sensor_trip_reaction_time"])
+
+    # Watchdog thread ##################################################################################################
+
+    def _run(self):
+        self._raise_priority()
+        next_sample = time.monotonic()
+        next_report = next_sample + self.report_interval
+        previous_start = None  # start of the previous cycle, None if there was none or its probe failed
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            if previous_start is not None:
+                self.max_sample_interval = max(self.max_sample_interval, start - previous_start)
+
+            with self._probe_lock:
+                try:
+                    decoding = self._read_level(False)
+                except Exception as e:
+                    logger.error("Safety watchdog could not read the level: %s", e)
+                    decoding = None
+            self._record_level(decoding, start)
+            self._check()
+            if decoding is not None:
+                self.max_decision_time = max(self.max_decision_time, time.monotonic() - start)
+            previous_start = start if decoding is not None else None
+
+            if start >= next_report:
+                self.log_report()
+                next_report = start + self.report_interval
+            next_sample += self.sample_interval
+            if next_sample < time.monotonic():
+                next_sample = time.monotonic()  # fell behind (e.g. system suspended), do not try to catch up
+            self._stop_event.wait(next_sample - time.monotonic())
+
+    def _raise_priority(self):
+        if self.priority is None:
+            return
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))  # 0 = this thread on Linux
+        except (AttributeError, OSError) as e:
+            logger.warning("Safety watchdog could not raise its priority, running with normal priority: %s", e)
+
+    def _record_level(self, decoding, sample_time):
+        level = decoding.level if decoding is not None else None
+        with self._lock:
+            changed = level != self._level
+            self._level = level
+            if level is not None:
+                self._level_time = sample_time
+            self.samples += 1
+            if decoding is None:
+                self.probe_errors += 1
+            elif not decoding.consistent:
+                self.sensor_faults += 1
+        if changed and self.on_level_change is not None:
+            self.on_level_change(level)
+
+    def _check(self):
+        with self._lock:
+            now = time.monotonic()
+            unsafe = self._unsafe_reason(now)
+            if unsafe is None or not self._pump_on:
+                return
+            kind, reason, unsafe_since = unsafe
+            self._switch(False)
+            reaction_time = max(time.monotonic() - unsafe_since, 0.0)
+            if kind == TRIP_SENSOR:
+                self.sensor_trips += 1
+                self.max_sensor_trip_reaction_time = max(self.max_sensor_trip_reaction_time, reaction_time)
+            else:
+                if kind == TRIP_HEARTBEAT:
+                    self.heartbeat_trips += 1
+                else:
+                    self.level_trips += 1
+                self.max_trip_reaction_time = max(self.max_trip_reaction_time, reaction_time)
+        logger.critical("Safety watchdog turned the pump OFF: %s (reaction time %.3f s)", reason, reaction_time)
+
+    # (trip kind, reason, monotonic time since when it is unsafe) if the pump must be off, None if it may run.
+    # A missing or stale level is unsafe from the moment the last reading went stale. Must be called with
+    # self._lock held.
+    def _unsafe_reason(self, now):
+        stale_since = self._level_time + 3 * self.sample_interval if self._level_time is not None else now
+        if self._level is None:
+            return TRIP_SENSOR, "level unknown", stale_since
+        if self._level * 100 < self._threshold:
+            return TRIP_LEVEL, "level {}% below threshold {}%".format(self._level * 100, self._threshold), \
+                self._level_time
+        if now > stale_since:
+            return TRIP_SENSOR, "level reading is {:.0f} s old".format(now - self._level_time), stale_since
+        if now - self._last_heartbeat > self.heartbeat_timeout:
+            return TRIP_HEARTBEAT, "no heartbeat from the control loop for {:.0f} s".format(
+                now - self._last_heartbeat), self._last_heartbeat + self.heartbeat_timeout
+        return None
+
+    # Must be called with self._lock held
+    def _switch(self, pump_on):
+        if pump_on == self._pump_on:
+            return
+        if pump_on:
+            self.pump.on()  # Pump is ON when LOW
+        else:
+            self.pump.off()  # Pump is OFF when HIGH
+        self._pump_on = pump_on
+        logger.info("Turning Pump %s", "ON" if pump_on else "OFF")
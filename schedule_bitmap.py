@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# Use Python 3
+
+import pump_scheduler
+from pump_scheduler import MINUTES_PER_DAY, MINUTES_PER_WEEK, DAY_NAMES, minute_of_week, format_time_of_day, \
+    compile_schedule
+
+"""Weekly schedules as 10080-bit bitmaps, one bit per minute of the week (bit 0 = Monday 00:00).
+
+The bits are packed into one Python integer, so a lookup is a shift and a mask, and union (|), intersection (&),
+difference (-), symmetric difference (^) and complement (~) of whole weeks run over the packed machine words in
+C: combining the pump schedule with blackout, tariff or maintenance windows costs a few word operations per
+policy, whatever the number of windows.
+
+    allowed = ScheduleBitmap.from_file("cfg/schedule.csv") - ScheduleBitmap.from_file("cfg/blackout.csv")
+    allowed.is_desired(now)
+    pump_scheduler.schedule_textual_vertically(allowed.to_rows())
+
+to_rows() converts back to schedule.csv rows (windows split at midnight), to_schedule() to a CompiledSchedule
+for next_transition() and transitions_between().
+"""
+
+
+WEEK_MASK = (1 << MINUTES_PER_WEEK) - 1
+
+
+class ScheduleBitmap:
+    """Set of minutes of the week"""
+
+    __slots__ = ("bits",)
+
+    def __init__(self, bits=0):
+        self.bits = bits & WEEK_MASK
+
+    # Construction #####################################################################################################
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        """From (start, end) minute-of-week intervals, end excluded; intervals may wrap around the end of the week"""
+        bits = 0
+        for start, end in intervals:
+            if end < start:
+                bits |= ((1 << (MINUTES_PER_WEEK - start)) - 1) << start
+                start = 0
+            bits |= ((1 << (end - start)) - 1) << start
+        return cls(bits)
+
+    @classmethod
+    def from_schedule(cls, schedule):
+        """From a CompiledSchedule or schedule rows"""
+        if not isinstance(schedule, pump_scheduler.CompiledSchedule):
+            schedule = compile_schedule(schedule)
+        return cls.from_intervals(zip(schedule.starts, schedule.ends))
+
+    @classmethod
+    def from_file(cls, schedule_filepath):
+        """From a schedule CSV file (compiled and cached by pump_scheduler.read_schedule)"""
+        return cls.from_schedule(pump_scheduler.read_schedule(schedule_filepath))
+
+    # Lookup ###########################################################################################################
+
+    def is_desired_at_minute(self, minute):
+        return bool(self.bits >> minute & 1)
+
+    def is_desired(self, now=None):
+        """True if now (datetime, Default = the current time) is in the set"""
+        if now is None:
+            now = pump_scheduler.clock.now()
+        return bool(self.bits >> minute_of_week(now) & 1)
+
+    def minutes(self):
+        """Number of minutes in the set"""
+        return bin(self.bits).count("1")
+
+    # Set algebra ######################################################################################################
+
+    def __or__(self, other):
+        return ScheduleBitmap(self.bits | other.bits)
+
+    def __and__(self, other):
+        return ScheduleBitmap(self.bits & other.bits)
+
+    def __sub__(self, other):
+        return ScheduleBitmap(self.bits & ~other.bits)
+
+    def __xor__(self, other):
+        return ScheduleBitmap(self.bits ^ other.bits)
+
+    def __invert__(self):
+        return ScheduleBitmap(~self.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, ScheduleBitmap) and self.bits == other.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __repr__(self):
+        return "ScheduleBitmap({} minutes in {} windows)".format(self.minutes(), len(self.intervals()))
+
+    # Conversion #######################################################################################################
+
+    def intervals(self):
+        """Runs of set minutes as (start, end) minute-of-week intervals, end excluded, in order"""
+        result = []
+        bits = self.bits
+        offset = 0
+        while bits:
+            # Skip the clear bits below the run, then measure the run of set bits
+            zeros = (bits & -bits).bit_length() - 1
+            bits >>= zeros
+            offset += zeros
+            ones = (~bits & (bits + 1)).bit_length() - 1
+            result.append((offset, offset + ones))
+            bits >>= ones
+            offset += ones
+        return result
+
+    def to_rows(self):
+        """Rows of schedule.csv, Monday first; windows across midnight are split, with "24:00" as end time"""
+        rows = [[day_name] for day_name in DAY_NAMES]
+        for start, end in self.intervals():
+            while start < end:
+                day_i = start // MINUTES_PER_DAY
+                day_end = min(end, (day_i + 1) * MINUTES_PER_DAY)
+                rows[day_i] += [format_time_of_day(start - day_i * MINUTES_PER_DAY),
+                                format_time_of_day(day_end - day_i * MINUTES_PER_DAY)]
+                start = day_end
+        return rows
+
+    def to_schedule(self):
+        """CompiledSchedule with the same windows"""
+        return compile_schedule(self.to_rows())
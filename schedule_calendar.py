@@ -0,0 +1,326 @@
+#!/usr/bin/python
+# Use Python 3
+
+import os
+import csv
+import heapq
+import logging
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pump_scheduler
+from pump_scheduler import MINUTES_PER_DAY, ScheduleDiagnostic, Transition, parse_time_of_day
+
+logger = logging.getLogger(__name__)
+
+"""Dated exceptions layered over the weekly schedule: holidays, vacations, one-off date ranges.
+
+calendar.csv (optional, no header) has one rule per row, "#" starts a comment row:
+
+    2026-12-24,2026-12-26,off                    pump not desired on these days (end date included)
+    2026-08-01 06:00,2026-08-03 18:00,on         pump desired from ... until ... (end time excluded)
+    2026-07-01,2026-07-14,windows,08:00,12:00,22:00,02:00
+                                                 on each of these days, these windows instead of the weekly ones
+
+Windows may run past midnight (start after end), like in schedule.csv. Where rules overlap, the later row wins;
+where no rule applies, the weekly schedule does.
+
+The rules are flattened once into a timeline: sorted breakpoints, each with the override that applies from there
+on (desired, not desired, or None = follow the weekly schedule). A point query is one binary search on the
+timeline plus at most one lookup in the weekly schedule, so it stays logarithmic with thousands of rules, e.g. a
+year-long calendar imported from elsewhere. CalendarSchedule answers is_desired(), next_transition() and
+transitions_between() like pump_scheduler.CompiledSchedule and can be used wherever that is.
+"""
+
+ACTIONS = ("on", "off", "windows")
+
+# A row of calendar.csv: start and end (datetimes, end excluded), action, windows as (start, end) minutes of the
+# day (only for "windows") and the line number in the file
+CalendarRule = namedtuple("CalendarRule", ["start", "end", "action", "windows", "line"])
+
+
+# Datetime from "YYYY-MM-DD" or "YYYY-MM-DD HH:MM"; True as second value if only a date was given
+def parse_date_or_datetime(text):
+    text = text.strip()
+    try:
+        return datetime.strptime(text, "%Y-%m-%d"), True
+    except ValueError:
+        return datetime.strptime(text, "%Y-%m-%d %H:%M"), False
+
+
+class CalendarError(pump_scheduler.ScheduleError):
+    """Invalid calendar; errors holds a ScheduleDiagnostic (row = line in the file) for every problem found"""
+
+    def __init__(self, errors, filepath=None):
+        super().__init__(errors, filepath or "calendar")
+
+
+def parse_rule(row, line=None):
+    """CalendarRule from a row of calendar.csv; raises a CalendarError listing every problem if it is inconsistent"""
+    rule, errors = _check_rule(row, line)
+    if errors:
+        raise CalendarError(errors)
+    return rule
+
+
+# CalendarRule from a row (None if inconsistent) and the ScheduleDiagnostics of all problems found
+def _check_rule(row, line):
+    errors = []
+
+    def error(column, message):
+        errors.append(ScheduleDiagnostic(line, column, "Inconsistent calendar: " + message))
+
+    if len(row) < 3:
+        error(max(len(row), 1), "A rule needs a start, an end and an action.")
+        return None, errors
+    try:
+        start, start_is_date = parse_date_or_datetime(row[0])
+    except ValueError as err:
+        error(1, "{}.".format(err))
+        start = None
+    try:
+        end, end_is_date = parse_date_or_datetime(row[1])
+        if end_is_date:
+            end += timedelta(days=1)  # end date included
+    except ValueError as err:
+        error(2, "{}.".format(err))
+        end = None
+
+    action = row[2].strip().lower()
+    if action not in ACTIONS:
+        error(3, "Unknown action {!r}, expected one of {}.".format(row[2], ", ".join(ACTIONS)))
+    if start is not None and end is not None and end <= start:
+        error(2, "End of a rule cannot be before its start.")
+
+    windows = []
+    # Non-empty time cells as (column, text)
+    times = [(column, cell) for column, cell in enumerate(row[3:], 4) if cell.strip()]
+    if action == "windows":
+        if start is not None and end is not None and not (start_is_date and end_is_date):
+            error(1, "Windows can only be given for whole days.")
+        prev_window_end = None
+        for window_i in range(len(times) // 2):
+            window = []
+            for column, cell in times[2 * window_i:2 * window_i + 2]:
+                try:
+                    window.append(parse_time_of_day(cell))
+                except ValueError as err:
+                    error(column, "{}.".format(err))
+            if len(window) < 2:
+                prev_window_end = None
+                continue
+            window_start, window_end = window
+            if prev_window_end is not None and prev_window_end > window_start:
+                error(times[2 * window_i][0], "Consecutive windows cannot overlap. Found in window number {}."
+                      .format(window_i + 1))
+            prev_window_end = window_end if window_start <= window_end else MINUTES_PER_DAY + 1
+            if window_start != window_end:
+                windows.append((window_start, window_end))
+        if len(times) % 2:
+            error(times[-1][0], "A time window must have both start and end time.")
+    elif times and action in ACTIONS:
+        error(times[0][0], "Only \"windows\" rules take times.")
+
+    if errors:
+        return None, errors
+    return CalendarRule(start, end, action, windows, line), errors
+
+
+class CalendarSchedule:
+    """Weekly schedule with calendar rules on top"""
+
+    def __init__(self, weekly, rules):
+        self.weekly = weekly  # CompiledSchedule
+        self.rules = rules
+
+        # Overrides as (start, end, priority, desired); later rules get higher priorities
+        overrides = []
+        for rule_i, rule in enumerate(rules):
+            if rule.action == "windows":
+                # Nothing but the rule's windows on its days
+                overrides.append((rule.start, rule.end, 2 * rule_i, False))
+                day = rule.start
+                while day < rule.end:
+                    for window_start, window_end in rule.windows:
+                        if window_end < window_start:
+                            window_end += MINUTES_PER_DAY  # until the next day
+                        overrides.append((day + timedelta(minutes=window_start), day + timedelta(minutes=window_end),
+                                          2 * rule_i + 1, True))
+                    day += timedelta(days=1)
+            else:
+                overrides.append((rule.start, rule.end, 2 * rule_i, rule.action == "on"))
+
+        self.times, self.states = _flatten(overrides)
+
+    def override_at(self, now):
+        """True or False if a rule decides at now (datetime), None if the weekly schedule does"""
+        segment_i = bisect_right(self.times, now) - 1
+        return self.states[segment_i] if segment_i >= 0 else None
+
+    def is_desired(self, now=None):
+        """True if the pump is desired at now (datetime, Default = the current time)"""
+        if now is None:
+            now = pump_scheduler.clock.now()
+        state = self.override_at(now)
+        return self.weekly.is_desired(now) if state is None else state
+
+    def next_transition(self, now=None):
+        """The first Transition after now (datetime, Default = the current time), or None if there is none"""
+        if now is None:
+            now = pump_scheduler.clock.now()
+        desired = self.is_desired(now)
+        segment_i = bisect_right(self.times, now) - 1
+        segment_start = now
+        while True:
+            segment_end = self.times[segment_i + 1] if segment_i + 1 < len(self.times) else None
+            if segment_i < 0 or self.states[segment_i] is None:
+                transition = self.weekly.next_transition(segment_start)
+                if transition is not None and (segment_end is None or transition.time < segment_end):
+                    return transition
+            if segment_end is None:
+                return None
+            segment_i += 1
+            segment_start = segment_end
+            state = self.states[segment_i]
+            if state is None:
+                state = self.weekly.is_desired(segment_start)
+            if state != desired:
+                return Transition(segment_start, state)
+
+    def transitions_between(self, start, end):
+        """All Transitions with start <= time < end (datetimes), in order"""
+        transitions = []
+        desired = self.is_desired(start - timedelta(microseconds=1))
+        segment_i = bisect_right(self.times, start) - 1
+        segment_start = start
+        while segment_start < end:
+            segment_end = self.times[segment_i + 1] if segment_i + 1 < len(self.times) else end
+            segment_end = min(segment_end, end)
+            state = self.states[segment_i] if segment_i >= 0 else None
+            if state is None:
+                candidates = [Transition(segment_start, self.weekly.is_desired(segment_start))]
+                candidates += self.weekly.transitions_between(segment_start, segment_end)
+            else:
+                candidates = [Transition(segment_start, state)]
+            for transition in candidates:
+                if transition.pump_desired != desired:
+                    transitions.append(transition)
+                    desired = transition.pump_desired
+            segment_i += 1
+            segment_start = segment_end
+        return transitions
+
+    def desired_mask(self, timestamps):
+        """is_desired() for each of a sequence of unix timestamps, see pump_scheduler.desired_mask()"""
+        return pump_scheduler.desired_mask(self, timestamps)
+
+
+# Timeline of overrides (start, end, priority, desired): breakpoints in ascending order, and for each the state
+# from there until the next one (the highest priority override active, or None)
+def _flatten(overrides):
+    boundaries = {}
+    for override_i, (start, end, priority, desired) in enumerate(overrides):
+        boundaries.setdefault(start, []).append(override_i)
+        boundaries.setdefault(end, [])
+
+    times = []
+    states = []
+    active = []   # heap of (-priority, override index); ended ones are removed when they come up
+    for time in sorted(boundaries):
+        for override_i in boundaries[time]:
+            heapq.heappush(active, (-overrides[override_i][2], override_i))
+        while active and overrides[active[0][1]][1] <= time:
+            heapq.heappop(active)
+        state = overrides[active[0][1]][3] if active else None
+        if not states or states[-1] != state:
+            times.append(time)
+            states.append(state)
+    return times, states
+
+
+# Calendar rules by file path: (mtime in ns, size, rules)
+_calendar_cache = {}
+
+
+def read_calendar(calendar_filepath):
+    """Read the rules from calendar.csv; an empty list if there is no such file. Raises a CalendarError listing every
+    problem if the file is invalid. Cached like pump_scheduler.read_schedule, so the same list is returned while the
+    file is unchanged."""
+    try:
+        stat = os.stat(calendar_filepath)
+        cached = _calendar_cache.get(calendar_filepath)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        rules = []
+        errors = []
+        with open(calendar_filepath) as calendar_file:
+            for line, row in enumerate(csv.reader(calendar_file, delimiter=','), 1):
+                if not row or not "".join(row).strip() or row[0].lstrip().startswith("#"):
+                    continue
+                rule, row_errors = _check_rule(row, line)
+                rules.append(rule)
+                errors += row_errors
+        if errors:
+            raise CalendarError(errors, calendar_filepath)
+        logger.debug("Successfully read %s calendar rules from CSV.", len(rules))
+    except FileNotFoundError:
+        logger.debug("No calendar file, using the weekly schedule only.")
+        return []
+    except (IOError, OSError) as err:
+        logger.error("IOError: could not read calendar.csv. %s", err)
+        return []
+
+    _calendar_cache[calendar_filepath] = (stat.st_mtime_ns, stat.st_size, rules)
+    return rules
+
+
+# Last valid rules by file path, for read_valid_calendar
+_last_valid_calendars = {}
+
+
+def read_valid_calendar(calendar_filepath):
+    """Same as read_calendar, but never raises for an invalid file: the problem is logged and the last valid rules
+    of the file (or none) are returned until the file is fixed"""
+    try:
+        rules = read_calendar(calendar_filepath)
+    except (CalendarError, IOError, OSError) as err:
+        rules = _last_valid_calendars.get(calendar_filepath, [])
+        logger.error("Invalid calendar, %s:\n%s", "keeping the previous rules" if rules else
+                     "using the weekly schedule only", err)
+        return rules
+    _last_valid_calendars[calendar_filepath] = rules
+    return rules
+
+
+_layered = (None, None, None)  # (weekly, rules, CalendarSchedule) of the last layer_calendar call
+
+
+def layer_calendar(weekly, rules):
+    """CalendarSchedule of a weekly CompiledSchedule and calendar rules, or the weekly schedule itself if there are
+    no rules. Only rebuilt when either argument is a different object than in the last call."""
+    global _layered
+    if not rules:
+        return weekly
+    if _layered[0] is not weekly or _layered[1] is not rules:
+        _layered = (weekly, rules, CalendarSchedule(weekly, rules))
+    return _layered[2]
+
+
+def read_calendar_schedule(schedule_filepath, calendar_filepath):
+    """CalendarSchedule from schedule.csv and calendar.csv"""
+    return layer_calendar(pump_scheduler.read_schedule(schedule_filepath), read_calendar(calendar_filepath))
+
+
+def main():
+    schedule = read_calendar_schedule('cfg/schedule.csv', 'cfg/calendar.csv')
+    now = pump_scheduler.clock.now()
+    print(schedule.is_desired(now))
+    for transition in schedule.transitions_between(now, now + timedelta(days=7)):
+        print("{:%a %Y-%m-%d %H:%M} pump {}".format(transition.time, "ON" if transition.pump_desired else "OFF"))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/python
+# Use Python 3
+
+# Pumpcontrol - tank simulator
+# Runs pumpcontrol's control decision (is_pump_allowed, is_pump_desired with pump_scheduler and pump_timer) against
+# a simulated tank on a virtual clock: no water, no GPIO, no waiting. A month of 30 s cycles runs in seconds and
+# always gives the same result, which makes it the basis for benchmarks, for tuning threshold_delta, and for
+# catching regressions in the hysteresis logic.
+#
+# Example: python3 tank_simulator.py --days 30 --inflow 60 --pump-outflow 400 --mode SCHEDULED
+
+import os
+import sys
+import time
+import math
+import argparse
+import logging
+from datetime import datetime
+
+import pumpcontrol
+import pump_scheduler
+import schedule_calendar
+import pump_timer
+from pumpcontrol import ControlMode
+from backends import create_mock_devices
+from virtual_clock import VirtualClock
+
+
+class TankModel:
+    """Water tank with an inflow and a pump drawing from it. Volumes in litres, flows in litres per hour.
+    inflow is a number, a function of the (simulated) datetime, e.g. for rain or a daily pattern, or an
+    InflowProfile, whose changes are followed exactly by advance() and time_to_change()."""
+
+    def __init__(self, capacity=1000.0, inflow=100.0, pump_outflow=300.0, level=0.5):
+        self.capacity = capacity
+        self.inflow = inflow
+        self.pump_outflow = pump_outflow
+        self.volume = level * capacity
+
+        self.delivered = 0.0         # litres pumped out of the tank
+        self.overflowed = 0.0        # litres lost because the tank was full
+        self.dry_run_seconds = 0.0   # time the pump ran with the tank empty
+        self.min_level = level
+
+    @property
+    def level(self):
+        """Fill level [0.0-1.0]"""
+        return self.volume / self.capacity
+
+    def step(self, seconds, pump_on, now=None):
+        """Advance the tank by seconds with the pump on or off; inflow and outflow are constant within a step"""
+        self._flow(seconds, pump_on, self.inflow(now) if callable(self.inflow) else self.inflow)
+
+    def advance(self, seconds, pump_on, now):
+        """Advance the tank by seconds from now (datetime) with the pump on or off, following the inflow's changes"""
+        if not isinstance(self.inflow, InflowProfile):
+            self.step(seconds, pump_on, now)
+            return
+        timestamp = now.timestamp()
+        while seconds > 0:
+            inflow, piece = self.inflow.piece(timestamp)
+            piece = seconds if piece is None else min(piece, seconds)
+            self._flow(piece, pump_on, inflow)
+            seconds -= piece
+            timestamp += piece
+
+    def _flow(self, seconds, pump_on, inflow):
+        volume = self.volume + inflow * seconds / 3600.0
+        if pump_on:
+            demand = self.pump_outflow * seconds / 3600.0
+            pumped = min(demand, volume)
+            if pumped < demand:
+                self.dry_run_seconds += seconds * (1 - pumped / demand)
+            volume -= pumped
+            self.delivered += pumped
+        if volume > self.capacity:
+            self.overflowed += volume - self.capacity
+            volume = self.capacity
+        self.volume = volume
+        self.min_level = min(self.min_level, self.level)
+
+    def wet_pins(self, pin_count):
+        """Number of level pins under water, with pin i at height (i + 1) / pin_count"""
+        return min(pin_count, int(self.level * pin_count + 1e-9))
+
+    def time_to_change(self, pump_on, pin_count, now, horizon=None):
+        """Seconds from now (datetime) until the number of wet pins changes with the pump on or off, or None if
+        that does not happen within horizon seconds (Default = never)"""
+        wet_pins = self.wet_pins(pin_count)
+        # Volumes at which the reading changes (see wet_pins() for the tolerance), None at the bottom and top pin
+        lower = (wet_pins - 2e-9) * self.capacity / pin_count if wet_pins > 0 else None
+        upper = (wet_pins + 1 - 1e-9) * self.capacity / pin_count if wet_pins < pin_count else None
+        outflow = self.pump_outflow if pump_on else 0.0
+        profile = self.inflow if isinstance(self.inflow, InflowProfile) else None
+        timestamp = now.timestamp() if profile is not None else None
+        volume = self.volume
+        elapsed = 0.0
+        while horizon is None or elapsed < horizon:
+            if profile is not None:
+                inflow, piece = profile.piece(timestamp)
+            else:
+                inflow, piece = self.inflow(now) if callable(self.inflow) else self.inflow, None
+            rate = (inflow - outflow) / 3600.0  # litres per second
+            seconds = None
+            if rate < 0 and lower is not None and volume > lower:
+                seconds = (volume - lower) / -rate
+            elif rate > 0 and upper is not None and volume < upper:
+                seconds = (upper - volume) / rate
+            if seconds is not None and (piece is None or seconds <= piece):
+                return elapsed + seconds
+            if piece is None:
+                return None
+            # Not within this piece of the inflow; follow the level into the next one
+            volume = min(self.capacity, max(0.0, volume + rate * piece))
+            elapsed += piece
+            timestamp += piece
+        return None
+
+
+class InflowProfile:
+    """Inflow in litres per hour that changes every bucket_seconds, e.g. estimated from telemetry"""
+
+    def __init__(self, start_time, bucket_seconds, rates):
+        self.start_time = start_time  # unix timestamp at which rates[0] starts
+        self.bucket_seconds = bucket_seconds
+        self.rates = rates
+
+    def _bucket(self, timestamp):
+        return min(len(self.rates) - 1, max(0, int((timestamp - self.start_time) // self.bucket_seconds)))
+
+    def __call__(self, now):
+        return self.rates[self._bucket(now.timestamp())]
+
+    def piece(self, timestamp):
+        """Inflow at timestamp and the seconds until it changes (None after the last bucket)"""
+        bucket = self._bucket(timestamp)
+        if bucket == len(self.rates) - 1:
+            return self.rates[bucket], None
+        return self.rates[bucket], self.start_time + (bucket + 1) * self.bucket_seconds - timestamp
+
+
+class StaticConfig:
+    """Config store stand-in with fixed values (see pumpcontrol.create_config_store for the names)"""
+
+    def __init__(self, threshold=pumpcontrol.threshold_default, mode=ControlMode.MANUAL, manual_pump_on=True,
+                 schedule=None, timer_end_time=0, calendar=None):
+        self.values = {"threshold": threshold, "mode": mode, "manual_pump_on": manual_pump_on,
+                       "schedule": schedule, "timer_end_time": timer_end_time, "calendar": calendar or []}
+
+    def get(self, name):
+        return self.values[name]
+
+
+# Make pumpcontrol, pump_scheduler and pump_timer read the time from clock; returns the clock used before
+def use_clock(clock):
+    previous_clock = pumpcontrol.clock
+    pumpcontrol.clock = pump_scheduler.clock = pump_timer.clock = clock
+    return previous_clock
+
+
+def run_simulation(tank, config, clock, duration, cycle_time=None, pin_count=None):
+    """Run the control loop for duration (simulated) seconds, one decision every cycle_time seconds
+    (Default = pumpcontrol.sleep_time). Returns a dict of results."""
+    if cycle_time is None:
+        cycle_time = pumpcontrol.sleep_time
+    if pin_count is None:
+        pin_count = len(pumpcontrol.LVL_PIN_NO_ARRAY)
+    pump, status_led, seed_voltage, level_reader = create_mock_devices(pin_count)
+
+    previous_clock = use_clock(clock)
+    try:
+        start = time.monotonic()
+        end_time = clock.time() + duration
+        cycles = 0
+        pump_running = False
+        pump_on_seconds = 0.0
+        while clock.time() < end_time:
+            level_reader.set_mask((1 << tank.wet_pins(pin_count)) - 1)
+            decoding = pumpcontrol.read_tank_level_decoded(level_reader, seed_voltage, None, verbose=False)
+            threshold, pump_allowed, pump_desired = pumpcontrol.decide_pump(decoding.level, pump_running, config,
+                                                                            None)
+            if pump_allowed and pump_desired:
+                pump.on()
+            else:
+                pump.off()
+            pump_running = pump.is_active
+
+            tank.step(cycle_time, pump_running, clock.now())
+            if pump_running:
+                pump_on_seconds += cycle_time
+            cycles += 1
+            clock.sleep(cycle_time)
+        wall_time = time.monotonic() - start
+    finally:
+        use_clock(previous_clock)
+
+    days = duration / 86400.0
+    return {
+        "cycles": cycles,
+        "wall_time": wall_time,
+        "cycles_per_second": cycles / wall_time if wall_time > 0 else 0.0,
+        "pump_starts": pump.switch_count,
+        "starts_per_day": pump.switch_count / days if days > 0 else 0.0,
+        "pump_on_seconds": pump_on_seconds,
+        "dry_run_seconds": tank.dry_run_seconds,
+        "delivered": tank.delivered,
+        "overflowed": tank.overflowed,
+        "min_level": tank.min_level,
+        "final_level": tank.level,
+    }
+
+
+def run_event_simulation(tank, config, clock, duration, cycle_time=None, pin_count=None):
+    """Same as run_simulation, but skips ahead over the cycles in which the decision cannot change: until the
+    reading of the level pins changes, or the schedule or timer switches. The results are the same as those of
+    run_simulation for a constant inflow (the changes of an InflowProfile are integrated exactly instead of once
+    per cycle), at a cost per event instead of per cycle."""
+    if cycle_time is None:
+        cycle_time = pumpcontrol.sleep_time
+    if pin_count is None:
+        pin_count = len(pumpcontrol.LVL_PIN_NO_ARRAY)
+    pump, status_led, seed_voltage, level_reader = create_mock_devices(pin_count)
+
+    previous_clock = use_clock(clock)
+    try:
+        start = time.monotonic()
+        end_time = clock.time() + duration
+        cycles = 0
+        events = 0
+        pump_running = False
+        pump_on_seconds = 0.0
+        while clock.time() < end_time:
+            level_reader.set_mask((1 << tank.wet_pins(pin_count)) - 1)
+            decoding = pumpcontrol.read_tank_level_decoded(level_reader, seed_voltage, None, verbose=False)
+            threshold, pump_allowed, pump_desired = pumpcontrol.decide_pump(decoding.level, pump_running, config,
+                                                                            None)
+            if pump_allowed and pump_desired:
+                pump.on()
+            else:
+                pump.off()
+            pump_running = pump.is_active
+
+            # The same decision repeats every cycle until the reading changes or the schedule or timer switches
+            now = clock.now()
+            horizon = end_time - clock.time()
+            deadline = pumpcontrol.get_next_deadline(config)
+            if deadline is not None:
+                horizon = min(horizon, max(0.0, deadline - clock.time()))
+            seconds = tank.time_to_change(pump_running, pin_count, now, horizon)
+            if seconds is None or seconds > horizon:
+                seconds = horizon
+            skip_cycles = max(1, int(math.ceil(seconds / cycle_time)))
+
+            span = skip_cycles * cycle_time
+            tank.advance(span, pump_running, now)
+            clock.advance(span)
+            if pump_running:
+                pump_on_seconds += span
+            cycles += skip_cycles
+            events += 1
+        wall_time = time.monotonic() - start
+    finally:
+        use_clock(previous_clock)
+
+    days = duration / 86400.0
+    return {
+        "cycles": cycles,
+        "events": events,
+        "wall_time": wall_time,
+        "cycles_per_second": cycles / wall_time if wall_time > 0 else 0.0,
+        "pump_starts": pump.switch_count,
+        "starts_per_day": pump.switch_count / days if days > 0 else 0.0,
+        "pump_on_seconds": pump_on_seconds,
+        "dry_run_seconds": tank.dry_run_seconds,
+        "delivered": tank.delivered,
+        "overflowed": tank.overflowed,
+        "min_level": tank.min_level,
+        "final_level": tank.level,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate pumpcontrol on a virtual tank")
+    parser.add_argument("--days", type=float, default=30, help="simulated time, in days (Default = 30)")
+    parser.add_argument("--start", help="simulated start time, YYYY-MM-DD[ HH:MM] (Default = now)")
+    parser.add_argument("--capacity", type=float, default=1000, help="tank capacity, in litres (Default = 1000)")
+    parser.add_argument("--inflow", type=float, default=100, help="inflow, in litres per hour (Default = 100)")
+    parser.add_argument("--pump-outflow", type=float, default=300,
+                        help="pump outflow, in litres per hour (Default = 300)")
+    parser.add_argument("--initial-level", type=float, default=0.5, help="initial level [0.0-1.0] (Default = 0.5)")
+    parser.add_argument("--threshold", type=int, default=pumpcontrol.threshold_default,
+                        help="threshold, in percent (Default = {})".format(pumpcontrol.threshold_default))
+    parser.add_argument("--threshold-delta", type=int, default=pumpcontrol.threshold_delta,
+                        help="width of the hysteresis, in percent (Default = {})".format(pumpcontrol.threshold_delta))
+    parser.add_argument("--sleep-time", type=float, default=pumpcontrol.sleep_time,
+                        help="time between two checks, in seconds (Default = {})".format(pumpcontrol.sleep_time))
+    parser.add_argument("--mode", choices=[mode.value for mode in ControlMode], default=ControlMode.MANUAL.value,
+                        help="control mode (Default = MANUAL, with the pump switched on)")
+    parser.add_argument("--schedule", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           pumpcontrol.cfg_path, "schedule.csv"),
+                        help="schedule CSV for SCHEDULED mode (Default = cfg/schedule.csv)")
+    parser.add_argument("--calendar", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           pumpcontrol.cfg_path, "calendar.csv"),
+                        help="calendar exceptions for SCHEDULED mode (Default = cfg/calendar.csv, if it exists)")
+    parser.add_argument("--timer-hours", type=float, default=0,
+                        help="timer set at the start, in hours, for TIMED mode (Default = 0)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="[%(levelname)s] %(message)s")
+
+    if args.start is not None:
+        start_time = datetime.strptime(args.start, "%Y-%m-%d %H:%M" if " " in args.start else "%Y-%m-%d").timestamp()
+    else:
+        start_time = time.time()
+    clock = VirtualClock(start_time)
+
+    schedule = pump_scheduler.read_schedule(args.schedule) if args.mode == ControlMode.SCHEDULED.value else None
+    calendar = schedule_calendar.read_calendar(args.calendar) if args.mode == ControlMode.SCHEDULED.value else None
+    config = StaticConfig(args.threshold, ControlMode(args.mode), True, schedule,
+                          int(start_time + args.timer_hours * 3600), calendar)
+    pumpcontrol.threshold_delta = args.threshold_delta
+    tank = TankModel(args.capacity, args.inflow, args.pump_outflow, args.initial_level)
+
+    results = run_simulation(tank, config, clock, args.days * 86400, args.sleep_time)
+    print("Simulated {} cycles ({} days) in {:.3f} s: {:.0f} cycles/s".format(
+        results["cycles"], args.days, results["wall_time"], results["cycles_per_second"]))
+    print("Pump starts: {} ({:.1f}/day), pump on: {:.0f} min, dry run: {:.0f} min".format(
+        results["pump_starts"], results["starts_per_day"], results["pump_on_seconds"] / 60,
+        results["dry_run_seconds"] / 60))
+    print("Water delivered: {:.0f} l, overflowed: {:.0f} l, min. level: {:.0f}%, final level: {:.0f}%".format(
+        results["delivered"], results["overflowed"], results["min_level"] * 100, results["final_level"] * 100))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+# Use Python 3
+
+import sys
+import time
+import sqlite3
+import argparse
+from datetime import datetime, timedelta
+
+"""Optional SQLite telemetry database with incrementally maintained rollup tables.
+
+The raw samples go to the "samples" table (indexed by time). For every sample, the rollup tables "rollup_minute",
+"rollup_hour" and "rollup_day" (local calendar days) are updated in the same transaction:
+    start            unix timestamp of the start of the bucket
+    samples          number of samples in the bucket
+    level_samples    number of samples in the bucket with a level (not None, e.g. no faulty reading)
+    level_min        lowest level in the bucket, as a fraction [0.0-1.0] like in the CSV files
+    level_max        highest level
+    level_sum        sum of all levels (mean = level_sum / level_samples, see rollup())
+    pump_on_seconds  time the pump was running within the bucket
+    pump_starts      number of times the pump was turned on within the bucket
+The pump state of a sample is assumed to last until the next sample, but at most max_sample_gap seconds, so
+that the time pumpcontrol was not running is not counted. Running time is split across bucket boundaries.
+
+The database runs in WAL mode and commits in groups (every commit_count samples or commit_interval seconds),
+so that the SD card sees one write per group instead of one per sample.
+"""
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    time INTEGER NOT NULL,
+    level REAL,
+    pump INTEGER NOT NULL,
+    flags INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS samples_time ON samples (time);
+"""
+
+ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup_{0} (
+    start INTEGER PRIMARY KEY,
+    samples INTEGER NOT NULL DEFAULT 0,
+    level_samples INTEGER NOT NULL DEFAULT 0,
+    level_min REAL,
+    level_max REAL,
+    level_sum REAL NOT NULL DEFAULT 0,
+    pump_on_seconds INTEGER NOT NULL DEFAULT 0,
+    pump_starts INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def minute_start(timestamp):
+    return timestamp - timestamp % 60
+
+
+def next_minute_start(bucket_start):
+    return bucket_start + 60
+
+
+def hour_start(timestamp):
+    return timestamp - timestamp % 3600
+
+
+def next_hour_start(bucket_start):
+    return bucket_start + 3600
+
+
+# Local midnight, so that days match what the user sees (and have 23 or 25 hours when DST changes)
+def day_start(timestamp):
+    return int(time.mktime(datetime.fromtimestamp(timestamp).date().timetuple()))
+
+
+def next_day_start(bucket_start):
+    return int(time.mktime((datetime.fromtimestamp(bucket_start).date() + timedelta(days = 1)).timetuple()))
+
+
+# Rollup name -> functions for the start of the bucket containing a timestamp and the start of the next bucket
+ROLLUPS = {
+    "minute": (minute_start, next_minute_start),
+    "hour": (hour_start, next_hour_start),
+    "day": (day_start, next_day_start),
+}
+
+
+class TelemetryDatabase:
+    """Appends samples to the SQLite database and keeps the rollup tables up to date"""
+
+    def __init__(self, filepath, commit_count=30, commit_interval=300.0, max_sample_gap=300):
+        self.filepath = filepath
+        self.commit_count = commit_count
+        self.commit_interval = commit_interval
+        self.max_sample_gap = max_sample_gap
+
+        # Only ever used by one thread at a time (the main loop, or the persist worker of pumpcontrol_async)
+        self._db = sqlite3.connect(filepath, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA + "".join(ROLLUP_SCHEMA.format(name) for name in ROLLUPS))
+        self._add_level_samples()
+
+        self._pending = 0
+        self._transaction_start = None
+        last_sample = self._db.execute("SELECT time, pump FROM samples ORDER BY time DESC LIMIT 1").fetchone()
+        self._last_time, self._last_pump = last_sample if last_sample is not None else (None, 0)
+
+    def _add_level_samples(self):
+        """Add the level_samples column to rollup tables of databases created before it existed, counted from the
+        raw samples"""
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(rollup_minute)")]
+        if "level_samples" in columns:
+            return
+        self._db.execute("BEGIN")
+        for name in ROLLUPS:
+            self._db.execute("ALTER TABLE rollup_{} ADD COLUMN level_samples INTEGER NOT NULL DEFAULT 0".format(name))
+        for name, (bucket_start, next_bucket_start) in ROLLUPS.items():
+            counts = {}
+            for (timestamp,) in self._db.execute("SELECT time FROM samples WHERE level IS NOT NULL"):
+                start = bucket_start(timestamp)
+                counts[start] = counts.get(start, 0) + 1
+            self._db.executemany("UPDATE rollup_{} SET level_samples = ? WHERE start = ?".format(name),
+                                 [(count, start) for start, count in counts.items()])
+        self._db.execute("COMMIT")
+
+    def append(self, timestamp, level, pump_state, flags=0):
+        """Insert a sample; level is a fraction [0.0-1.0] or None. Commits when the group is complete."""
+        timestamp = int(timestamp)
+        pump_state = int(bool(pump_state))
+        if self._transaction_start is None:
+            self._db.execute("BEGIN")
+            self._transaction_start = time.monotonic()
+
+        self._db.execute("INSERT INTO samples (time, level, pump, flags) VALUES (?, ?, ?, ?)",
+                         (timestamp, level, pump_state, flags))
+        for name, (bucket_start, next_bucket_start) in ROLLUPS.items():
+            self._update_rollup(name, bucket_start, next_bucket_start, timestamp, level, pump_state)
+        self._last_time = max(timestamp, self._last_time or timestamp)
+        self._last_pump = pump_state
+
+        self._pending += 1
+        if self._pending >= self.commit_count or time.monotonic() - self._transaction_start >= self.commit_interval:
+            self.flush()
+
+    def _update_rollup(self, name, bucket_start, next_bucket_start, timestamp, level, pump_state):
+        table = "rollup_" + name
+        start = bucket_start(timestamp)
+        self._db.execute("INSERT OR IGNORE INTO {} (start) VALUES (?)".format(table), (start,))
+        # min() and max() with several arguments are NULL if any is, so a missing level keeps the previous values
+        self._db.execute("UPDATE {} SET samples = samples + 1, level_samples = level_samples + (?1 IS NOT NULL), "
+                         "level_min = coalesce(min(level_min, ?1), level_min, ?1), "
+                         "level_max = coalesce(max(level_max, ?1), level_max, ?1), "
+                         "level_sum = level_sum + coalesce(?1, 0), "
+                         "pump_starts = pump_starts + ?2 WHERE start = ?3".format(table),
+                         (level, int(pump_state and not self._last_pump), start))
+
+        # Running time since the previous sample, split into the buckets it falls into
+        if not self._last_pump or self._last_time is None or timestamp <= self._last_time:
+            return
+        interval_start = max(self._last_time, timestamp - self.max_sample_gap)
+        while interval_start < timestamp:
+            start = bucket_start(interval_start)
+            interval_end = min(timestamp, next_bucket_start(start))
+            self._db.execute("INSERT OR IGNORE INTO {} (start) VALUES (?)".format(table), (start,))
+            self._db.execute("UPDATE {} SET pump_on_seconds = pump_on_seconds + ? WHERE start = ?".format(table),
+                             (interval_end - interval_start, start))
+            interval_start = interval_end
+
+    def flush(self):
+        """Commit the pending group of samples"""
+        if self._transaction_start is not None:
+            self._db.execute("COMMIT")
+        self._pending = 0
+        self._transaction_start = None
+
+    def close(self):
+        if self._db is None:
+            return
+        self.flush()
+        self._db.close()
+        self._db = None
+
+    def rollup(self, name, start, end):
+        """Buckets of a rollup ("minute", "hour" or "day") with start <= bucket start < end, oldest first, as
+        (start, samples, level_min, level_max, level_mean, pump_on_seconds, pump_starts) tuples; level_min,
+        level_max and level_mean are None for buckets without any level"""
+        if name not in ROLLUPS:
+            raise ValueError("Unknown rollup: {}".format(name))
+        return self._db.execute("SELECT start, samples, level_min, level_max, "
+                                "level_sum / nullif(level_samples, 0), pump_on_seconds, pump_starts FROM rollup_{} WHERE start >= ? AND start < ? ORDER BY start"
+                                .format(name), (int(start), int(end))).fetchall()
+
+    def samples(self, start, end):
+        """Raw (time, level, pump, flags) samples with start <= time < end, oldest first"""
+        return self._db.execute("SELECT time, level, pump, flags FROM samples WHERE time >= ? AND time < ? "
+                                "ORDER BY time", (int(start), int(end))).fetchall()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pump runtime per day from the pumpcontrol telemetry database")
+    parser.add_argument("database", help="database file, e.g. telemetry/telemetry.sqlite3")
+    parser.add_argument("--days", type=int, default=30, help="number of days to show (Default = 30)")
+    args = parser.parse_args(argv)
+
+    database = TelemetryDatabase(args.database)
+    end = time.time()
+    print("Day;Runtime [min];Starts;Min. Level;Max. Level;Mean Level")
+    for start, samples, level_min, level_max, level_mean, pump_on_seconds, pump_starts \
+            in database.rollup("day", end - args.days * 86400, end):
+        print("{};{:.0f};{};{};{};{}".format(datetime.fromtimestamp(start).strftime("%Y-%m-%d"),
+                                             pump_on_seconds / 60.0, pump_starts, level_min, level_max,
+                                             "{:.2f}".format(level_mean) if level_mean is not None else None))
+    database.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# Use Python 3
+
+import os
+import sys
+import gzip
+import mmap
+import time
+import struct
+import bisect
+import argparse
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""Compact binary time series store for the tank telemetry.
+
+Every sample is stored as a fixed-width 8 byte little-endian record:
+    uint32 time (unix timestamp, seconds), uint8 level (percent, LEVEL_UNKNOWN if not known),
+    uint8 pump state (0/1), uint8 flags (FLAG_*), uint8 padding
+Records are appended to one file per UTC day (<directory>/YYYY-MM-DD.bin) in time order, so a time range can be
+found by binary search on the time column of a memory-mapped file, without parsing anything.
+
+With NumPy installed, TelemetryReader.read_range() returns a structured array (see RECORD_DTYPE), otherwise a
+list of (time, level, pump, flags) tuples.
+"""
+
+
+RECORD = struct.Struct("<IBBBx")
+RECORD_SIZE = RECORD.size
+
+LEVEL_UNKNOWN = 255
+
+# Flags
+FLAG_PUMP_ALLOWED = 0x01
+FLAG_PUMP_DESIRED = 0x02
+FLAG_SENSOR_FAULT = 0x04
+FLAG_CLOCK_ADJUSTED = 0x08  # system clock went backwards, time was clamped to keep the file sorted
+FLAG_FAULT_SHIFT = 4  # bits 4-5: level_sensor fault class of an inconsistent level reading (with FLAG_SENSOR_FAULT)
+FLAG_FAULT_MASK = 0x30
+
+if np is not None:
+    RECORD_DTYPE = np.dtype([("time", "<u4"), ("level", "u1"), ("pump", "u1"), ("flags", "u1"), ("pad", "u1")])
+else:
+    RECORD_DTYPE = None
+
+SECONDS_PER_DAY = 86400
+
+
+def day_filename(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d") + ".bin"
+
+
+# Level as fraction [0.0-1.0] (as returned by read_tank_level) to stored percent code
+def level_to_code(level):
+    if level is None:
+        return LEVEL_UNKNOWN
+    return max(0, min(100, int(round(level * 100))))
+
+
+class TelemetryWriter:
+    """Appends records to the file of the current UTC day"""
+
+    def __init__(self, directory, flush_count=1):
+        self.directory = directory
+        self.flush_count = flush_count
+        self._file = None
+        self._filename = None
+        self._last_time = 0
+        self._pending = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def append(self, timestamp, level, pump_state, flags=0):
+        """Append a sample; level is a fraction [0.0-1.0] or None"""
+        timestamp = int(timestamp)
+        if timestamp < self._last_time:
+            timestamp = self._last_time
+            flags |= FLAG_CLOCK_ADJUSTED
+        filename = day_filename(timestamp)
+        if filename != self._filename:
+            self._open(filename)
+        self._file.write(RECORD.pack(timestamp, level_to_code(level), int(bool(pump_state)), flags))
+        self._last_time = timestamp
+        self._pending += 1
+        if self._pending >= self.flush_count:
+            self.flush()
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+        self._pending = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._filename = None
+
+    def _open(self, filename):
+        self.close()
+        filepath = os.path.join(self.directory, filename)
+        self._file = open(filepath, "ab")
+        self._filename = filename
+        # Drop a partial record left by a power cut, so that all records stay aligned
+        size = self._file.tell()
+        if size % RECORD_SIZE:
+            self._file.truncate(size - size % RECORD_SIZE)
+            self._file.seek(0, os.SEEK_END)
+        # Continue after the last stored record, so the file stays sorted even if the clock went backwards
+        if self._file.tell() >= RECORD_SIZE:
+            with open(filepath, "rb") as day_file:
+                day_file.seek(-RECORD_SIZE, os.SEEK_END)
+                self._last_time = max(self._last_time, RECORD.unpack(day_file.read(RECORD_SIZE))[0])
+
+
+class _TimeColumn:
+    """Sequence view on the time column of a mapped day file, for bisect without NumPy"""
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._count = len(buffer) // RECORD_SIZE
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        return struct.unpack_from("<I", self._buffer, index * RECORD_SIZE)[0]
+
+
+class TelemetryReader:
+    """Reads time ranges from the day files through memory maps"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def days(self):
+        """Names of all day files, oldest first"""
+        try:
+            return sorted(filename for filename in os.listdir(self.directory) if filename.endswith(".bin"))
+        except OSError:
+            return []
+
+    def read_range(self, start, end):
+        """All records with start <= time < end (unix timestamps)"""
+        start = int(start)
+        end = int(end)
+        parts = []
+        day_start = start - start % SECONDS_PER_DAY
+        for day in range(day_start, end, SECONDS_PER_DAY):
+            part = self._read_day(os.path.join(self.directory, day_filename(day)), start, end)
+            if part is not None and len(part):
+                parts.append(part)
+
+        if np is not None:
+            if not parts:
+                return np.empty(0, dtype=RECORD_DTYPE)
+            return np.concatenate(parts)
+        return [record for part in parts for record in part]
+
+    def _read_day(self, filepath, start, end):
+        try:
+            day_file = open(filepath, "rb")
+        except IOError:
+            return None
+        with day_file:
+            size = os.fstat(day_file.fileno()).st_size
+            size -= size % RECORD_SIZE  # ignore a partial record that is just being written
+            if size == 0:
+                return None
+            with mmap.mmap(day_file.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+                if np is not None:
+                    records = np.frombuffer(mapped, dtype=RECORD_DTYPE)
+                    first, last = np.searchsorted(records["time"], [start, end], side="left")
+                    result = records[first:last].copy()  # copy, so that the file can be unmapped
+                    del records
+                    return result
+                times = _TimeColumn(mapped)
+                first = bisect.bisect_left(times, start)
+                last = bisect.bisect_left(times, end, first)
+                return [RECORD.unpack_from(mapped, i * RECORD_SIZE)[:4] for i in range(first, last)]
+
+
+# Iterate over (time, level, pump, flags) of a read_range() result, whichever type it is
+def iter_records(records):
+    for record in records:
+        yield int(record[0]), int(record[1]), int(record[2]), int(record[3])
+
+
+def export_csv(reader, start, end, out):
+    """Write a time range in the "Time;Level;Pump" CSV format of pumpcontrol's telemetry"""
+    out.write("Time;Level;Pump\n")
+    for timestamp, level_code, pump_state, flags in iter_records(reader.read_range(start, end)):
+        level = "" if level_code == LEVEL_UNKNOWN else level_code / 100.0
+        out.write("{};{};{}\n".format(datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"),
+                                      level, pump_state))
+
+
+def read_csv_records(csv_filepath):
+    """Yield (time, level, pump) of a pumpcontrol CSV file (plain or gzipped); level is a fraction [0.0-1.0]"""
+    opener = gzip.open if csv_filepath.endswith(".gz") else open
+    with opener(csv_filepath, "rt") as csv_file:
+        for line in csv_file:
+            fields = line.strip().split(";")
+            if len(fields) != 3 or fields[0] == "Time":
+                continue
+            try:
+                timestamp = time.mktime(datetime.strptime(fields[0], "%Y-%m-%d %H:%M:%S").timetuple())
+                yield timestamp, float(fields[1]), int(fields[2])
+            except ValueError:
+                continue
+
+
+def import_csv(writer, csv_filepath):
+    """Append the records of a pumpcontrol CSV file (plain or gzipped) to the store; returns the record count"""
+    count = 0
+    for timestamp, level, pump_state in read_csv_records(csv_filepath):
+        writer.append(timestamp, level, pump_state)
+        count += 1
+    writer.flush()
+    return count
+
+
+# Parse "YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS" (local time) to a unix timestamp
+def _parse_time_argument(text):
+    for time_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return time.mktime(datetime.strptime(text, time_format).timetuple())
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("Not a date: {}".format(text))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pumpcontrol telemetry store")
+    parser.add_argument("directory", help="telemetry directory, e.g. telemetry")
+    subparsers = parser.add_subparsers(dest="command")
+    export_parser = subparsers.add_parser("export", help="export a time range as CSV to stdout")
+    export_parser.add_argument("start", type=_parse_time_argument)
+    export_parser.add_argument("end", type=_parse_time_argument)
+    import_parser = subparsers.add_parser("import", help="import pumpcontrol CSV files (.csv or .csv.gz)")
+    import_parser.add_argument("csv_files", nargs="+")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        export_csv(TelemetryReader(args.directory), args.start, args.end, sys.stdout)
+    elif args.command == "import":
+        writer = TelemetryWriter(args.directory, flush_count=1000)
+        for csv_filepath in sorted(args.csv_files):
+            print("Imported {} records from {}".format(import_csv(writer, csv_filepath), csv_filepath))
+        writer.close()
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
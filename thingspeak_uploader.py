@@ -0,0 +1,315 @@
+#!/usr/bin/python
+# Use Python 3
+
+import os
+import json
+import time
+import queue
+import threading
+from datetime import datetime, timezone
+
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+
+"""Batched, offline-tolerant uploader for Thingspeak.
+
+Samples are handed to a bounded in-memory queue and sent by a background thread in batches, using Thingspeak's
+bulk update JSON API. If Thingspeak cannot be reached, the batch is appended to a spool file on disk instead.
+Once the link is back, the spool is replayed oldest-first before any new samples are sent.
+
+Spool file format: one JSON object per line, {"created_at": ..., "field1": ..., "field2": ...}.
+The replay position is kept in a small sidecar file (<spool>.pos), so a restart does not send samples twice.
+"""
+
+
+THINGSPEAK_BULK_URL = 'https://api.thingspeak.com/channels/{}/bulk_update.json'
+
+# Thingspeak accepts at most 960 updates per bulk request
+MAX_BATCH_SIZE = 960
+
+# Outcomes of sending a batch: delivered, rejected for good (not worth retrying), or to be retried later
+SEND_SENT = "sent"
+SEND_DROPPED = "dropped"
+SEND_RETRY = "retry"
+
+
+# Format a unix timestamp the way Thingspeak's bulk update API expects it
+def format_created_at(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d %H:%M:%S +0000")
+
+
+def post_json(url, body, timeout):
+    """Fallback transport opening a new connection per request: POST a JSON body, return the HTTP status code.
+    Raises on connection errors. See connection_manager.ConnectionManager.post_json for a keep-alive transport."""
+    data = json.dumps(body).encode("utf-8")
+    req = Request(url, data, {"Content-Type": "application/json"})
+    response = urlopen(req, None, timeout)
+    try:
+        response.read()
+        return response.status
+    finally:
+        response.close()
+
+
+class ThingspeakUploader:
+    """Background uploader with a bounded queue, batching and a size-capped disk spool"""
+
+    def __init__(self, url, key, spool_filepath, log=print, batch_size=30, batch_interval=300.0, queue_size=1000,
+                 spool_max_bytes=8 * 1024 * 1024, retry_interval=60.0, timeout=10.0, transport=post_json):
+        self.url = url
+        self.key = key
+        self.spool_filepath = spool_filepath
+        self.spool_pos_filepath = spool_filepath + ".pos"
+        self.log = log
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.batch_interval = batch_interval
+        self.spool_max_bytes = spool_max_bytes
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.transport = transport
+
+        # Counters
+        self.sent = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.queue_dropped = 0   # queue full, counted by the producer thread only
+        self.upload_dropped = 0  # rejected or not spoolable, counted by the worker thread only
+        self.requests = 0
+
+        self._queue = queue.Queue(queue_size)
+        self._stop = threading.Event()
+        self._flush = threading.Event()
+        self._thread = None
+        self._next_retry = 0.0
+
+    @property
+    def dropped(self):
+        """Samples lost in total"""
+        return self.queue_dropped + self.upload_dropped
+
+    # Producer side ####################################################################################################
+
+    def submit(self, level, pump_state, timestamp=None):
+        """Hand a sample to the uploader without blocking. Returns False if the queue is full (backpressure)."""
+        if timestamp is None:
+            timestamp = time.time()
+        sample = {"created_at": format_created_at(timestamp), "field1": level, "field2": pump_state}
+        try:
+            self._queue.put_nowait(sample)
+        except queue.Full:
+            self.queue_dropped += 1
+            return False
+        return True
+
+    def flush(self):
+        """Ask the uploader to send what it has right away instead of waiting for a full batch"""
+        self._flush.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="thingspeak-uploader", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the worker; samples that could not be sent are spooled"""
+        self._stop.set()
+        self._flush.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def pending_spool_bytes(self):
+        try:
+            return os.path.getsize(self.spool_filepath) - self._read_spool_pos()
+        except OSError:
+            return 0
+
+    # Worker side ######################################################################################################
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect_batch()
+            self._upload(batch)
+        # Drain what is left and keep it for the next start
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._append_to_spool(batch)
+
+    def _collect_batch(self):
+        """Wait until batch_size samples are queued, batch_interval elapsed or a flush was requested"""
+        batch = []
+        deadline = time.monotonic() + self.batch_interval
+        while len(batch) < self.batch_size and not self._flush.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=min(remaining, 1.0)))
+            except queue.Empty:
+                pass
+        self._flush.clear()
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _upload(self, batch):
+        # Do not hammer a dead link, spool until the next retry is due
+        if time.monotonic() < self._next_retry:
+            if batch:
+                self._append_to_spool(batch)
+            return
+
+        # Replay the spool first, so that Thingspeak receives samples oldest-first
+        if not self._replay_spool():
+            if batch:
+                self._append_to_spool(batch)
+            return
+
+        if batch:
+            result = self._send(batch)
+            if result == SEND_SENT:
+                self.sent += len(batch)
+            elif result == SEND_DROPPED:
+                self.upload_dropped += len(batch)
+            else:
+                self._append_to_spool(batch)
+
+    def _send(self, updates):
+        """Send a batch; returns SEND_SENT, SEND_DROPPED or SEND_RETRY"""
+        body = {"write_api_key": self.key, "updates": updates}
+        self.requests += 1
+        try:
+            status = self.transport(self.url, body, self.timeout)
+        except HTTPError as e:
+            status = e.code
+        except (URLError, OSError) as e:
+            self.log("[ERROR] Error sending data to Thingspeak: Failed to reach server. Reason: {}".format(e))
+            self._next_retry = time.monotonic() + self.retry_interval
+            return SEND_RETRY
+
+        if 200 <= status < 300:
+            self.log("[INFO] Successfully sent {} samples to Thingspeak".format(len(updates)))
+            return SEND_SENT
+        if 400 <= status < 500 and status != 429:
+            # Thrown when URL or Key are wrong; retrying will not help, so do not let the spool fill up with it
+            self.log("[ERROR] Error sending data to Thingspeak: Server rejected the request. Error code: {}. "
+                     "Dropping {} samples.".format(status, len(updates)))
+            return SEND_DROPPED
+        self.log("[ERROR] Error sending data to Thingspeak: Server could not fulfill the request. "
+                 "Error code: {}".format(status))
+        self._next_retry = time.monotonic() + self.retry_interval
+        return SEND_RETRY
+
+    # Spool ############################################################################################################
+
+    def _append_to_spool(self, batch):
+        try:
+            with open(self.spool_filepath, "a") as spool_file:
+                for sample in batch:
+                    spool_file.write(json.dumps(sample) + "\n")
+            self.spooled += len(batch)
+        except IOError as e:
+            self.log("[ERROR] Could not write to Thingspeak spool file. Dropping {} samples. IOError occurred: {}"
+                     .format(len(batch), e))
+            self.upload_dropped += len(batch)
+            return
+
+        # The batch is spooled either way; if compacting fails, the spool just stays too large until the next try
+        try:
+            if os.path.getsize(self.spool_filepath) > self.spool_max_bytes:
+                self._compact_spool()
+        except IOError as e:
+            self.log("[ERROR] Could not compact Thingspeak spool file. IOError occurred: {}".format(e))
+
+    def _compact_spool(self):
+        """Remove replayed samples and, if still too large, the oldest samples, keeping half of the size cap"""
+        pos = self._read_spool_pos()
+        with open(self.spool_filepath, "rb") as spool_file:
+            spool_file.seek(pos)
+            lines = spool_file.readlines()
+
+        kept = []
+        kept_bytes = 0
+        for line in reversed(lines):
+            if kept_bytes + len(line) > self.spool_max_bytes // 2:
+                break
+            kept.append(line)
+            kept_bytes += len(line)
+        kept.reverse()
+
+        tmp_filepath = self.spool_filepath + ".tmp"
+        with open(tmp_filepath, "wb") as tmp_file:
+            tmp_file.writelines(kept)
+        os.replace(tmp_filepath, self.spool_filepath)
+        self._write_spool_pos(0)
+
+        # Only counted once the compacted file is in place
+        if len(kept) < len(lines):
+            self.upload_dropped += len(lines) - len(kept)
+            self.log("[WARNING] Thingspeak spool file exceeded {} bytes, dropped {} oldest samples"
+                     .format(self.spool_max_bytes, len(lines) - len(kept)))
+
+    def _replay_spool(self):
+        """Send spooled samples oldest-first. Returns True once the spool is empty, False if samples are left or the
+        spool could not be read or updated (then the new batch is spooled, or counted as dropped if that fails too,
+        and the replay is retried after retry_interval)."""
+        try:
+            return self._replay_spool_file()
+        except IOError as e:
+            self.log("[ERROR] Could not replay Thingspeak spool file, retrying in {:.0f} s. IOError occurred: {}"
+                     .format(self.retry_interval, e))
+            self._next_retry = time.monotonic() + self.retry_interval
+            return False
+
+    def _replay_spool_file(self):
+        if not os.path.exists(self.spool_filepath):
+            return True
+
+        pos = self._read_spool_pos()
+        with open(self.spool_filepath, "rb") as spool_file:
+            spool_file.seek(pos)
+            while True:
+                updates = []
+                for line in iter(spool_file.readline, b""):
+                    try:
+                        updates.append(json.loads(line.decode("utf-8")))
+                    except ValueError:
+                        pass  # half-written line after a power cut
+                    if len(updates) >= self.batch_size:
+                        break
+                if not updates:
+                    break
+                result = self._send(updates)
+                if result == SEND_RETRY:
+                    return False
+                if result == SEND_SENT:
+                    self.replayed += len(updates)
+                else:
+                    self.upload_dropped += len(updates)
+                self._write_spool_pos(spool_file.tell())
+
+        # Everything was replayed
+        os.remove(self.spool_filepath)
+        self._write_spool_pos(0)
+        return True
+
+    def _read_spool_pos(self):
+        try:
+            with open(self.spool_pos_filepath) as pos_file:
+                return int(pos_file.readline())
+        except (IOError, ValueError):
+            return 0
+
+    def _write_spool_pos(self, pos):
+        if pos == 0:
+            if os.path.exists(self.spool_pos_filepath):
+                os.remove(self.spool_pos_filepath)
+            return
+        with open(self.spool_pos_filepath, "w") as pos_file:
+            pos_file.write(str(pos))
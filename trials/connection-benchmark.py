@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# Use Python 3
+
+# Compare TLS handshakes per hour of uploads between a new urlopen() per request (as pumpcontrol did before)
+# and the keep-alive connection manager, against a local TLS stand-in server with a self-signed certificate.
+# Needs the openssl command line tool to create the certificate.
+
+import os
+import sys
+import ssl
+import time
+import tempfile
+import threading
+import subprocess
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from connection_manager import ConnectionManager
+
+
+# One hour of uploads at pumpcontrol's default sleep_time of 30 seconds
+REQUESTS_PER_HOUR = 120
+# Like nginx' keepalive_requests: the server closes a connection after this many requests
+SERVER_KEEPALIVE_REQUESTS = 40
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.handshakes += 1
+        if self.request.session_reused:
+            self.server.resumed += 1
+        self.requests_on_connection = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.requests_on_connection += 1
+        payload = b"1"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(payload)))
+        if self.requests_on_connection >= SERVER_KEEPALIVE_REQUESTS:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def create_certificate(directory):
+    cert_filepath = os.path.join(directory, "cert.pem")
+    key_filepath = os.path.join(directory, "key.pem")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                           "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+                           "-keyout", key_filepath, "-out", cert_filepath],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_filepath, key_filepath
+
+
+def start_server(cert_filepath, key_filepath):
+    server = ThreadingHTTPSServer(("localhost", 0), StandinHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_filepath, key_filepath)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    server.handshakes = 0
+    server.resumed = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_urlopen(url, client_context):
+    for i in range(REQUESTS_PER_HOUR):
+        response = urlopen(Request(url, b"field1=50&field2=1"), None, 5, context=client_context)
+        response.read()
+        response.close()
+
+
+def run_connection_manager(url, client_context):
+    connections = ConnectionManager(timeout=5, ssl_context=client_context)
+    for i in range(REQUESTS_PER_HOUR):
+        connections.request("POST", url, b"field1=50&field2=1", {"Content-Type": "application/x-www-form-urlencoded"})
+    stats = connections.stats()
+    connections.close()
+    return stats
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    cert_filepath, key_filepath = create_certificate(directory)
+    client_context = ssl.create_default_context(cafile=cert_filepath)
+
+    for name, run in (("urlopen per request", run_urlopen), ("connection manager", run_connection_manager)):
+        server = start_server(cert_filepath, key_filepath)
+        url = "https://localhost:{}/update".format(server.server_address[1])
+        start = time.monotonic()
+        stats = run(url, client_context)
+        duration = time.monotonic() - start
+        server.shutdown()
+        print("{:<20} handshakes/hour: {:>3} (full: {:>3}, resumed: {:>3}), {:.1f} ms per request"
+              .format(name, server.handshakes, server.handshakes - server.resumed, server.resumed,
+                      duration / REQUESTS_PER_HOUR * 1000))
+        if stats is not None:
+            print("{:<20} client counters: {}".format("", stats["https://localhost:{}".format(server.server_address[1])]))
+
+
+if __name__ == "__main__":
+    main()
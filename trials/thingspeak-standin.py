@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# Use Python 3
+
+# Local stand-in for the Thingspeak API, to try out the uploader without internet access or an API key.
+# Run without arguments to go through an offline -> online scenario with the batching uploader,
+# or with --serve PORT to just run the stand-in server.
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from thingspeak_uploader import ThingspeakUploader
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path.endswith("/bulk_update.json"):
+            updates = json.loads(body.decode("utf-8"))["updates"]
+            self.server.received.extend(updates)
+            self.server.requests += 1
+            self._reply(202, b'{"success":true}')
+        elif self.path == "/update":
+            self.server.received.append(body.decode("ascii"))
+            self.server.requests += 1
+            self._reply(200, str(len(self.server.received)).encode("ascii"))
+        else:
+            self._reply(404, b"")
+
+    def _reply(self, status, payload):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_standin(port):
+    server = HTTPServer(("127.0.0.1", port), StandinHandler)
+    server.received = []
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_scenario():
+    port = 18080
+    spool_filepath = os.path.join(tempfile.mkdtemp(), "spool.jsonl")
+    uploader = ThingspeakUploader("http://127.0.0.1:{}/channels/1/bulk_update.json".format(port), "KEY",
+                                  spool_filepath, batch_size=10, batch_interval=0.2, retry_interval=0.5, timeout=1)
+    uploader.start()
+
+    # Link down: nothing listens on the port
+    for i in range(25):
+        uploader.submit(i, i % 2, timestamp=1600000000 + 30 * i)
+    time.sleep(1)
+    print("Offline: sent {}, spooled {}, spool bytes {}".format(uploader.sent, uploader.spooled,
+                                                               uploader.pending_spool_bytes()))
+
+    # Link back up
+    server = start_standin(port)
+    for i in range(25, 40):
+        uploader.submit(i, i % 2, timestamp=1600000000 + 30 * i)
+    time.sleep(2)
+    uploader.stop()
+
+    levels = [update["field1"] for update in server.received]
+    print("Online: sent {}, replayed {}, requests {}, received {} samples".format(uploader.sent, uploader.replayed,
+                                                                              server.requests, len(levels)))
+    print("Received oldest-first without gaps: {}".format(levels == list(range(40))))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Thingspeak stand-in")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="only run the stand-in server on PORT")
+    args = parser.parse_args()
+    if args.serve:
+        server = start_standin(args.serve)
+        print("Thingspeak stand-in listening on http://127.0.0.1:{}".format(args.serve))
+        try:
+            while True:
+                time.sleep(10)
+                print("Received {} samples in {} requests".format(len(server.received), server.requests))
+        except KeyboardInterrupt:
+            pass
+    else:
+        run_scenario()
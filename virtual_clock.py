@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# Use Python 3
+
+import time
+from datetime import datetime
+
+"""Clocks for pumpcontrol, pump_scheduler and pump_timer.
+
+Each of these modules reads the current time through its module-level `clock` (system_clock by default) instead of
+calling datetime.now() or time.time() directly. The simulator swaps in a VirtualClock, whose time only moves when
+it is told to, so weeks of control cycles run in seconds and always give the same result.
+
+All clocks provide:
+    time()        unix timestamp
+    monotonic()   seconds from an arbitrary origin, never going backwards
+    now()         local datetime
+    sleep(s)      wait s seconds
+"""
+
+
+class SystemClock:
+    """Real time"""
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock:
+    """Simulated time that only advances through sleep() or advance()"""
+
+    def __init__(self, start_time=0.0):
+        self._time = float(start_time)
+        self._start_time = self._time
+
+    def time(self):
+        return self._time
+
+    def monotonic(self):
+        return self._time - self._start_time
+
+    def now(self):
+        return datetime.fromtimestamp(self._time)
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self._time += seconds
+
+
+system_clock = SystemClock()